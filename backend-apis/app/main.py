@@ -38,16 +38,38 @@ from app.routers import (
     p6_field_service_agent,
     p7_return_agent
 )
-
-client = google.cloud.logging.Client()
-client.setup_logging()
-
+from app.utils.utils_metrics import get_metrics
+from app.utils.utils_sentiment import sentiment_worker
 
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
 
 
 app = FastAPI()
+
+
+@app.on_event("startup")
+def setup_logging():
+    """Sets up Cloud Logging when the server starts instead of at import"""
+    google.cloud.logging.Client().setup_logging()
+
+
+@app.on_event("startup")
+def start_sentiment_worker():
+    """Starts the background sentiment scoring of P4 chat messages"""
+    sentiment_worker.start()
+
+
+@app.on_event("shutdown")
+def stop_sentiment_worker():
+    """Scores the queued chat messages before the server stops"""
+    sentiment_worker.stop(
+        timeout=config.get("sentiment_worker", {}).get(
+            "drain_timeout_seconds", 10
+        )
+    )
+
+
 app.include_router(router=p1_customer.router)
 app.include_router(router=p2_content_creator.router)
 app.include_router(router=p4_customer_service_agent.router)
@@ -74,6 +96,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/metrics")
+def metrics() -> dict:
+    """
+    ## In-process metrics
+
+    ### Returns:
+    - Counters of the connection pool, caches and executors, by name
+
+    """
+    return get_metrics()
+
+
 @app.get("/")
 @app.get("/customer/{path}")
 @app.get("/contact-center-analyst/{path}")
@@ -48,9 +48,17 @@ class GenerateConversationsInsightsRequest(BaseModel):
     ## Request Body for generate-conversations-insights
     **conversations**: *list*
     - Conversations to generate the insights from
+
+    **mode**: *string*
+    - Optional. Insights generation mode
+    - Allowed values
+        - parts: one Gemini call per part
+        - bundle: a single Gemini call for all the parts
+    - Defaults to insights_mode in config.toml
     """
 
     conversations: list[dict]
+    mode: Literal["parts", "bundle"] | None = None
 
 
 class GenerateConversationsInsightsResponse(BaseModel):
@@ -71,6 +79,8 @@ class GenerateConversationsInsightsResponse(BaseModel):
     **next_best_action**: *string*
     - Next best action extracted from the conversations
 
+    **failed_parts**: *list*
+    - Parts that failed or timed out and are returned empty
     """
 
     summary: str
@@ -78,6 +88,7 @@ class GenerateConversationsInsightsResponse(BaseModel):
     insights: str
     pending_tasks: str
     next_best_action: str
+    failed_parts: list[str] = []
 
 
 # @router.post(path="/generate-reviews-insights")
@@ -108,6 +119,9 @@ class GenerateReviewsInsightsResponse(BaseModel):
 
     **next_best_action**: *string*
     - Next best action extracted from the reviews
+
+    **failed_parts**: *list*
+    - Parts that failed or timed out and are returned empty
     """
 
     summary: str
@@ -115,6 +129,7 @@ class GenerateReviewsInsightsResponse(BaseModel):
     insights: str
     pending_tasks: str
     next_best_action: str
+    failed_parts: list[str] = []
 
 
 # @router.post(path="/search-conversations")
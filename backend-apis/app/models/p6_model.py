@@ -142,9 +142,17 @@ class GenerateConversationsInsightsRequest(BaseModel):
     ### Request Body for generate-conversations-insights
     **conversations**: *list*
     - Conversations to generate the insights from
+
+    **mode**: *string*
+    - Optional. Insights generation mode
+    - Allowed values
+        - parts: one Gemini call per part
+        - bundle: a single Gemini call for all the parts
+    - Defaults to insights_mode in config.toml
     """
 
     conversations: list[dict]
+    mode: Literal["parts", "bundle"] | None = None
 
 
 class GenerateConversationsInsightsResponse(BaseModel):
@@ -165,6 +173,8 @@ class GenerateConversationsInsightsResponse(BaseModel):
     **next_best_action**: *string*
     - Next best action extracted from the conversations
 
+    **failed_parts**: *list*
+    - Parts that failed or timed out and are returned empty
     """
 
     summary: str
@@ -172,6 +182,7 @@ class GenerateConversationsInsightsResponse(BaseModel):
     insights: str
     pending_tasks: str
     next_best_action: str
+    failed_parts: list[str] = []
 
 
 # @router.post(path="/search-manuals")
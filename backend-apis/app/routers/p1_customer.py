@@ -20,7 +20,7 @@ import json
 import tomllib
 
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from google.api_core.exceptions import GoogleAPICallError
 from google.cloud import firestore, pubsub_v1
 from google.cloud import translate_v2 as translate
@@ -51,23 +51,28 @@ from app.utils import (
     utils_cloud_sql,
     utils_gemini,
     utils_recommendations,
+    utils_reviews,
     utils_salesforce,
     utils_search,
     utils_workspace,
 )
+from app.utils.utils_lazy import lazy
 
 # ----------------------------------------------------------------------------#
 # Load configuration file (config.toml) and global configs
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
 
+# Per call site TTLs of the LLM response cache
+llm_cache_ttl = config.get("llm_cache", {}).get("ttl_seconds", {})
+
 # ----------------------------------------------------------------------------#
 
 # ----------------------------------------------------------------------------#
 # Clients
-db = firestore.Client()
-publisher = pubsub_v1.PublisherClient()
-translate_client = translate.Client()
+db = lazy(firestore.Client)
+publisher = lazy(pubsub_v1.PublisherClient)
+translate_client = lazy(translate.Client)
 
 # ----------------------------------------------------------------------------#
 
@@ -75,7 +80,9 @@ translate_client = translate.Client()
 # Pubsub Topics
 project_id = config["global"]["project_id"]
 website_topic_id = config["website_search"]["website_topic_id"]
-website_topic_path = publisher.topic_path(project_id, website_topic_id)
+website_topic_path = pubsub_v1.PublisherClient.topic_path(
+    project_id, website_topic_id
+)
 recommendations_topic_id = config["recommendations"][
     "recommendations_topic_id"
 ]
@@ -85,10 +92,10 @@ email_recommendation_topic_id = config["recommendations"][
 email_template = config["recommendations"][
     "email_template"
 ]
-recommendations_topic_path = publisher.topic_path(
+recommendations_topic_path = pubsub_v1.PublisherClient.topic_path(
     project_id, recommendations_topic_id
 )
-email_recommendation_topic_path = publisher.topic_path(
+email_recommendation_topic_path = pubsub_v1.PublisherClient.topic_path(
     project_id, email_recommendation_topic_id
 )
 # ----------------------------------------------------------------------------#
@@ -220,11 +227,9 @@ def get_reviews_summary(product_id: int) -> GetReviewsSummaryResponse:
     **HTTPException** - *404* - Product not found
     - Product was not found in the Cloud SQL database
 
-    **HTTPException** - 400 - Error getting reviews
-    - Firestore could not return the reviews
-
     **HTTPException** - 400 - Error generating reviews summary
-    - PaLM could not generate the summary
+    - Firestore could not return the reviews or Gemini could not generate
+    the summary
 
     """
     try:
@@ -239,43 +244,45 @@ def get_reviews_summary(product_id: int) -> GetReviewsSummaryResponse:
     product_dict = utils_cloud_sql.convert_product_to_dict(product)
 
     try:
-        reviews: list[GetReviewsResponse.ReviewDoc] = [
-            review_snapshot.to_dict()
-            for review_snapshot in db.collection("website_reviews")
-            .document(str(product_id))
-            .collection("reviews")
-            .get()
-        ]
+        summary = utils_reviews.get_reviews_summary(
+            db, product_id, product_dict
+        )
     except GoogleAPICallError as e:
         raise HTTPException(
-            status_code=400, detail="Error getting reviews " + str(e)
+            status_code=400,
+            detail="Error generating reviews summary" + str(e),
         ) from e
+    return GetReviewsSummaryResponse(reviews_summary=summary)
 
-    summary = "No reviews yet."
-    if reviews:
-        reviews_json = json.dumps(
-            {
-                "product": product_dict,
-                "reviews": reviews,
-            }
-        )
-        try:
-            summary = utils_gemini.generate_gemini_pro_text(
-                prompt=config["summary"]["prompt_reviews"].format(
-                    reviews=reviews_json
-                ),
-                max_output_tokens=1024,
-                temperature=0.2,
-                top_k=40,
-                top_p=0.8,
-            )
 
-        except GoogleAPICallError as e:
-            raise HTTPException(
-                status_code=400,
-                detail="Error generating reviews summary" + str(e),
-            ) from e
-    return GetReviewsSummaryResponse(reviews_summary=summary)
+def product_summary_prompt(product_id: int) -> str:
+    """Builds the product summary prompt
+
+    Args:
+        product_id: int
+            Product id
+
+    Raises:
+        HTTPException:
+            If Cloud SQL failed or the product was not found
+
+    Returns:
+        str
+            Prompt
+    """
+    try:
+        product = utils_cloud_sql.get_product(product_id)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400, detail="Cloud SQL error." + str(e)
+        ) from e
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found.")
+
+    product_dict = utils_cloud_sql.convert_product_to_dict(product)
+    return config["summary"]["prompt_product"].format(
+        product=json.dumps(product_dict)
+    )
 
 
 @router.get(
@@ -306,27 +313,17 @@ def get_product_summary(product_id: int) -> GetProductSummaryResponse:
 
 
     """
-    try:
-        product = utils_cloud_sql.get_product(product_id)
-    except Exception as e:
-        raise HTTPException(
-            status_code=400, detail="Cloud SQL error." + str(e)
-        ) from e
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found.")
-
-    product_dict = utils_cloud_sql.convert_product_to_dict(product)
+    prompt = product_summary_prompt(product_id)
 
     try:
-        product_json = json.dumps(product_dict)
         summary = utils_gemini.generate_gemini_pro_text(
-            prompt=config["summary"]["prompt_product"].format(
-                product=product_json
-            ),
+            prompt=prompt,
             max_output_tokens=1024,
             temperature=0.2,
             top_k=40,
             top_p=0.8,
+            use_cache=True,
+            cache_ttl_seconds=llm_cache_ttl.get("product_summary"),
         )
         return GetProductSummaryResponse(product_summary=summary)
     except Exception as e:
@@ -335,6 +332,45 @@ def get_product_summary(product_id: int) -> GetProductSummaryResponse:
         ) from e
 
 
+@router.get(path="/get-product-summary-stream/{product_id}")
+def get_product_summary_stream(product_id: int) -> StreamingResponse:
+    """
+    # Get Product Summary as a stream
+
+    Streaming variant of get-product-summary. The summary is sent as
+    server-sent events while it is generated.
+
+    ## Path parameters
+    **product_id**: *string*
+    - Product id
+
+    ## Returns
+    **StreamingResponse** - *text/event-stream*
+    - `data: {"text": "..."}` events with the summary chunks
+    - A final `done` event, or an `error` event if generation failed
+
+    ## Raises
+    **HTTPException** - *400* - Cloud SQL Error
+    - Error connecting to Cloud SQL
+
+    **HTTPException** - *404* - Product not found
+    - Product was not found in the Cloud SQL database
+
+    """
+    chunks = utils_gemini.stream_gemini_pro_text(
+        prompt=product_summary_prompt(product_id),
+        max_output_tokens=1024,
+        temperature=0.2,
+        top_k=40,
+        top_p=0.8,
+        use_cache=True,
+        cache_ttl_seconds=llm_cache_ttl.get("product_summary"),
+    )
+    return StreamingResponse(
+        utils_gemini.to_sse_events(chunks), media_type="text/event-stream"
+    )
+
+
 # ---------------------------------POST---------------------------------------#
 @router.post(path="/collect-recommendations-events")
 def collect_recommendations_events(data: CollectRecommendationsEventsRequest):
@@ -385,6 +421,31 @@ def collect_recommendations_events(data: CollectRecommendationsEventsRequest):
     return "ok"
 
 
+def compare_products_prompt(data: CompareProductsRequest) -> str:
+    """Builds the products comparison prompt
+
+    Args:
+        data: CompareProductsRequest
+            Products to compare
+
+    Returns:
+        str
+            Prompt
+    """
+    for i in data.products:
+        print("Product Description------")
+        print(i)
+
+    product_1 = json.loads(data.products[0])
+    product_2 = json.loads(data.products[1])
+    return config["compare"]["prompt_compare"].format(
+        product_title_1=product_1["title"],
+        product_description_1=product_1["description"],
+        product_title_2=product_2["title"],
+        product_description_2=product_2["description"]
+    )
+
+
 @router.post(path="/compare-products", response_class=HTMLResponse)
 def compare_products(data: CompareProductsRequest) -> HTMLResponse:
     """
@@ -404,34 +465,13 @@ def compare_products(data: CompareProductsRequest) -> HTMLResponse:
 
     """
     try:
-        for i in data.products:
-            print("Product Description------")
-            print(i)
-
-        product_1 = json.loads(data.products[0])
-        del product_1["image"]
-        del product_1["quantity"]
-        del product_1["id"]
-        del product_1["features"]
-        del product_1["categories"]
-
-        product_2 = json.loads(data.products[1])
-        del product_2["image"]
-        del product_2["quantity"]
-        del product_2["id"]
-        del product_2["features"]
-        del product_2["categories"]
-
         comparison = utils_gemini.generate_gemini_pro_text(
-            prompt=config["compare"]["prompt_compare"].format(
-                product_title_1=product_1["title"],
-                product_description_1=product_1["description"],
-                product_title_2=product_2["title"],
-                product_description_2=product_2["description"]
-            ),
+            prompt=compare_products_prompt(data),
             temperature=0.2,
             top_k=40,
-            top_p=0.8
+            top_p=0.8,
+            use_cache=True,
+            cache_ttl_seconds=llm_cache_ttl.get("compare_products"),
         )
         return HTMLResponse(content=comparison)
     except GoogleAPICallError as e:
@@ -440,6 +480,37 @@ def compare_products(data: CompareProductsRequest) -> HTMLResponse:
         ) from e
 
 
+@router.post(path="/compare-products-stream")
+def compare_products_stream(data: CompareProductsRequest) -> StreamingResponse:
+    """
+    # Compare Products as a stream
+
+    Streaming variant of compare-products. The HTML comparison table is
+    sent as server-sent events while it is generated.
+
+    ## Request body [CompareProductsRequest]
+    **products**: *list[string]*
+    - List of products ids
+
+    ## Returns
+    **StreamingResponse** - *text/event-stream*
+    - `data: {"text": "..."}` events with the HTML chunks
+    - A final `done` event, or an `error` event if generation failed
+
+    """
+    chunks = utils_gemini.stream_gemini_pro_text(
+        prompt=compare_products_prompt(data),
+        temperature=0.2,
+        top_k=40,
+        top_p=0.8,
+        use_cache=True,
+        cache_ttl_seconds=llm_cache_ttl.get("compare_products"),
+    )
+    return StreamingResponse(
+        utils_gemini.to_sse_events(chunks), media_type="text/event-stream"
+    )
+
+
 @router.post(path="/initiate-vertexai-recommendations")
 def initiate_vertexai_recommendations(
     data: InitiateVertexAIRecommendationsRequest,
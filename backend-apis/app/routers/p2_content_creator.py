@@ -37,7 +37,14 @@ from app.models.p2_model import (
     Product,
     Service,
 )
-from app.utils import utils_gemini, utils_palm, utils_imagen, utils_vertex_vector
+from app.utils import (
+    utils_cloud_sql,
+    utils_gemini,
+    utils_imagen,
+    utils_palm,
+    utils_vertex_vector,
+)
+from app.utils.utils_lazy import lazy
 
 # ----------------------------------------------------------------------------#
 # Load configuration file (config.toml) and global configs
@@ -45,14 +52,17 @@ with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
 
 project_id = config["global"]["project_id"]
+llm_cache_ttl = config.get("llm_cache", {}).get("ttl_seconds", {})
 
 # ----------------------------------------------------------------------------#
 
-db = firestore.Client()
+db = lazy(firestore.Client)
 
 # ----------------------------------------------------------------------------#
 # Vertex Vector multimodal search
-embeddings_client = utils_palm.EmbeddingPredictionClient(project=project_id)
+embeddings_client = lazy(
+    lambda: utils_palm.EmbeddingPredictionClient(project=project_id)
+)
 index_endpoint_id = config["multimodal"]["index_endpoint_id"]
 deployed_index_id = config["multimodal"]["deployed_index_id"]
 vector_api_endpoint = config["multimodal"]["vector_api_endpoint"]
@@ -91,6 +101,7 @@ def delete_user_product(user_id: str, product_id: str) -> str:
         raise HTTPException(
             status_code=400, detail="Error deleting in Firestore" + str(e)
         ) from e
+    utils_cloud_sql.invalidate_product(product_id)
 
     return "ok"
 
@@ -324,21 +335,23 @@ def detect_product_categories(
             detail="Error extracting features and categories" + str(e),
         ) from e
 
-    images_embeddings = []
     try:
         # Get similar products and retrieve their labels from Firestore
-        for image_bytes in images_bytes:
-            images_embeddings.append(
-                embeddings_client.get_embedding(
-                    image_bytes=image_bytes
-                ).image_embedding
+        images_embeddings = [
+            embedding.image_embedding
+            for embedding in embeddings_client.get_embeddings(
+                [
+                    utils_palm.EmbeddingInput(image_bytes=image_bytes)
+                    for image_bytes in images_bytes
+                ]
             )
+        ]
     except GoogleAPICallError as e:
         raise HTTPException(
             status_code=400, detail="Error getting images embeddings" + str(e)
         ) from e
 
-    image_embedding = list(np.sum(np.array(images_embeddings), axis=0))
+    image_embedding = np.sum(images_embeddings, axis=0)
     try:
         neighbors = utils_vertex_vector.find_neighbor(
             feature_vector=image_embedding,
@@ -539,6 +552,8 @@ def generate_title_description(
             prompt=config["content_creation"][
                 "prompt_title_description"
             ].format(data.product_categories, data.context),
+            use_cache=True,
+            cache_ttl_seconds=llm_cache_ttl.get("title_description"),
         )
         response = response.replace("</output>", "")
         response = response.replace("```json", "")
@@ -585,6 +600,7 @@ def put_user_product(user_id: str, product_id: str, product: Product) -> str:
         raise HTTPException(
             status_code=400, detail="Error setting in Firestore" + str(e)
         ) from e
+    utils_cloud_sql.invalidate_product(product_id)
 
     return "ok"
 
@@ -20,9 +20,10 @@ import tomllib
 from datetime import datetime, timedelta, timezone
 
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from google.api_core.exceptions import GoogleAPICallError
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 from google.protobuf import timestamp_pb2
 from proto import Message
 
@@ -47,14 +48,11 @@ from app.utils import (
     utils_cloud_translation,
     utils_gemini,
     utils_search,
+    utils_summarize,
     utils_workspace,
 )
-
-# Imports the Google Cloud language client library
-from google.cloud import language_v1
-
-# Instantiates a client
-lang_client = language_v1.LanguageServiceClient()
+from app.utils.utils_lazy import lazy
+from app.utils.utils_sentiment import sentiment_worker
 
 # Load configuration file
 with open("app/config.toml", "rb") as f:
@@ -71,14 +69,24 @@ chat_summarize_prompt_template = config["salesforce"][
     "chat_summarize_prompt_template"
 ]
 chat_title_prompt_template = config["salesforce"]["chat_title_prompt_template"]
+chat_summary_mode = config["salesforce"].get("chat_summary_mode", "full")
+chat_rolling_summary_prompt_template = config["salesforce"].get(
+    "chat_rolling_summary_prompt_template", ""
+)
+chat_title_from_summary_prompt_template = config["salesforce"].get(
+    "chat_title_from_summary_prompt_template", ""
+)
 
 rephrase_prompt_template = config["salesforce"]["rephrase_prompt_template"]
 
 auto_suggest_prompt_template = config["salesforce"]["auto_suggest_prompt_template"]
 
+# Per call site TTLs of the LLM response cache
+llm_cache_ttl = config.get("llm_cache", {}).get("ttl_seconds", {})
+
 router = APIRouter(prefix="/p4", tags=["P4 - Customer Service Agent"])
 
-db = firestore.Client()
+db = lazy(firestore.Client)
 
 
 # ---------------------------------GET---------------------------------------#
@@ -89,6 +97,9 @@ def conversation_summary_and_title(
     """
     # End conversation and create summary
 
+    In the "rolling" chat_summary_mode, only the messages added since the
+    last summary are read and folded into it.
+
     ## Request parameters
     **user_id**: *string*
     - User Id
@@ -114,6 +125,9 @@ def conversation_summary_and_title(
     - Summarization error
 
     """
+    if chat_summary_mode == "rolling":
+        return _rolling_summary_and_title(user_id, conversation_id)
+
     try:
         conversation_messages_snapshot = [
             message_snapshot.to_dict()
@@ -170,6 +184,112 @@ def conversation_summary_and_title(
     return ConversationSummaryAndTitleResponse(summary=summary, title=title)
 
 
+async def _fold_summary_and_title(
+    summary: str, messages: list
+) -> tuple[str, str]:
+    """Folds new messages into the summary and derives the title from it"""
+    summary = await utils_summarize.fold_summary(
+        summary=summary,
+        items=messages,
+        fold_prompt=chat_rolling_summary_prompt_template,
+    )
+    if not summary:
+        return "", ""
+    title = await utils_gemini.async_predict_text_llm(
+        prompt=chat_title_from_summary_prompt_template.format(
+            summary=summary
+        ),
+    )
+    return summary, title
+
+
+def _rolling_summary_and_title(
+    user_id: str, conversation_id: str
+) -> ConversationSummaryAndTitleResponse:
+    """Updates the summary of a conversation with the messages added since
+    the last summary. The conversation document keeps the summary and the
+    timestamp of the last summarized message (summarized_until).
+
+    Args:
+        user_id: str
+            User Id
+        conversation_id: str
+            Conversation Id
+
+    Returns:
+        ConversationSummaryAndTitleResponse
+    """
+    conversation_ref = (
+        db.collection("p4-conversations")
+        .document(user_id)
+        .collection("conversations")
+        .document(conversation_id)
+    )
+    try:
+        conversation = conversation_ref.get().to_dict() or {}
+        summarized_until = conversation.get("summarized_until")
+        messages_query = conversation_ref.collection("messages")
+        if summarized_until:
+            messages_query = messages_query.where(
+                filter=FieldFilter("timestamp", ">", summarized_until)
+            )
+        new_messages = [
+            message_snapshot.to_dict()
+            for message_snapshot in messages_query.order_by(
+                "timestamp"
+            ).get()
+        ]
+    except GoogleAPICallError as e:
+        print(f"[Error]query_conversation:{e}")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    summary = conversation.get("summary", "") if summarized_until else ""
+    title = conversation.get("title", "") if summarized_until else ""
+    update = {}
+    if new_messages:
+        try:
+            new_summary, new_title = asyncio.run(
+                _fold_summary_and_title(
+                    summary,
+                    [
+                        {
+                            "author": message.get("author"),
+                            "text": message.get("text"),
+                            "timestamp": str(message.get("timestamp")),
+                        }
+                        for message in new_messages
+                    ],
+                )
+            )
+        except GoogleAPICallError as e:
+            print(f"[Error]VertexSummarizeChat:{e}")
+            raise HTTPException(status_code=500, detail=str(e)) from e
+
+        if new_summary:
+            summary = new_summary
+            title = new_title or title or "Closed case"
+            update["summarized_until"] = new_messages[-1]["timestamp"]
+        else:
+            # The messages are summarized again on the next call
+            summary = summary or "Closed case"
+            title = title or "Closed case"
+    elif not summarized_until:
+        summary = "Empty conversation."
+        title = "Empty conversation."
+    else:
+        return ConversationSummaryAndTitleResponse(
+            summary=summary, title=title
+        )
+
+    try:
+        conversation_ref.update({**update, "title": title, "summary": summary})
+    except GoogleAPICallError as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    return ConversationSummaryAndTitleResponse(summary=summary, title=title)
+
+
 # ---------------------------------POST---------------------------------------#
 @router.post(path="/message/{user_id}/{conversation_id}")
 def add_message(
@@ -222,35 +342,25 @@ def add_message(
             ) from e
         conversation_id = conversation_doc[1].id
 
-    try:
-        document = language_v1.types.Document(
-        content=message.text, type_=language_v1.types.Document.Type.PLAIN_TEXT
+    # The sentiment is patched onto the message by the sentiment worker
+    _, message_ref = (
+        db.collection("p4-conversations")
+        .document(user_id)
+        .collection("conversations")
+        .document(conversation_id)
+        .collection("messages")
+        .add(
+            {
+                "author": message.author,
+                "text": message.text,
+                "timestamp": datetime.now(tz=timezone.utc),
+                "language": message.language,
+                "link": message.link,
+                "iconURL": message.iconURL,
+            }
         )
-
-        # Detects the sentiment of the text
-        sentiment = lang_client.analyze_sentiment(
-            request={"document": document}
-        ).document_sentiment
-        sentiment_score = sentiment.score
-        sentiment_magnitude = sentiment.magnitude
-    except:
-        sentiment_score = 0
-        sentiment_magnitude = 0
-
-    db.collection("p4-conversations").document(user_id).collection(
-        "conversations"
-    ).document(conversation_id).collection("messages").add(
-        {
-            "author": message.author,
-            "text": message.text,
-            "timestamp": datetime.now(tz=timezone.utc),
-            "language": message.language,
-            "link": message.link,
-            "iconURL": message.iconURL,
-            "sentiment_score":sentiment_score,
-            "sentiment_magnitude": sentiment_magnitude
-        }
     )
+    sentiment_worker.submit(message_ref, message.text)
 
     return AddMessageResponse(conversation_id=conversation_id)
 
@@ -327,12 +437,42 @@ def rephrase_text(
     """
 
     llm_response = utils_gemini.generate_gemini_pro_text(
-        prompt=rephrase_prompt_template.format(data.rephrase_text_input)
+        prompt=rephrase_prompt_template.format(data.rephrase_text_input),
+        use_cache=True,
+        cache_ttl_seconds=llm_cache_ttl.get("rephrase_text"),
     )
 
     return RephraseTextResponse(rephrase_text_output=llm_response)
 
 
+@router.post(path="/rephrase-text-stream")
+def rephrase_text_stream(data: RephraseTextRequest) -> StreamingResponse:
+    """
+    # Rephrase a given text, as a stream.
+
+    Streaming variant of rephrase-text. The rephrased text is sent as
+    server-sent events while it is generated.
+
+    ## Request body for rephrase-text
+    **rephrase_text_input**: *string*
+    - Text to rephrase
+
+    ## Returns
+    **StreamingResponse** - *text/event-stream*
+    - `data: {"text": "..."}` events with the rephrased text chunks
+    - A final `done` event, or an `error` event if generation failed
+
+    """
+    chunks = utils_gemini.stream_gemini_pro_text(
+        prompt=rephrase_prompt_template.format(data.rephrase_text_input),
+        use_cache=True,
+        cache_ttl_seconds=llm_cache_ttl.get("rephrase_text"),
+    )
+    return StreamingResponse(
+        utils_gemini.to_sse_events(chunks), media_type="text/event-stream"
+    )
+
+
 @router.post(path="/schedule-event")
 def schedule_event(data: ScheduleEventRequest) -> ScheduleEventResponse:
     """
@@ -40,18 +40,43 @@ from app.models.p5_model import (
 )
 from app.utils import (
     utils_cloud_nlp,
+    utils_firestore,
     utils_gemini,
+    utils_insights,
     utils_palm,
     utils_search,
+    utils_summarize,
     utils_vertex_vector,
 )
+from app.utils.utils_cache import TTLCache
+from app.utils.utils_lazy import lazy
+from app.utils.utils_metrics import register_metrics
 
 # Load configuration file
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
 
-db = firestore.Client()
+db = lazy(firestore.Client)
 
+insights_timeout = config["search-persona5"].get(
+    "insights_timeout_seconds", 60
+)
+insights_mode = config["search-persona5"].get("insights_mode", "parts")
+
+# Similar conversations and reviews, read with a field mask
+similar_documents_fields = {
+    "conversations": config["search-persona5"].get(
+        "similar_conversations_fields"
+    ),
+    "reviews": config["search-persona5"].get("similar_reviews_fields"),
+}
+documents_cache = TTLCache(
+    max_size=config["search-persona5"].get("documents_cache_max_size", 4096),
+    ttl_seconds=config["search-persona5"].get(
+        "documents_cache_ttl_seconds", 86400
+    ),
+)
+register_metrics("p5_documents_cache", documents_cache.stats)
 
 router = APIRouter(prefix="/p5", tags=["P5 - Contact Center Analyst"])
 
@@ -117,7 +142,7 @@ def get_customer_info(customer_id: str) -> Customer:
 
 # ---------------------------------POST---------------------------------------#
 @router.post(path="/generate-conversations-insights")
-def generate_insights_conversations(
+async def generate_insights_conversations(
     data: GenerateConversationsInsightsRequest,
 ) -> GenerateConversationsInsightsResponse:
     """
@@ -146,6 +171,9 @@ def generate_insights_conversations(
 
     **next_best_action**: *string*
     - Next best action extracted from the conversations
+
+    **failed_parts**: *list*
+    - Parts that failed or timed out and are returned empty
     """
     if len(data.conversations) > 1:
         prompt_summary = config["search-persona5"][
@@ -173,45 +201,30 @@ def generate_insights_conversations(
         prompt_nbs = config["search-persona5"]["prompt_nbs_conversation"]
 
     input_text = json.dumps({"conversations": data.conversations})
-
-    try:
-        summary = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_summary.format(input_text)
-        )
-        insights = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_insights.format(input_text)
+    prompts = {
+        "summary": prompt_summary,
+        "insights": prompt_insights,
+        "pending_tasks": prompt_tasks,
+        "next_best_action": prompt_nbs,
+    }
+
+    if (data.mode or insights_mode) == "bundle":
+        insights = await utils_insights.generate_insights_bundle(
+            config["search-persona5"]["prompt_insights_bundle_conversations"],
+            prompts,
+            input_text,
+            timeout=insights_timeout,
         )
-        pending_tasks = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_tasks.format(input_text)
-        )
-        next_best_action = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_nbs.format(input_text)
+    else:
+        insights = await utils_insights.generate_insights(
+            prompts, input_text, timeout=insights_timeout
         )
-    except GoogleAPICallError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Error calling Vertex AI PaLM API. " f"{str(e)}",
-        ) from e
-
-    try:
-        entities = utils_cloud_nlp.nlp_analyze_entities(input_text)
-    except GoogleAPICallError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Error calling Google Cloud NL API. " f"{str(e)}",
-        ) from e
 
-    return GenerateConversationsInsightsResponse(
-        summary=summary,
-        entities=entities,
-        insights=insights,
-        pending_tasks=pending_tasks,
-        next_best_action=next_best_action,
-    )
+    return GenerateConversationsInsightsResponse(**insights)
 
 
 @router.post(path="/generate-reviews-insights")
-def generate_insights_reviews(
+async def generate_insights_reviews(
     data: GenerateReviewsInsightsRequest,
 ) -> GenerateReviewsInsightsResponse:
     """
@@ -241,6 +254,9 @@ def generate_insights_reviews(
 
     **next_best_action**: *string*
     - Next best action extracted from the reviews
+
+    **failed_parts**: *list*
+    - Parts that failed or timed out and are returned empty
     """
     prompt_summary = config["search-persona5"]["prompt_summary_reviews"]
     prompt_insights = config["search-persona5"]["prompt_insights_reviews"]
@@ -248,41 +264,34 @@ def generate_insights_reviews(
     prompt_nbs = config["search-persona5"]["prompt_nbs_reviews"]
 
     input_text = json.dumps({"reviews": data.reviews})
-    try:
-        summary = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_summary.format(input_text)
-        )
-        insights = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_insights.format(input_text)
-        )
-        pending_tasks = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_tasks.format(input_text)
-        )
-        next_best_action = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_nbs.format(input_text)
+    if (
+        utils_summarize.estimate_tokens(input_text)
+        > utils_summarize.TOKEN_BUDGET
+    ):
+        # Too many reviews for a single prompt, use the chunk summaries
+        input_text = json.dumps(
+            {
+                "reviews_summaries": await utils_summarize.summarize_chunks(
+                    data.reviews,
+                    config["summary"]["prompt_reviews_map"],
+                    timeout=insights_timeout,
+                )
+            }
         )
-    except GoogleAPICallError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Error calling Vertex AI Gemini API. " f"{str(e)}",
-        ) from e
-
-    try:
-        entities = utils_cloud_nlp.nlp_analyze_entities(input_text)
-    except GoogleAPICallError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Error calling Google Cloud NL API. " f"{str(e)}",
-        ) from e
 
-    return GenerateReviewsInsightsResponse(
-        summary=summary,
-        entities=entities,
-        insights=insights,
-        pending_tasks=pending_tasks,
-        next_best_action=next_best_action,
+    insights = await utils_insights.generate_insights(
+        {
+            "summary": prompt_summary,
+            "insights": prompt_insights,
+            "pending_tasks": prompt_tasks,
+            "next_best_action": prompt_nbs,
+        },
+        input_text,
+        timeout=insights_timeout,
     )
 
+    return GenerateReviewsInsightsResponse(**insights)
+
 
 @router.post(path="/search-conversations")
 def search_conversations(
@@ -654,21 +663,21 @@ def vector_find_similar(
     nearest_neighbors = similar_vectors.get("nearest_neighbors", "")
     neighbors = nearest_neighbors[0].get("neighbors")
 
-    results = []
-
     firebase_collection = ""
     if data.user_journey == "conversations":
-        firebase_collection = "p5-conversations"
+        firebase_collection = config["search-persona5"][
+            "firestore_conversations"
+        ]
     else:
-        firebase_collection = "p5-reviews"
-
-    for i in neighbors:
-        document = (
-            db.collection(firebase_collection)
-            .document(i["datapoint"]["datapoint_id"])
-            .get()
-            .to_dict()
-        )
-        results.append(document)
+        firebase_collection = config["search-persona5"]["firestore_reviews"]
+
+    # One batched read, in the neighbors order
+    results = utils_firestore.get_documents(
+        client=db.get(),
+        collection=firebase_collection,
+        document_ids=[i["datapoint"]["datapoint_id"] for i in neighbors],
+        field_paths=similar_documents_fields.get(data.user_journey),
+        cache=documents_cache,
+    )
 
     return VectorFindNeighborResponse(similar_vectors=results)
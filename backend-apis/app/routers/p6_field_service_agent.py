@@ -44,19 +44,25 @@ from app.models.p6_model import (
     SearchManualsResponse,
 )
 from app.utils import (
-    utils_cloud_nlp,
     utils_gemini,
     utils_imagen,
     utils_gemini,
+    utils_insights,
     utils_search,
     utils_workspace,
 )
+from app.utils.utils_lazy import lazy
 
 # Load configuration file
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
 
-firestore_client = firestore.Client()
+firestore_client = lazy(firestore.Client)
+
+insights_timeout = config["search-persona5"].get(
+    "insights_timeout_seconds", 60
+)
+insights_mode = config["search-persona5"].get("insights_mode", "parts")
 
 router = APIRouter(prefix="/p6", tags=["P6 - Field Service Agent"])
 
@@ -311,7 +317,7 @@ def generate_agent_activity(data: GenerateAgentActivityRequest) -> str:
 
 
 @router.post(path="/generate-conversations-insights")
-def generate_insights_conversations(
+async def generate_insights_conversations(
     data: GenerateConversationsInsightsRequest,
 ) -> GenerateConversationsInsightsResponse:
     """
@@ -340,6 +346,9 @@ def generate_insights_conversations(
 
     **next_best_action**: *string*
     - Next best action extracted from the conversations
+
+    **failed_parts**: *list*
+    - Parts that failed or timed out and are returned empty
     """
     if len(data.conversations) > 1:
         prompt_summary = config["search-persona5"][
@@ -367,41 +376,26 @@ def generate_insights_conversations(
         prompt_nbs = config["search-persona5"]["prompt_nbs_conversation"]
 
     input_text = json.dumps({"conversations": data.conversations})
-
-    try:
-        summary = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_summary.format(input_text)
+    prompts = {
+        "summary": prompt_summary,
+        "insights": prompt_insights,
+        "pending_tasks": prompt_tasks,
+        "next_best_action": prompt_nbs,
+    }
+
+    if (data.mode or insights_mode) == "bundle":
+        insights = await utils_insights.generate_insights_bundle(
+            config["search-persona5"]["prompt_insights_bundle_conversations"],
+            prompts,
+            input_text,
+            timeout=insights_timeout,
         )
-        insights = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_insights.format(input_text)
-        )
-        pending_tasks = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_tasks.format(input_text)
-        )
-        next_best_action = utils_gemini.generate_gemini_pro_text(
-            prompt=prompt_nbs.format(input_text)
+    else:
+        insights = await utils_insights.generate_insights(
+            prompts, input_text, timeout=insights_timeout
         )
-    except GoogleAPICallError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Error calling Vertex AI PaLM API. " f"{str(e)}",
-        ) from e
 
-    try:
-        entities = utils_cloud_nlp.nlp_analyze_entities(input_text)
-    except GoogleAPICallError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Error calling Google Cloud NL API. " f"{str(e)}",
-        ) from e
-
-    return GenerateConversationsInsightsResponse(
-        summary=summary,
-        entities=entities,
-        insights=insights,
-        pending_tasks=pending_tasks,
-        next_best_action=next_best_action,
-    )
+    return GenerateConversationsInsightsResponse(**insights)
 
 
 @router.post(path="/search-manuals")
@@ -42,6 +42,7 @@ from app.utils import (
     utils_palm,
     utils_vertex_vector,
 )
+from app.utils.utils_lazy import lazy
 
 # Load configuration file
 with open("app/config.toml", "rb") as f:
@@ -49,11 +50,13 @@ with open("app/config.toml", "rb") as f:
 # Global configurations
 project_id = config["global"]["project_id"]
 images_bucket_name = config["global"]["images_bucket_name"]
-embeddings_client = utils_palm.EmbeddingPredictionClient(project=project_id)
+embeddings_client = lazy(
+    lambda: utils_palm.EmbeddingPredictionClient(project=project_id)
+)
 
-storage_client = storage.Client()
+storage_client = lazy(storage.Client)
 
-firestore_client = firestore.Client()
+firestore_client = lazy(firestore.Client)
 
 router = APIRouter(prefix="/p7", tags=["P7 - Return Agent"])
 
@@ -267,22 +270,12 @@ def search_similar(data: SearchSimilarRequest) -> SearchSimilarResponse:
             feature_vector=reduced_vector,
         )
 
-        num_responses = len(neighbors.nearest_neighbors[0].neighbors)
-        results = []
-        for i, n in enumerate(neighbors.nearest_neighbors[0].neighbors):
-            product = utils_cloud_sql.get_product(
-                int(n.datapoint.datapoint_id)
-            )
-            snapshot = {}
-
-            if product:
-                snapshot = utils_cloud_sql.convert_product_to_dict(product)
-            results.append(
-                {"id": n.datapoint.datapoint_id, "snapshot": snapshot}
-            )
-
-            if i == 9 or (num_responses < 10 and i == num_responses - 1):
-                break
+        hydrated = utils_cloud_sql.hydrate_neighbors(
+            neighbors.nearest_neighbors[0].neighbors
+        )
+        if hydrated.missing_ids:
+            print(f"Products not found: {hydrated.missing_ids}")
+        results = hydrated.results
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
@@ -0,0 +1,136 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the in-process and persistent caches.
+"""
+
+import os
+import tempfile
+import unittest
+
+from .utils_cache import DiskCacheTier, ResponseCache, TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    """
+    Test the TTL + LRU cache.
+    """
+
+    def test_hit_and_miss(self):
+        """
+        Test that stored values are returned and counted as hits.
+        """
+        cache = TTLCache(max_size=2, ttl_seconds=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, "product_1")
+        self.assertEqual(cache.get(1), "product_1")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used entry is evicted first.
+        """
+        cache = TTLCache(max_size=2, ttl_seconds=60)
+        cache.set(1, "product_1")
+        cache.set(2, "product_2")
+        cache.get(1)
+        cache.set(3, "product_3")
+        self.assertEqual(cache.get(1), "product_1")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl_expiration(self):
+        """
+        Test that expired entries are not returned.
+        """
+        cache = TTLCache(max_size=2, ttl_seconds=-1)
+        cache.set(1, "product_1")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_invalidate(self):
+        """
+        Test that invalidated entries are removed from the cache.
+        """
+        cache = TTLCache(max_size=2, ttl_seconds=60)
+        cache.set(1, "product_1")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_entry_ttl(self):
+        """
+        Test that a TTL given to set overrides the cache TTL.
+        """
+        cache = TTLCache(max_size=2, ttl_seconds=60)
+        cache.set(1, "product_1", ttl_seconds=-1)
+        self.assertIsNone(cache.get(1))
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    Test the two-tier response cache.
+    """
+
+    def test_key_depends_on_model_params_and_prompt(self):
+        """
+        Test that any change to the request changes the key.
+        """
+        key = ResponseCache.make_key("model", {"temperature": 0.2}, "prompt")
+        self.assertEqual(
+            key,
+            ResponseCache.make_key("model", {"temperature": 0.2}, "prompt"),
+        )
+        self.assertNotEqual(
+            key, ResponseCache.make_key("other", {"temperature": 0.2}, "prompt")
+        )
+        self.assertNotEqual(
+            key, ResponseCache.make_key("model", {"temperature": 0.4}, "prompt")
+        )
+        self.assertNotEqual(
+            key, ResponseCache.make_key("model", {"temperature": 0.2}, "other")
+        )
+
+    def test_hit_ratio(self):
+        """
+        Test that hits and misses are counted.
+        """
+        cache = ResponseCache(memory=TTLCache())
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", "response")
+        self.assertEqual(cache.get("key"), "response")
+        self.assertEqual(cache.stats()["hit_ratio"], 0.5)
+
+    def test_disabled(self):
+        """
+        Test that a disabled cache never returns values.
+        """
+        cache = ResponseCache(memory=TTLCache(), enabled=False)
+        cache.set("key", "response")
+        self.assertIsNone(cache.get("key"))
+
+    def test_persistent_tier(self):
+        """
+        Test that persistent hits are served after the memory tier is lost.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            persistent = DiskCacheTier(os.path.join(cache_dir, "cache"))
+            cache = ResponseCache(memory=TTLCache(), persistent=persistent)
+            cache.set("key", "response", ttl_seconds=60)
+            cache.memory.clear()
+            self.assertEqual(cache.get("key"), "response")
+            self.assertEqual(cache.stats()["persistent_hits"], 1)
+            self.assertEqual(cache.memory.get("key"), "response")
+            persistent.close()
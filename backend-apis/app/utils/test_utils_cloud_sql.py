@@ -15,9 +15,30 @@
 Test the conversion of a Product object to a dictionary.
 """
 
+import json
+import os
+import tempfile
+import threading
 import unittest
+from types import SimpleNamespace
 
-from .utils_cloud_sql import Product, convert_product_to_dict
+import sqlalchemy
+
+from .utils_cloud_sql import (
+    InstrumentedQueuePool,
+    Product,
+    ProductIdIndex,
+    ProductRepository,
+    ProductSnapshot,
+    SqliteProductRepository,
+    clear_product_cache,
+    convert_product_to_dict,
+    get_product,
+    get_random_products,
+    hydrate_neighbors,
+    product_cache,
+    set_repository,
+)
 
 
 class TestProductConversion(unittest.TestCase):
@@ -82,3 +103,254 @@ class TestProductConversion(unittest.TestCase):
                 "quantity": 1,
             },
         )
+
+    def test_snapshot_parses_columns_once(self):
+        """
+        Test that a snapshot exposes the parsed columns and serializes
+        to the same dict as the Product.
+        """
+        product = Product(
+            id=1,
+            title="",
+            description="",
+            image="",
+            features="['feature1']",
+            categories="['category1','category2']",
+            price=10.0,
+            quantity=1,
+        )
+        snapshot = ProductSnapshot.from_product(product)
+        self.assertEqual(snapshot.categories, ("category1", "category2"))
+        self.assertEqual(snapshot.to_dict(), convert_product_to_dict(product))
+
+
+class TestHydrateNeighbors(unittest.TestCase):
+    """
+    Test the hydration of Vector Search neighbors into products.
+    """
+
+    def tearDown(self):
+        clear_product_cache()
+
+    def test_rank_order_and_missing_ids(self):
+        """
+        Test that products keep the neighbors order and missing ids are
+        reported.
+        """
+        for product_id in (1, 2):
+            product_cache.set(
+                product_id,
+                ProductSnapshot.from_product(
+                    Product(
+                        id=product_id,
+                        title=f"title {product_id}",
+                        description="",
+                        image="",
+                        features="",
+                        categories="",
+                        price=10.0,
+                        quantity=1,
+                    )
+                ),
+            )
+        neighbors = [
+            SimpleNamespace(
+                datapoint=SimpleNamespace(datapoint_id=datapoint_id),
+                distance=distance,
+            )
+            for datapoint_id, distance in (("2", 0.9), ("1", 0.8))
+        ]
+        hydrated = hydrate_neighbors(neighbors)
+        self.assertEqual([r["id"] for r in hydrated.results], ["2", "1"])
+        self.assertEqual(hydrated.results[0]["distance"], 0.9)
+        self.assertEqual(hydrated.results[1]["snapshot"]["title"], "title 1")
+        self.assertEqual(hydrated.missing_ids, [])
+
+
+class TestProductIdIndex(unittest.TestCase):
+    """
+    Test the random sampling of product ids.
+    """
+
+    rows = [
+        (1, "['Bed']"),
+        (2, "['Bed']"),
+        (3, "['Bed']"),
+        (4, "['Sofa']"),
+        (5, "['Chair']"),
+    ]
+
+    def test_sample_without_replacement(self):
+        """
+        Test that sampled ids are unique and limited to the catalog size.
+        """
+        index = ProductIdIndex(loader=lambda: self.rows)
+        sample = index.sample(size=10)
+        self.assertEqual(sorted(sample), [1, 2, 3, 4, 5])
+
+    def test_seeded_sample(self):
+        """
+        Test that the same seed returns the same ids.
+        """
+        index = ProductIdIndex(loader=lambda: self.rows)
+        self.assertEqual(
+            index.sample(size=3, seed=42), index.sample(size=3, seed=42)
+        )
+
+    def test_stratified_sample(self):
+        """
+        Test that a stratified sample covers every category first.
+        """
+        index = ProductIdIndex(loader=lambda: self.rows)
+        sample = index.sample(size=3, seed=7, stratify_by_category=True)
+        self.assertIn(4, sample)
+        self.assertIn(5, sample)
+        self.assertEqual(len(set(sample) & {1, 2, 3}), 1)
+
+    def test_single_refresh_of_a_stale_index(self):
+        """
+        Test that one thread reloads a stale index while the others
+        sample the previous ids.
+        """
+        loading = threading.Event()
+        release = threading.Event()
+        loads = []
+
+        def loader():
+            loads.append(1)
+            if len(loads) > 1:
+                loading.set()
+                release.wait(5)
+            return self.rows
+
+        index = ProductIdIndex(loader=loader, refresh_seconds=0)
+        index.sample(size=1)
+        reloading = threading.Thread(target=index.sample, args=(1,))
+        reloading.start()
+        self.assertTrue(loading.wait(5))
+
+        samples = [index.sample(size=1) for _ in range(3)]
+        release.set()
+        reloading.join()
+
+        self.assertEqual(len(loads), 2)
+        self.assertTrue(all(len(sample) == 1 for sample in samples))
+
+
+class TestInstrumentedQueuePool(unittest.TestCase):
+    """
+    Test the connection pool instrumentation.
+    """
+
+    def test_checkout_stats(self):
+        """
+        Test that checkouts are counted and reported with the pool size.
+        """
+        engine = sqlalchemy.create_engine(
+            "sqlite://",
+            poolclass=InstrumentedQueuePool,
+            pool_size=2,
+            max_overflow=0,
+        )
+        with engine.connect():
+            stats = engine.pool.stats()
+            self.assertEqual(stats["checked_out"], 1)
+        stats = engine.pool.stats()
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["pool_size"], 2)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertGreaterEqual(stats["checkout_wait_max_ms"], 0.0)
+        engine.dispose()
+
+
+class TestSqliteProductRepository(unittest.TestCase):
+    """
+    Test the SQLite product repository seeded from the datasets.
+    """
+
+    def setUp(self):
+        self.seed_dir = tempfile.TemporaryDirectory()
+        search_file = os.path.join(self.seed_dir.name, "search.jsonl")
+        with open(search_file, "w", encoding="utf-8") as f:
+            for product_id in ("1", "2"):
+                f.write(
+                    json.dumps(
+                        {
+                            "id": product_id,
+                            "jsonData": json.dumps(
+                                {
+                                    "title": f"title {product_id}",
+                                    "description": "",
+                                    "price": "10.50",
+                                }
+                            ),
+                        }
+                    )
+                    + "\n"
+                )
+        recommendation_file = os.path.join(
+            self.seed_dir.name, "recommendation.jsonl"
+        )
+        with open(recommendation_file, "w", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "id": "1",
+                        "categories": "Bed",
+                        "availableQuantity": 3,
+                        "images": [{"uri": "https://example.com/1.png"}],
+                    }
+                )
+                + "\n"
+            )
+        self.repository = SqliteProductRepository(
+            seed_files=[search_file, recommendation_file]
+        )
+        set_repository(self.repository)
+
+    def tearDown(self):
+        set_repository(None)
+        self.seed_dir.cleanup()
+
+    def test_seeded_products(self):
+        """
+        Test that both datasets are merged into the products table.
+        """
+        product = self.repository.get_product(1)
+        self.assertEqual(product.title, "title 1")
+        self.assertEqual(product.price, 10.5)
+        self.assertEqual(product.categories, ("Bed",))
+        self.assertEqual(product.image, "https://example.com/1.png")
+        self.assertEqual(product.quantity, 3)
+        self.assertEqual(
+            sorted(p.id for p in self.repository.get_products([1, 2, 3])),
+            [1, 2],
+        )
+
+    def test_module_functions_use_repository(self):
+        """
+        Test that the module level helpers read from the repository.
+        """
+        self.assertEqual(get_product(2).title, "title 2")
+        self.assertIsNone(get_product(3))
+        self.assertEqual(
+            sorted(p["id"] for p in get_random_products(size=5)), [1, 2]
+        )
+
+    def test_incomplete_repository_cannot_be_created(self):
+        """
+        Test that a repository missing a method fails when instantiated.
+        """
+
+        class IncompleteRepository(ProductRepository):
+            """Repository without get_id_index_rows"""
+
+            def get_product(self, product_id):
+                return None
+
+            def get_products(self, id_list):
+                return []
+
+        with self.assertRaises(TypeError):
+            # pylint: disable-next=abstract-class-instantiated
+            IncompleteRepository()
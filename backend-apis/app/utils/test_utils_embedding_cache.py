@@ -0,0 +1,96 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the content-hash embedding cache.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from .utils_embedding_cache import (
+    EmbeddingCache,
+    MemmapVectorStore,
+    embedding_key,
+)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    """
+    Test the keys and the memory and disk tiers.
+    """
+
+    def test_keys(self):
+        """
+        Test that keys depend on the normalized content and the model.
+        """
+        self.assertEqual(
+            embedding_key("m", text="red  sofa\n"),
+            embedding_key("m", text="red sofa"),
+        )
+        self.assertNotEqual(
+            embedding_key("m", text="red sofa"),
+            embedding_key("other", text="red sofa"),
+        )
+        self.assertNotEqual(
+            embedding_key("m", text="img"),
+            embedding_key("m", image_bytes=b"img"),
+        )
+
+    def test_vectors_are_float32(self):
+        """
+        Test that embeddings are stored as read-only float32 vectors.
+        """
+        cache = EmbeddingCache("m", max_entries=10)
+        key = cache.key(text="sofa")
+        cache.set(key, [0.5, 0.25])
+
+        vector = cache.get(key)
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertFalse(vector.flags.writeable)
+        self.assertEqual(vector.tolist(), [0.5, 0.25])
+
+    def test_disk_tier_survives_restarts(self):
+        """
+        Test that the memory-mapped tier is reused by a new cache.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "embeddings")
+            store = MemmapVectorStore(path, dim=2, capacity=4)
+            EmbeddingCache("m", disk_tier=store).set("k", [1.0, 2.0])
+            store.close()
+
+            store = MemmapVectorStore(path, dim=2, capacity=4)
+            cache = EmbeddingCache("m", disk_tier=store)
+            self.assertEqual(cache.get("k").tolist(), [1.0, 2.0])
+            self.assertEqual(cache.stats()["disk_hits"], 1)
+            store.close()
+
+    def test_disk_tier_overwrites_oldest(self):
+        """
+        Test that a full disk tier overwrites its oldest vector.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            store = MemmapVectorStore(
+                os.path.join(directory, "embeddings"), dim=1, capacity=2
+            )
+            for i in range(3):
+                store.set(f"k{i}", np.array([i], dtype=np.float32))
+
+            self.assertIsNone(store.get("k0"))
+            self.assertEqual(store.get("k1").tolist(), [1.0])
+            self.assertEqual(store.get("k2").tolist(), [2.0])
+            store.close()
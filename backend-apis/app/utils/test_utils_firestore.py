@@ -0,0 +1,84 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the batched Firestore reads.
+"""
+
+import unittest
+from types import SimpleNamespace
+
+from .utils_cache import TTLCache
+from .utils_firestore import get_documents
+
+
+class FakeFirestoreClient:
+    """Firestore client returning the snapshots in reverse order"""
+
+    def __init__(self, documents: dict):
+        self.documents = documents
+        self.calls = []
+
+    def collection(self, name: str):
+        return SimpleNamespace(
+            document=lambda document_id: SimpleNamespace(
+                collection=name, id=document_id
+            )
+        )
+
+    def get_all(self, references: list, field_paths=None):
+        self.calls.append(([r.id for r in references], field_paths))
+        return [
+            SimpleNamespace(
+                id=r.id,
+                exists=r.id in self.documents,
+                to_dict=lambda i=r.id: self.documents.get(i),
+            )
+            for r in reversed(references)
+        ]
+
+
+class TestGetDocuments(unittest.TestCase):
+    """
+    Test that documents are read in one call, in order, and cached.
+    """
+
+    def test_order_and_missing_documents(self):
+        """
+        Test that documents keep the order of the ids.
+        """
+        client = FakeFirestoreClient(
+            {"a": {"title": "A"}, "b": {"title": "B"}}
+        )
+        documents = get_documents(
+            client, "p5-reviews", ["b", "x", "a"], field_paths=["title"]
+        )
+
+        self.assertEqual(documents, [{"title": "B"}, None, {"title": "A"}])
+        self.assertEqual(client.calls, [(["b", "x", "a"], ["title"])])
+
+    def test_cached_documents_are_not_read(self):
+        """
+        Test that only the documents missing from the cache are read.
+        """
+        client = FakeFirestoreClient(
+            {"a": {"title": "A"}, "b": {"title": "B"}}
+        )
+        cache = TTLCache()
+        get_documents(client, "p5-reviews", ["a"], cache=cache)
+        documents = get_documents(
+            client, "p5-reviews", ["a", "b"], cache=cache
+        )
+
+        self.assertEqual(documents, [{"title": "A"}, {"title": "B"}])
+        self.assertEqual(client.calls[-1][0], ["b"])
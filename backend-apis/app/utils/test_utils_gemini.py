@@ -0,0 +1,125 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the async Gemini text helpers.
+"""
+
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from . import utils_gemini
+from .utils_cache import ResponseCache, TTLCache
+from .utils_llm_executor import LlmExecutor
+
+
+class FakeModel:
+    """Gemini model recording the generate_content calls"""
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_content(
+        self, contents, generation_config=None, stream=False
+    ):
+        self.calls.append(generation_config)
+        if stream:
+            return iter(
+                [SimpleNamespace(text=word) for word in contents[0].split()]
+            )
+        return SimpleNamespace(text=f"response {len(self.calls)}")
+
+
+class TestAsyncPredictTextLlm(unittest.TestCase):
+    """
+    Test the generation parameters and the caching of the async calls.
+    """
+
+    def setUp(self):
+        self.model = FakeModel()
+        self.cache = ResponseCache(memory=TTLCache())
+        for name, value in (
+            ("gemini_pro_text", self.model),
+            ("llm_response_cache", self.cache),
+        ):
+            patcher = mock.patch.object(utils_gemini, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_model_defaults_without_parameters(self):
+        """
+        Test that no generation config is sent when none is given.
+        """
+        asyncio.run(utils_gemini.async_predict_text_llm(prompt="a"))
+        asyncio.run(
+            utils_gemini.async_predict_text_llm(
+                prompt="b", max_output_tokens=2048
+            )
+        )
+        self.assertEqual(self.model.calls, [None, {"max_output_tokens": 2048}])
+
+    def test_cache_is_opt_in(self):
+        """
+        Test that only the calls made with use_cache are cached.
+        """
+        first = asyncio.run(utils_gemini.async_predict_text_llm(prompt="a"))
+        second = asyncio.run(utils_gemini.async_predict_text_llm(prompt="a"))
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.cache.stats()["memory"]["size"], 0)
+
+        cached = [
+            asyncio.run(
+                utils_gemini.async_predict_text_llm(
+                    prompt="b", use_cache=True
+                )
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual(cached[0], cached[1])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+
+class TestStreamGeminiProText(unittest.TestCase):
+    """
+    Test that streams go through the model limiter.
+    """
+
+    def setUp(self):
+        self.executor = LlmExecutor(max_workers=2)
+        for name, value in (
+            ("gemini_pro_text", FakeModel()),
+            ("llm_executor", self.executor),
+        ):
+            patcher = mock.patch.object(utils_gemini, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_slot_is_held_while_streaming(self):
+        """
+        Test that the model slot is held until the stream is closed.
+        """
+        chunks = utils_gemini.stream_gemini_pro_text("a b c")
+        self.assertEqual(next(chunks), "a")
+        stats = self.executor.stats()["models"]
+        self.assertEqual(
+            stats[utils_gemini.GEMINI_PRO_TEXT_MODEL]["in_flight"], 1
+        )
+
+        # Client disconnected
+        chunks.close()
+        stats = self.executor.stats()["models"]
+        self.assertEqual(
+            stats[utils_gemini.GEMINI_PRO_TEXT_MODEL]["in_flight"], 0
+        )
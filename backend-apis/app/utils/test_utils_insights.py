@@ -0,0 +1,80 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the concurrent generation of the insights parts.
+"""
+
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from . import utils_cloud_nlp, utils_gemini, utils_insights
+
+
+class BlockedResponse:
+    """Gemini response without candidates, e.g. blocked by safety filters"""
+
+    @property
+    def text(self):
+        raise ValueError("Response has no candidates")
+
+
+class FakeModel:
+    """Gemini model failing the prompts of some parts"""
+
+    def generate_content(self, contents, generation_config=None):
+        del generation_config
+        if contents.startswith("insights"):
+            return BlockedResponse()
+        if contents.startswith("pending_tasks"):
+            raise RuntimeError("executor shut down")
+        return SimpleNamespace(text=f"{contents.split(':')[0]} text")
+
+
+class TestGenerateInsights(unittest.TestCase):
+    """
+    Test that failing parts are reported instead of failing the request.
+    """
+
+    def setUp(self):
+        for target, name, value in (
+            (utils_gemini, "gemini_pro_text", FakeModel()),
+            (
+                utils_cloud_nlp,
+                "async_nlp_analyze_entities",
+                mock.AsyncMock(return_value=[{"name": "entity"}]),
+            ),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_failed_parts_are_partial_results(self):
+        """
+        Test that non Google API errors only fail their own part.
+        """
+        prompts = {
+            name: name + ": {}" for name in utils_insights.INSIGHTS_PARTS
+        }
+        result = asyncio.run(
+            utils_insights.generate_insights(prompts, "conversations")
+        )
+
+        self.assertEqual(result["summary"], "summary text")
+        self.assertEqual(result["next_best_action"], "next_best_action text")
+        self.assertEqual(result["insights"], "")
+        self.assertEqual(result["pending_tasks"], "")
+        self.assertEqual(result["failed_parts"], ["insights", "pending_tasks"])
+        self.assertEqual(result["entities"], [{"name": "entity"}])
@@ -0,0 +1,87 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the lazy client initialization.
+"""
+
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from .utils_lazy import lazy
+
+
+class TestLazyClient(unittest.TestCase):
+    """
+    Test that clients are created once, on first use.
+    """
+
+    def test_created_on_first_use(self):
+        """
+        Test that the factory runs on first attribute access only.
+        """
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return SimpleNamespace(collection=lambda name: f"ref:{name}")
+
+        client = lazy(factory)
+        self.assertFalse(client.initialized)
+        self.assertEqual(calls, [])
+
+        self.assertEqual(client.collection("products"), "ref:products")
+        self.assertEqual(client.collection("reviews"), "ref:reviews")
+        self.assertTrue(client.initialized)
+        self.assertEqual(calls, [1])
+
+    def test_created_once_across_threads(self):
+        """
+        Test that concurrent first uses create a single client.
+        """
+        calls = []
+
+        def factory():
+            calls.append(1)
+            time.sleep(0.05)
+            return SimpleNamespace(name="client")
+
+        client = lazy(factory)
+        threads = [
+            threading.Thread(target=lambda: client.name) for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+
+    def test_failed_creation_is_retried(self):
+        """
+        Test that a failed creation is retried on next use.
+        """
+        attempts = []
+
+        def factory():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionError("metadata server unavailable")
+            return SimpleNamespace(name="client")
+
+        client = lazy(factory)
+        with self.assertRaises(ConnectionError):
+            client.get()
+        self.assertEqual(client.name, "client")
@@ -0,0 +1,174 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the shared LLM executor.
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+
+from .utils_llm_executor import LlmExecutor, TokenBucket
+
+
+class TestLlmExecutor(unittest.TestCase):
+    """
+    Test the per model concurrency limits and metrics.
+    """
+
+    def test_max_concurrency(self):
+        """
+        Test that a model never has more calls in flight than its limit.
+        """
+        executor = LlmExecutor(
+            max_workers=8, models={"model": {"max_concurrency": 2}}
+        )
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def call():
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.pop()
+            return "ok"
+
+        async def run():
+            return await asyncio.gather(
+                *(executor.run("model", call) for _ in range(6))
+            )
+
+        self.assertEqual(asyncio.run(run()), ["ok"] * 6)
+        self.assertEqual(max(peak), 2)
+
+        stats = executor.stats()["models"]["model"]
+        self.assertEqual(stats["calls"], 6)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertGreater(stats["wait_max_ms"], 0)
+
+    def test_limits_are_shared_by_event_loops(self):
+        """
+        Test that the limits apply across event loops in several threads.
+        """
+        executor = LlmExecutor(
+            max_workers=8, models={"model": {"max_concurrency": 1}}
+        )
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def call():
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.02)
+            with lock:
+                in_flight.pop()
+
+        async def run():
+            await asyncio.gather(
+                *(executor.run("model", call) for _ in range(3))
+            )
+
+        threads = [
+            threading.Thread(target=asyncio.run, args=(run(),))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(peak), 9)
+        self.assertEqual(max(peak), 1)
+
+    def test_hold_shares_the_limits_with_run(self):
+        """
+        Test that a slot held by a thread counts against the model limit.
+        """
+        executor = LlmExecutor(
+            max_workers=8, models={"model": {"max_concurrency": 1}}
+        )
+        order = []
+        held = threading.Event()
+
+        def stream():
+            with executor.hold("model"):
+                held.set()
+                time.sleep(0.05)
+                order.append("stream")
+
+        thread = threading.Thread(target=stream)
+        thread.start()
+        held.wait()
+        self.assertEqual(
+            executor.stats()["models"]["model"]["in_flight"], 1
+        )
+        asyncio.run(executor.run("model", lambda: order.append("call")))
+        thread.join()
+
+        self.assertEqual(order, ["stream", "call"])
+        stats = executor.stats()["models"]["model"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_errors_are_counted(self):
+        """
+        Test that exceptions are raised to the caller and counted.
+        """
+        executor = LlmExecutor(max_workers=1)
+
+        def call():
+            raise ValueError("quota")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(executor.run("model", call))
+        self.assertEqual(executor.stats()["models"]["model"]["errors"], 1)
+
+    def test_default_limits(self):
+        """
+        Test that models without limits use the default entry.
+        """
+        executor = LlmExecutor(
+            max_workers=8, models={"default": {"max_concurrency": 3}}
+        )
+        self.assertEqual(executor.limiter("other").max_concurrency, 3)
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Test the token bucket rate limiter.
+    """
+
+    def test_burst_then_wait(self):
+        """
+        Test that tokens are available up to the burst, then rate limited.
+        """
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+    def test_disabled(self):
+        """
+        Test that a rate of 0 never limits.
+        """
+        bucket = TokenBucket(rate=0)
+        for _ in range(100):
+            self.assertEqual(bucket.try_acquire(), 0)
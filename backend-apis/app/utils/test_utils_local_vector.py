@@ -0,0 +1,108 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the in-process nearest neighbor index.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from .utils_local_vector import LocalVectorIndex, load_local_index
+
+
+def _datapoints(count: int, dim: int) -> tuple[list[str], np.ndarray]:
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(count, dim)).astype(np.float32)
+    return [str(i) for i in range(count)], vectors
+
+
+class TestLocalVectorIndex(unittest.TestCase):
+    """
+    Test the exact and IVF searches and the response shape.
+    """
+
+    def test_exact_search(self):
+        """
+        Test that the exact search returns the highest dot products.
+        """
+        ids, vectors = _datapoints(50, 8)
+        queries = vectors[:3]
+        neighbor_ids, distances = LocalVectorIndex(ids, vectors).search(
+            queries, 5
+        )
+
+        for query, found, found_distances in zip(
+            queries, neighbor_ids, distances
+        ):
+            expected = np.argsort(-(vectors @ query))[:5]
+            self.assertEqual(found, [ids[i] for i in expected])
+            np.testing.assert_allclose(
+                found_distances, (vectors @ query)[expected], rtol=1e-5
+            )
+
+    def test_ivf_search_probing_every_list(self):
+        """
+        Test that the IVF search is exact when every list is scanned.
+        """
+        ids, vectors = _datapoints(50, 8)
+        exact = LocalVectorIndex(ids, vectors)
+        ivf = LocalVectorIndex(ids, vectors, ivf_n_lists=4, ivf_n_probe=4)
+
+        self.assertEqual(
+            ivf.search(vectors[:3], 5)[0], exact.search(vectors[:3], 5)[0]
+        )
+
+    def test_find_neighbors_response(self):
+        """
+        Test that results have the shape of the Vector Search response.
+        """
+        ids, vectors = _datapoints(10, 4)
+        response = LocalVectorIndex(ids, vectors).find_neighbors(
+            feature_vector=vectors[7].tolist(), neighbor_count=2
+        )
+
+        self.assertEqual(len(response.nearest_neighbors), 1)
+        neighbors = response.nearest_neighbors[0].neighbors
+        self.assertEqual(len(neighbors), 2)
+        self.assertEqual(neighbors[0].datapoint.datapoint_id, "7")
+
+    def test_load_memmap(self):
+        """
+        Test that vector_metadata.json is loaded into memory-mapped vectors.
+        """
+        ids, vectors = _datapoints(10, 4)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "vector_metadata.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "datapoints": [
+                            {"datapoint_id": i, "feature_vector": v.tolist()}
+                            for i, v in zip(ids, vectors)
+                        ]
+                    },
+                    f,
+                )
+            cfg = {"memmap_dir": os.path.join(directory, "memmap")}
+
+            load_local_index(path, cfg)
+            index = load_local_index(path, cfg)
+
+            self.assertIsInstance(index.vectors, np.memmap)
+            self.assertEqual(index.ids, ids)
+            np.testing.assert_array_equal(index.vectors, vectors)
@@ -0,0 +1,66 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the registry of the in-process metrics.
+"""
+
+import unittest
+
+# pylint: disable-next=unused-import
+from . import (
+    utils_cache,
+    utils_cloud_sql,
+    utils_llm_executor,
+    utils_singleflight,
+    utils_vector_cache,
+)
+from .utils_metrics import get_metrics, register_metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Test that the registered sources are read on request.
+    """
+
+    def test_registered_sources(self):
+        """
+        Test that sources are called and failing ones report an error.
+        """
+        register_metrics("test_counter", lambda: {"value": 1})
+
+        def failing():
+            raise RuntimeError("down")
+
+        register_metrics("test_failing", failing)
+        metrics = get_metrics()
+        self.assertEqual(metrics["test_counter"], {"value": 1})
+        self.assertEqual(metrics["test_failing"], {"error": "down"})
+
+    def test_cloud_sql_metrics_are_registered(self):
+        """
+        Test that the pool and product cache counters are exported.
+        """
+        metrics = get_metrics()
+        self.assertIn("cloud_sql_pool", metrics)
+        self.assertIn("size", metrics["product_cache"])
+
+    def test_model_call_metrics_are_registered(self):
+        """
+        Test that the executor, cache and coalescing counters are exported.
+        """
+        metrics = get_metrics()
+        self.assertIn("models", metrics["llm_executor"])
+        self.assertIn("hit_ratio", metrics["llm_cache"])
+        self.assertIsInstance(metrics["singleflight"], dict)
+        self.assertIn("vector_search_cache", metrics)
@@ -0,0 +1,195 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the batched multimodal embeddings.
+"""
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from google.api_core.exceptions import InvalidArgument
+from google.cloud.aiplatform_v1.types import PredictResponse
+
+from . import utils_palm
+from .utils_embedding_cache import EmbeddingCache
+from .utils_palm import EmbeddingInput, EmbeddingPredictionClient
+
+
+class FakePredictionClient:
+    """Prediction client embedding the length of each text and image"""
+
+    def __init__(self, max_instances: int):
+        self.max_instances = max_instances
+        self.max_predictions = max_instances
+        self.requests = []
+
+    def predict(self, endpoint: str, instances: list):
+        del endpoint
+        self.requests.append(len(instances))
+        if len(instances) > self.max_instances:
+            raise InvalidArgument("Too many instances")
+        response = PredictResponse.pb()()
+        for instance in instances[: self.max_predictions]:
+            fields = instance.struct_value.fields
+            prediction = response.predictions.add()
+            if "text" in fields:
+                size = len(fields["text"].string_value)
+                prediction.struct_value.update({"textEmbedding": [size]})
+            if "image" in fields:
+                image = fields["image"].struct_value.fields
+                size = len(image["bytesBase64Encoded"].string_value)
+                prediction.struct_value.update({"imageEmbedding": [size]})
+        return SimpleNamespace(_pb=response)
+
+
+class TestGetEmbeddings(unittest.TestCase):
+    """
+    Test that batches are packed, split and returned in order.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(
+            utils_palm,
+            "multimodal_embedding_cache",
+            EmbeddingCache("multimodalembedding@001"),
+        )
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _client(self, max_instances: int) -> EmbeddingPredictionClient:
+        client = EmbeddingPredictionClient.__new__(EmbeddingPredictionClient)
+        client.project = "project"
+        client.location = "us-central1"
+        client.client = FakePredictionClient(max_instances)
+        return client
+
+    def test_batch_is_packed_and_ordered(self):
+        """
+        Test that inputs are packed per request and returned in order.
+        """
+        client = self._client(max_instances=4)
+        batch = [EmbeddingInput(text="a" * size) for size in (1, 2, 3, 4, 5)]
+        with mock.patch.object(
+            utils_palm, "EMBEDDING_MAX_INSTANCES_PER_REQUEST", 4
+        ):
+            embeddings = client.get_embeddings(batch)
+
+        self.assertEqual(
+            [e.text_embedding.tolist() for e in embeddings],
+            [[1.0], [2.0], [3.0], [4.0], [5.0]],
+        )
+        self.assertEqual(sorted(client.client.requests), [1, 4])
+
+    def test_identical_inputs_are_embedded_once(self):
+        """
+        Test that duplicated inputs are sent once.
+        """
+        client = self._client(max_instances=1)
+        batch = [
+            EmbeddingInput(image_bytes=b"img"),
+            EmbeddingInput(text="question"),
+            EmbeddingInput(image_bytes=b"img"),
+        ]
+        embeddings = client.get_embeddings(batch)
+
+        self.assertEqual(len(client.client.requests), 2)
+        self.assertIs(
+            embeddings[0].image_embedding, embeddings[2].image_embedding
+        )
+        self.assertEqual(embeddings[1].text_embedding.tolist(), [8.0])
+        self.assertEqual(embeddings[1].image_embedding.tolist(), [])
+
+    def test_rejected_request_is_split(self):
+        """
+        Test that a request above the model limit is sent one by one.
+        """
+        client = self._client(max_instances=1)
+        batch = [EmbeddingInput(text="a"), EmbeddingInput(text="bb")]
+        with mock.patch.object(
+            utils_palm, "EMBEDDING_MAX_INSTANCES_PER_REQUEST", 2
+        ):
+            embeddings = client.get_embeddings(batch)
+
+        self.assertEqual(
+            [e.text_embedding.tolist() for e in embeddings], [[1.0], [2.0]]
+        )
+        self.assertEqual(client.client.requests, [2, 1, 1])
+
+    def test_missing_predictions_are_an_error(self):
+        """
+        Test that a response with fewer predictions than instances fails.
+        """
+        client = self._client(max_instances=2)
+        client.client.max_predictions = 1
+        batch = [EmbeddingInput(text="a"), EmbeddingInput(text="bb")]
+        with mock.patch.object(
+            utils_palm, "EMBEDDING_MAX_INSTANCES_PER_REQUEST", 2
+        ), self.assertRaisesRegex(ValueError, "2 instances returned 1"):
+            client.get_embeddings(batch)
+
+    def test_cached_parts_are_not_sent(self):
+        """
+        Test that a cached image is not sent again with a new text.
+        """
+        client = self._client(max_instances=1)
+        client.get_embeddings([EmbeddingInput(image_bytes=b"img")])
+        embeddings = client.get_embeddings(
+            [EmbeddingInput(text="question", image_bytes=b"img")]
+        )
+
+        self.assertEqual(client.client.requests, [1, 1])
+        self.assertEqual(embeddings[0].text_embedding.tolist(), [8.0])
+        self.assertEqual(embeddings[0].image_embedding.tolist(), [4.0])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_embeddings_are_float32(self):
+        """
+        Test that predictions are decoded into float32 vectors.
+        """
+        client = self._client(max_instances=1)
+        embedding = client.get_embedding(text="question")
+
+        self.assertEqual(embedding.text_embedding.dtype, np.float32)
+        self.assertEqual(embedding.image_embedding.size, 0)
+
+
+class TestReduceEmbeddingDimension(unittest.TestCase):
+    """
+    Test the sum-pooling of text and image embeddings.
+    """
+
+    def test_sum_pooling(self):
+        """
+        Test that text and image embeddings are summed as float32.
+        """
+        reduced = utils_palm.reduce_embedding_dimension(
+            vector_text=np.array([1.0, 2.0], dtype=np.float32),
+            vector_image=[0.5, 0.5],
+        )
+
+        self.assertEqual(reduced.dtype, np.float32)
+        self.assertEqual(reduced.tolist(), [1.5, 2.5])
+
+    def test_single_embedding(self):
+        """
+        Test that a missing embedding is ignored.
+        """
+        reduced = utils_palm.reduce_embedding_dimension(
+            vector_text=utils_palm.EMPTY_EMBEDDING,
+            vector_image=np.array([3.0], dtype=np.float32),
+        )
+
+        self.assertEqual(reduced.tolist(), [3.0])
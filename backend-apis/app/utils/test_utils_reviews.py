@@ -0,0 +1,206 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the precomputed reviews summaries.
+"""
+
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from google.cloud import firestore
+
+from . import utils_reviews
+
+
+class FakeReviews:
+    """Reviews subcollection of the fake Firestore"""
+
+    def __init__(self, reviews: list):
+        self.reviews = reviews
+        self.counts = 0
+
+    def get(self):
+        return [
+            SimpleNamespace(
+                to_dict=lambda review=review: dict(review), create_time=index
+            )
+            for index, review in enumerate(self.reviews)
+        ]
+
+    def count(self, alias: str):
+        self.counts += 1
+        value = SimpleNamespace(alias=alias, value=len(self.reviews))
+        return SimpleNamespace(get=lambda: [[value]])
+
+    def document(self):
+        return SimpleNamespace(set=self.reviews.append)
+
+
+def _resolve(data: dict, current: dict) -> dict:
+    """Applies the Firestore transforms of a write"""
+    resolved = {}
+    for key, value in data.items():
+        if isinstance(value, firestore.Increment):
+            value = current.get(key, 0) + value.value
+        elif value is firestore.SERVER_TIMESTAMP:
+            value = datetime.datetime.now()
+        resolved[key] = value
+    return resolved
+
+
+class FakeProductDocument:
+    """Product document of the fake Firestore"""
+
+    def __init__(self, data: dict, reviews: list):
+        self.data = data
+        self.reviews = FakeReviews(reviews)
+
+    def get(self):
+        return SimpleNamespace(to_dict=lambda: dict(self.data) or None)
+
+    def set(self, data: dict, merge: bool = False):
+        data = _resolve(data, self.data)
+        if not merge:
+            self.data.clear()
+        self.data.update(data)
+
+    def collection(self, _name: str):
+        return self.reviews
+
+
+class FakeBatch:
+    """Write batch of the fake Firestore, applied on commit"""
+
+    def __init__(self):
+        self.writes = []
+
+    def set(self, ref, data: dict, merge: bool = False):
+        if merge:
+            self.writes.append(lambda: ref.set(data, merge=True))
+        else:
+            self.writes.append(lambda: ref.set(_resolve(data, {})))
+
+    def commit(self):
+        for write in self.writes:
+            write()
+
+
+class FakeFirestore:
+    """Single product fake Firestore client"""
+
+    def __init__(self, data: dict, reviews: list):
+        self.document = FakeProductDocument(data, reviews)
+
+    def collection(self, _name: str):
+        return SimpleNamespace(document=lambda _id: self.document)
+
+    def batch(self):
+        return FakeBatch()
+
+
+class TestReviewsSummary(unittest.TestCase):
+    """
+    Test that summaries are only regenerated when the review set changes.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(
+            utils_reviews, "summarize_reviews", return_value="Great product"
+        )
+        self.summarize = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_summary_is_reused_while_fingerprint_matches(self):
+        """
+        Test that a stored summary is served without scanning the reviews.
+        """
+        db = FakeFirestore({}, [{"stars": 5}, {"stars": 4}])
+
+        first = utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+        second = utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+
+        self.assertEqual(first, "Great product")
+        self.assertEqual(second, "Great product")
+        self.summarize.assert_called_once_with(
+            {"id": 1}, [{"stars": 5}, {"stars": 4}]
+        )
+
+    def test_fingerprint_is_read_with_the_product(self):
+        """
+        Test that the reviews are only counted when no count is stored.
+        """
+        db = FakeFirestore({}, [{"stars": 5}])
+        for _ in range(3):
+            utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+
+        self.assertEqual(db.document.data["review_count"], 1)
+        self.assertEqual(db.document.reviews.counts, 1)
+
+    def test_summary_is_regenerated_when_reviews_are_added(self):
+        """
+        Test that add_review invalidates the summary.
+        """
+        db = FakeFirestore({}, [{"stars": 5}])
+        utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+
+        utils_reviews.add_review(db, 1, {"stars": 1})
+        utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+
+        self.assertEqual(db.document.data["review_count"], 2)
+        self.assertEqual(self.summarize.call_count, 2)
+
+    def test_add_review_counts_uploaded_reviews(self):
+        """
+        Test that reviews uploaded without a count are counted once.
+        """
+        db = FakeFirestore({}, [{"stars": 5}, {"stars": 4}])
+        utils_reviews.add_review(db, 1, {"stars": 1})
+        utils_reviews.add_review(db, 1, {"stars": 2})
+
+        self.assertEqual(db.document.data["review_count"], 4)
+        self.assertEqual(db.document.reviews.counts, 1)
+        self.assertIn("timestamp", db.document.reviews.reviews[-1])
+
+    def test_summary_is_regenerated_when_latest_review_changes(self):
+        """
+        Test that the time of the latest review is part of the fingerprint.
+        """
+        first_at = datetime.datetime(2024, 1, 1)
+        db = FakeFirestore(
+            {"review_count": 1, "latest_review_at": first_at},
+            [{"stars": 5}],
+        )
+        utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+        self.assertEqual(
+            db.document.data["summary_fingerprint"],
+            utils_reviews.review_fingerprint(1, first_at),
+        )
+
+        # Same count, newer review
+        db.document.data["latest_review_at"] = datetime.datetime(2024, 1, 2)
+        utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+
+        self.assertEqual(self.summarize.call_count, 2)
+
+    def test_no_reviews(self):
+        """
+        Test that products without reviews are not sent to the LLM.
+        """
+        db = FakeFirestore({}, [])
+        summary = utils_reviews.get_reviews_summary(db, 1, {"id": 1})
+
+        self.assertEqual(summary, utils_reviews.NO_REVIEWS_SUMMARY)
+        self.summarize.assert_not_called()
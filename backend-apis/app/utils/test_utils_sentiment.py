@@ -0,0 +1,174 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the background sentiment worker.
+"""
+
+import threading
+import time
+import unittest
+
+from .utils_sentiment import SentimentWorker
+
+
+class FakeBatch:
+    """Firestore write batch recording the committed updates"""
+
+    def __init__(self, db: "FakeFirestore"):
+        self.db = db
+        self.updates = []
+
+    def update(self, document, fields: dict):
+        self.updates.append((document, fields))
+
+    def commit(self):
+        self.db.commits.append(self.updates)
+
+
+class FakeFirestore:
+    """Firestore client recording the batched writes"""
+
+    def __init__(self):
+        self.commits = []
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    def updated(self) -> dict:
+        return {
+            document: fields
+            for commit in self.commits
+            for document, fields in commit
+        }
+
+
+def analyze(text: str) -> dict:
+    return {"sentiment_score": len(text), "sentiment_magnitude": 1}
+
+
+class TestSentimentWorker(unittest.TestCase):
+    """
+    Test the micro-batches, the backpressure and the drain on stop.
+    """
+
+    def test_queued_messages_are_drained_on_stop(self):
+        """
+        Test that every message is patched, in fewer writes than messages.
+        """
+        db = FakeFirestore()
+        worker = SentimentWorker(
+            analyze, db, batch_size=8, batch_wait_seconds=0.5
+        )
+        worker.start()
+        for i in range(20):
+            worker.submit(f"message-{i}", "x" * i)
+        worker.stop(timeout=5)
+
+        updated = db.updated()
+        self.assertEqual(len(updated), 20)
+        self.assertEqual(updated["message-3"]["sentiment_score"], 3)
+        self.assertLess(len(db.commits), 20)
+        self.assertEqual(worker.stats()["scored_inline"], 0)
+
+    def test_full_queue_scores_in_caller(self):
+        """
+        Test that a message that does not fit the queue is scored inline.
+        """
+        release = threading.Event()
+
+        def slow_analyze(text: str) -> dict:
+            if text == "slow":
+                release.wait(5)
+            return analyze(text)
+
+        db = FakeFirestore()
+        worker = SentimentWorker(
+            slow_analyze,
+            db,
+            max_queue_size=1,
+            batch_size=1,
+            submit_timeout_seconds=0.01,
+        )
+        worker.start()
+        worker.submit("message-0", "slow")
+        # Wait for the worker to take the first message
+        while worker.stats()["queued"]:
+            time.sleep(0.001)
+        worker.submit("message-1", "queued")
+        worker.submit("message-2", "inline")
+
+        self.assertEqual(worker.stats()["scored_inline"], 1)
+        self.assertIn("message-2", db.updated())
+        release.set()
+        worker.stop(timeout=5)
+        self.assertEqual(len(db.updated()), 3)
+
+    def test_not_started(self):
+        """
+        Test that messages are scored inline when the worker is stopped.
+        """
+        db = FakeFirestore()
+        worker = SentimentWorker(analyze, db)
+        worker.submit("message-0", "hi")
+
+        self.assertEqual(db.updated()["message-0"]["sentiment_score"], 2)
+
+    def test_stop_honors_timeout_with_full_queue(self):
+        """
+        Test that stop does not block when the queue is full.
+        """
+        release = threading.Event()
+
+        def slow_analyze(text: str) -> dict:
+            release.wait(5)
+            return analyze(text)
+
+        db = FakeFirestore()
+        worker = SentimentWorker(
+            slow_analyze, db, max_queue_size=1, batch_size=1
+        )
+        worker.start()
+        worker.submit("message-0", "taken")
+        while worker.stats()["queued"]:
+            time.sleep(0.001)
+        worker.submit("message-1", "queued")
+
+        started_at = time.monotonic()
+        worker.stop(timeout=0.1)
+        self.assertLess(time.monotonic() - started_at, 2)
+
+        # The worker still drains the queue, then exits
+        release.set()
+        worker._thread.join(5)  # pylint: disable=protected-access
+        self.assertEqual(len(db.updated()), 2)
+
+    def test_analyze_errors_do_not_stop_the_worker(self):
+        """
+        Test that the worker keeps consuming after an analyze error.
+        """
+
+        def failing_analyze(text: str) -> dict:
+            if text == "fail":
+                raise RuntimeError("no credentials")
+            return analyze(text)
+
+        db = FakeFirestore()
+        worker = SentimentWorker(failing_analyze, db, batch_size=1)
+        worker.start()
+        worker.submit("message-0", "fail")
+        worker.submit("message-1", "ok")
+        worker.stop(timeout=5)
+
+        self.assertEqual(list(db.updated()), ["message-1"])
+        self.assertEqual(worker.stats()["errors"], 1)
@@ -0,0 +1,137 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the coalescing of identical in-flight calls.
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils_singleflight import SingleFlight, make_key
+
+
+class TestSingleFlight(unittest.TestCase):
+    """
+    Test that identical concurrent calls share one execution.
+    """
+
+    def test_threads_share_one_call(self):
+        """
+        Test that concurrent sync calls with the same key run once.
+        """
+        group = SingleFlight("test")
+        calls = []
+
+        def call():
+            calls.append(1)
+            time.sleep(0.1)
+            return "summary"
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(
+                executor.map(lambda _: group.do("product-1", call), range(8))
+            )
+
+        self.assertEqual(results, ["summary"] * 8)
+        self.assertEqual(calls, [1])
+        stats = group.stats()
+        self.assertEqual(stats["calls"], 8)
+        self.assertEqual(stats["executions"], 1)
+        self.assertEqual(stats["coalesced"], 7)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_event_loops_share_one_call(self):
+        """
+        Test that async calls from event loops in several threads run once.
+        """
+        group = SingleFlight("test")
+        calls = []
+        results = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "summary"
+
+        def run():
+            results.append(asyncio.run(group.do_async("key", call)))
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["summary"] * 4)
+        self.assertEqual(calls, [1])
+
+    def test_errors_are_shared(self):
+        """
+        Test that waiting calls get the exception of the call in flight.
+        """
+        group = SingleFlight("test")
+
+        def call():
+            time.sleep(0.05)
+            raise ValueError("quota")
+
+        def run(_):
+            try:
+                group.do("key", call)
+            except ValueError as e:
+                return str(e)
+            return None
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            errors = list(executor.map(run, range(4)))
+
+        self.assertEqual(errors, ["quota"] * 4)
+        self.assertEqual(group.stats()["errors"], 1)
+
+    def test_cancelled_leader_is_replaced(self):
+        """
+        Test that a waiting call runs the call itself if the first caller
+        is cancelled.
+        """
+        group = SingleFlight("test")
+
+        async def slow_call():
+            await asyncio.sleep(10)
+            return "slow"
+
+        async def fast_call():
+            return "fast"
+
+        async def run():
+            leader = asyncio.create_task(group.do_async("key", slow_call))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(group.do_async("key", fast_call))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(run()), "fast")
+
+    def test_key_is_normalized(self):
+        """
+        Test that keyword argument order does not change the key.
+        """
+        self.assertEqual(
+            make_key("model", top_k=40, top_p=0.8),
+            make_key("model", top_p=0.8, top_k=40),
+        )
+        self.assertNotEqual(make_key("a"), make_key("b"))
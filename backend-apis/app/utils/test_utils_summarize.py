@@ -0,0 +1,115 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the map-reduce summarization chunker and the rolling summary.
+"""
+
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from . import utils_gemini
+from .utils_summarize import chunk_items, estimate_tokens, fold_summary
+
+
+class TestChunkItems(unittest.TestCase):
+    """
+    Test the token budgeted partitioning of items.
+    """
+
+    def test_chunks_fit_budget(self):
+        """
+        Test that every chunk fits the budget and no item is lost.
+        """
+        items = [{"review": "x" * 100, "stars": i % 5} for i in range(50)]
+        chunks = chunk_items(items, token_budget=200)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([item for chunk in chunks for item in chunk], items)
+        for chunk in chunks:
+            tokens = sum(estimate_tokens(json.dumps(item)) for item in chunk)
+            self.assertLessEqual(tokens, 200)
+
+    def test_appended_item_only_changes_last_chunk(self):
+        """
+        Test that appending an item keeps the previous chunks unchanged.
+        """
+        items = [{"review": "x" * 100} for _ in range(20)]
+        chunks = chunk_items(items, token_budget=200)
+        new_chunks = chunk_items(items + [{"review": "new"}], 200)
+
+        self.assertEqual(new_chunks[:-1], chunks[:-1])
+
+    def test_large_item(self):
+        """
+        Test that an item larger than the budget gets its own chunk.
+        """
+        items = [{"review": "a"}, {"review": "x" * 2000}, {"review": "b"}]
+        self.assertEqual(
+            chunk_items(items, token_budget=100),
+            [[items[0]], [items[1]], [items[2]]],
+        )
+
+
+class TestFoldSummary(unittest.TestCase):
+    """
+    Test that new items are folded into the rolling summary.
+    """
+
+    def test_chunks_are_folded_in_order(self):
+        """
+        Test that each chunk is folded into the summary of the previous.
+        """
+        prompts = []
+
+        async def predict(prompt: str, **_) -> str:
+            prompts.append(prompt)
+            return f"summary {len(prompts)}"
+
+        items = [{"text": "x" * 100} for _ in range(4)]
+        with mock.patch.object(
+            utils_gemini, "async_predict_text_llm", predict
+        ):
+            summary = asyncio.run(
+                fold_summary(
+                    "summary 0",
+                    items,
+                    "{summary}|{items}",
+                    token_budget=60,
+                )
+            )
+
+        self.assertEqual(summary, f"summary {len(prompts)}")
+        self.assertGreater(len(prompts), 1)
+        self.assertTrue(prompts[0].startswith("summary 0|"))
+        self.assertTrue(prompts[1].startswith("summary 1|"))
+
+    def test_failed_call(self):
+        """
+        Test that a failed call returns an empty summary.
+        """
+
+        async def predict(prompt: str, **_) -> str:
+            del prompt
+            return ""
+
+        with mock.patch.object(
+            utils_gemini, "async_predict_text_llm", predict
+        ):
+            summary = asyncio.run(
+                fold_summary("old", [{"text": "hi"}], "{summary}{items}")
+            )
+
+        self.assertEqual(summary, "")
@@ -0,0 +1,91 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the approximate query vector cache.
+"""
+
+import unittest
+
+import numpy as np
+
+from .utils_vector_cache import QueryVectorCache, create_query_vector_cache
+
+
+class TestQueryVectorCache(unittest.TestCase):
+    """
+    Test the similarity threshold, the keys and the stats.
+    """
+
+    def setUp(self):
+        self.vector = np.random.default_rng(0).normal(size=64)
+
+    def test_near_identical_query_is_a_hit(self):
+        """
+        Test that a slightly different query reuses the result.
+        """
+        cache = QueryVectorCache(similarity_threshold=0.99)
+        cache.set("index", self.vector, 10, "result")
+        noise = np.random.default_rng(1).normal(scale=0.01, size=64)
+
+        result, similarity = cache.get("index", self.vector + noise, 10)
+
+        self.assertEqual(result, "result")
+        self.assertGreaterEqual(similarity, 0.99)
+
+    def test_misses(self):
+        """
+        Test that other indexes, larger counts and far queries miss.
+        """
+        cache = QueryVectorCache(similarity_threshold=0.99)
+        cache.set("index", self.vector, 10, "result")
+        other = np.random.default_rng(2).normal(size=64)
+
+        self.assertIsNone(cache.get("other", self.vector, 10)[0])
+        self.assertIsNone(cache.get("index", self.vector, 20)[0])
+        self.assertIsNone(cache.get("index", other, 10)[0])
+        self.assertEqual(cache.get("index", self.vector, 5)[0], "result")
+
+    def test_stats(self):
+        """
+        Test the hit rate and the overlap of the verified hits.
+        """
+        cache = QueryVectorCache()
+        cache.set("index", self.vector, 2, "result")
+        cache.get("index", self.vector, 2)
+        cache.get("index", -self.vector, 2)
+        cache.record_overlap(["a", "b"], ["a", "c"])
+
+        stats = cache.stats()
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["mean_overlap"], 0.5)
+
+    def test_replace(self):
+        """
+        Test that a verified hit replaces the cached result.
+        """
+        cache = QueryVectorCache(similarity_threshold=0.99)
+        cache.set("index", self.vector, 10, "stale")
+        cached, _ = cache.get("index", self.vector * 1.001, 10)
+
+        cache.replace("index", cached, self.vector * 1.001, 10, "fresh")
+
+        self.assertEqual(cache.get("index", self.vector, 10)[0], "fresh")
+        self.assertEqual(cache.stats()["size"], 1)
+
+    def test_disabled_by_default(self):
+        """
+        Test that the cache is only created when enabled.
+        """
+        self.assertIsNone(create_query_vector_cache({}))
+        self.assertIsNotNone(create_query_vector_cache({"enabled": True}))
@@ -0,0 +1,199 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Test the batched Vector Search queries.
+"""
+
+# pylint: disable=protected-access
+
+import asyncio
+import unittest
+from unittest import mock
+
+import numpy as np
+from google.cloud import aiplatform_v1
+
+from . import utils_vertex_vector
+from .utils_local_vector import LocalVectorIndex
+from .utils_vector_cache import QueryVectorCache
+from .utils_vertex_vector import NeighborQuery
+
+
+class FakeAsyncMatchClient:
+    """Async match client recording the requests"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def find_neighbors(self, request):
+        self.requests.append(request)
+        return aiplatform_v1.FindNeighborsResponse(
+            nearest_neighbors=[
+                aiplatform_v1.FindNeighborsResponse.NearestNeighbors(
+                    id=query.datapoint.datapoint_id
+                )
+                for query in request.queries
+            ]
+        )
+
+
+class TestFindNeighbors(unittest.TestCase):
+    """
+    Test that queries are packed in one request and answered in order.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(
+            utils_vertex_vector, "query_vector_cache", None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queries_are_packed(self):
+        """
+        Test that each query keeps its vector and neighbor count.
+        """
+        request, key = utils_vertex_vector._build_request(
+            utils_vertex_vector.p1_index,
+            [
+                NeighborQuery(np.array([1.0, 2.0], dtype=np.float32), "a", 2),
+                NeighborQuery([3.0, 4.0], "b", 5),
+            ],
+        )
+
+        self.assertEqual(
+            [q.datapoint.datapoint_id for q in request.queries], ["a", "b"]
+        )
+        self.assertEqual([q.neighbor_count for q in request.queries], [2, 5])
+        self.assertEqual(
+            list(request.queries[1].datapoint.feature_vector), [3.0, 4.0]
+        )
+        _, other_key = utils_vertex_vector._build_request(
+            utils_vertex_vector.p1_index,
+            [NeighborQuery([1.0, 2.0], "a", 3)],
+        )
+        self.assertNotEqual(key, other_key)
+
+    def test_local_index_batch(self):
+        """
+        Test that a local index answers each query with its count.
+        """
+        vectors = np.eye(4, dtype=np.float32)
+        index = utils_vertex_vector.p1_index._replace(
+            local_index=LocalVectorIndex(["0", "1", "2", "3"], vectors)
+        )
+        with mock.patch.object(utils_vertex_vector, "p1_index", index):
+            response = utils_vertex_vector.find_neighbors(
+                [
+                    NeighborQuery(vectors[2], "q0", 1),
+                    NeighborQuery(vectors[3], "q1", 3),
+                ]
+            )
+
+        self.assertEqual(
+            [n.id for n in response.nearest_neighbors], ["q0", "q1"]
+        )
+        self.assertEqual(
+            [len(n.neighbors) for n in response.nearest_neighbors], [1, 3]
+        )
+        self.assertEqual(
+            response.nearest_neighbors[1].neighbors[0].datapoint.datapoint_id,
+            "3",
+        )
+
+    def test_async_find_neighbors(self):
+        """
+        Test that the async variant sends one request from any event loop.
+        """
+        client = FakeAsyncMatchClient()
+        endpoint = utils_vertex_vector.p1_index.api_endpoint
+        with mock.patch.dict(
+            utils_vertex_vector._async_match_clients, {endpoint: client}
+        ):
+            for _ in range(2):
+                response = asyncio.run(
+                    utils_vertex_vector.async_find_neighbors(
+                        [
+                            NeighborQuery([1.0], "q0"),
+                            NeighborQuery([2.0], "q1"),
+                        ]
+                    )
+                )
+
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(
+            [n.id for n in response.nearest_neighbors], ["q0", "q1"]
+        )
+
+
+class TestQueryVectorCache(unittest.TestCase):
+    """
+    Test that similar queries reuse the cached neighbors.
+    """
+
+    def setUp(self):
+        self.cache = QueryVectorCache(similarity_threshold=0.99)
+        patcher = mock.patch.object(
+            utils_vertex_vector, "query_vector_cache", self.cache
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_similar_queries_are_cached(self):
+        """
+        Test that a scaled query is a hit and a different one is a miss.
+        """
+        client = FakeAsyncMatchClient()
+        endpoint = utils_vertex_vector.p1_index.api_endpoint
+        vector = np.arange(1, 9, dtype=np.float32)
+        with mock.patch.dict(
+            utils_vertex_vector._async_match_clients, {endpoint: client}
+        ):
+            for feature_vector in (vector, vector * 2, -vector):
+                response = asyncio.run(
+                    utils_vertex_vector.async_find_neighbors(
+                        [NeighborQuery(feature_vector, "q")]
+                    )
+                )
+
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(response.nearest_neighbors[0].id, "q")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_verified_hit_refreshes_the_entry(self):
+        """
+        Test that a verified hit caches the fresh neighbors.
+        """
+        self.cache.verify_sample_rate = 1.0
+        client = FakeAsyncMatchClient()
+        endpoint = utils_vertex_vector.p1_index.api_endpoint
+        vector = np.arange(1, 9, dtype=np.float32)
+        with mock.patch.dict(
+            utils_vertex_vector._async_match_clients, {endpoint: client}
+        ):
+            for query_id in ("first", "second"):
+                asyncio.run(
+                    utils_vertex_vector.async_find_neighbors(
+                        [NeighborQuery(vector, query_id)]
+                    )
+                )
+
+        index = utils_vertex_vector.p1_index
+        cached, _ = self.cache.get(
+            f"{index.index_endpoint_id}/{index.deployed_index_id}", vector, 10
+        )
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(cached.id, "second")
+        self.assertEqual(self.cache.stats()["size"], 1)
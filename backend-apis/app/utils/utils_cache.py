@@ -0,0 +1,395 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Utils for in-process and persistent caches
+"""
+
+import hashlib
+import json
+import shelve
+import threading
+import time
+import tomllib
+from collections import OrderedDict
+
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import firestore
+
+from app.utils.utils_metrics import register_metrics
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    llm_cache_cfg = config.get("llm_cache", {})
+
+
+class TTLCache:
+    """Bounded in-process cache with TTL and LRU eviction.
+
+    Entries expire `ttl_seconds` after being stored, unless another TTL
+    is given to `set`. When the cache is full, the least recently used
+    entry is evicted.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Gets a cached value
+
+        Args:
+            key:
+                Cache key
+
+        Returns:
+            The cached value, or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl_seconds: float | None = None):
+        """Stores a value, evicting the least recently used entries if full
+
+        Args:
+            key:
+                Cache key
+            value:
+                Value to be cached
+            ttl_seconds: float | None
+                TTL of this entry. Defaults to the cache TTL.
+        """
+        if self.max_size <= 0:
+            return
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes a single entry from the cache
+
+        Args:
+            key:
+                Cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the cache counters
+
+        Returns:
+            dict
+                Size, hits, misses and evictions of the cache
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCacheTier:
+    """Persistent cache tier stored in a local shelve file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._shelf = None
+
+    def _get_shelf(self) -> shelve.Shelf:
+        if self._shelf is None:
+            self._shelf = shelve.open(self.path)
+        return self._shelf
+
+    def get(self, key: str):
+        """Gets a value that has not expired
+
+        Args:
+            key: str
+                Cache key
+
+        Returns:
+            The cached value or None
+        """
+        with self._lock:
+            entry = self._get_shelf().get(key)
+        if entry is None or entry["expires_at"] < time.time():
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value, ttl_seconds: float):
+        """Stores a value
+
+        Args:
+            key: str
+                Cache key
+            value:
+                Value to be cached (must be picklable)
+            ttl_seconds: float
+                TTL of the entry
+        """
+        with self._lock:
+            shelf = self._get_shelf()
+            shelf[key] = {
+                "expires_at": time.time() + ttl_seconds,
+                "value": value,
+            }
+            shelf.sync()
+
+    def close(self):
+        """Closes the shelve file"""
+        with self._lock:
+            if self._shelf is not None:
+                self._shelf.close()
+                self._shelf = None
+
+
+class FirestoreCacheTier:
+    """Persistent cache tier stored in a Firestore collection,
+       shared by all the instances of the service."""
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        self._client = None
+
+    def _get_collection(self):
+        if self._client is None:
+            self._client = firestore.Client()
+        return self._client.collection(self.collection)
+
+    def get(self, key: str):
+        """Gets a value that has not expired
+
+        Args:
+            key: str
+                Cache key
+
+        Returns:
+            The cached value or None
+        """
+        try:
+            entry = self._get_collection().document(key).get().to_dict()
+        except GoogleAPICallError as e:
+            print(e)
+            return None
+        if not entry or entry["expires_at"] < time.time():
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value, ttl_seconds: float):
+        """Stores a value
+
+        Args:
+            key: str
+                Cache key
+            value:
+                Value to be cached (must be a Firestore value)
+            ttl_seconds: float
+                TTL of the entry
+        """
+        try:
+            self._get_collection().document(key).set(
+                {"expires_at": time.time() + ttl_seconds, "value": value}
+            )
+        except GoogleAPICallError as e:
+            print(e)
+
+
+class ResponseCache:
+    """Two-tier cache for generated responses.
+
+    Lookups go to the in-memory LRU tier first and then to the optional
+    persistent tier (disk or Firestore). Persistent hits are copied back
+    into memory.
+    """
+
+    def __init__(
+        self,
+        memory: TTLCache,
+        persistent: DiskCacheTier | FirestoreCacheTier | None = None,
+        enabled: bool = True,
+    ):
+        self.memory = memory
+        self.persistent = persistent
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, params: dict, prompt: str) -> str:
+        """Builds the cache key for a generation request
+
+        Args:
+            model: str
+                Model name
+            params: dict
+                Generation parameters
+            prompt: str
+                Prompt
+
+        Returns:
+            str
+                SHA-256 of the model, parameters and prompt
+        """
+        payload = json.dumps(
+            {"model": model, "params": params, "prompt": prompt},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Gets a cached response
+
+        Args:
+            key: str
+                Cache key
+
+        Returns:
+            The cached response or None
+        """
+        if not self.enabled:
+            return None
+        value = self.memory.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+        if self.persistent is not None:
+            value = self.persistent.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+                with self._lock:
+                    self.hits += 1
+                    self.persistent_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value, ttl_seconds: float | None = None):
+        """Stores a response in both tiers
+
+        Args:
+            key: str
+                Cache key
+            value:
+                Response
+            ttl_seconds: float | None
+                TTL of the entry. Defaults to the memory tier TTL.
+        """
+        if not self.enabled:
+            return
+        if ttl_seconds is None:
+            ttl_seconds = self.memory.ttl_seconds
+        self.memory.set(key, value, ttl_seconds)
+        if self.persistent is not None:
+            self.persistent.set(key, value, ttl_seconds)
+
+    def stats(self) -> dict:
+        """Returns the cache counters
+
+        Returns:
+            dict
+                Hits, persistent hits, misses, hit ratio and the memory
+                tier counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "memory": self.memory.stats(),
+            }
+
+
+def create_response_cache(cache_cfg: dict) -> ResponseCache:
+    """Creates a ResponseCache from a config section
+
+    Args:
+        cache_cfg: dict
+            Section of config.toml (see [llm_cache])
+
+    Raises:
+        ValueError:
+            If the persistent backend is unknown
+
+    Returns:
+        ResponseCache
+    """
+    persistent_backend = cache_cfg.get("persistent_backend", "")
+    persistent = None
+    if persistent_backend == "disk":
+        persistent = DiskCacheTier(cache_cfg["disk_path"])
+    elif persistent_backend == "firestore":
+        persistent = FirestoreCacheTier(cache_cfg["firestore_collection"])
+    elif persistent_backend:
+        raise ValueError(f"Unknown cache backend: {persistent_backend}")
+
+    return ResponseCache(
+        memory=TTLCache(
+            max_size=cache_cfg.get("max_size", 2048),
+            ttl_seconds=cache_cfg.get("default_ttl_seconds", 3600),
+        ),
+        persistent=persistent,
+        enabled=cache_cfg.get("enabled", True),
+    )
+
+
+llm_response_cache = create_response_cache(llm_cache_cfg)
+
+
+def get_llm_cache_stats() -> dict:
+    """Gets the LLM response cache counters
+
+    Returns:
+        dict
+            Hits, persistent hits, misses and hit ratio
+    """
+    return llm_response_cache.stats()
+
+
+register_metrics("llm_cache", get_llm_cache_stats)
@@ -15,9 +15,14 @@
 Utils for Cloud NLP API
 """
 
+import asyncio
+import functools
+
 from google.cloud import language_v2
 
-client = language_v2.LanguageServiceClient()
+from app.utils.utils_lazy import lazy
+
+client = lazy(language_v2.LanguageServiceClient)
 
 
 def nlp_analyze_entities(input_text: str) -> list:
@@ -65,3 +70,25 @@ def nlp_analyze_entities(input_text: str) -> list:
         results.append(result)
 
     return results
+
+
+async def async_nlp_analyze_entities(
+    input_text: str, timeout: float | None = None
+) -> list:
+    """
+    Analyzes Entities in a string without blocking the event loop.
+
+    Args:
+      input_text: The text content to analyze
+      timeout: Seconds to wait for the response
+
+    Raises:
+      asyncio.TimeoutError: The response took longer than timeout
+    """
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(
+        loop.run_in_executor(
+            None, functools.partial(nlp_analyze_entities, input_text)
+        ),
+        timeout,
+    )
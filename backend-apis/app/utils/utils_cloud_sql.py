@@ -12,32 +12,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """
-Utils to help with Cloud SQL queries 
-
+Utils to help with Cloud SQL queries
+
+Products are read with a sync SQLAlchemy engine whose pool is configured
+in the [sql] section of config.toml and reported on /metrics
+(cloud_sql_pool). There is no async engine: the Cloud SQL Connector only
+has an async driver for PostgreSQL (asyncpg), and its connect_async
+returns a blocking pymysql connection for MySQL, which AsyncSession
+cannot use. The product routes run in the FastAPI thread pool, so the
+pool is sized to the number of worker threads instead.
 """
 
+import abc
 import json
+import threading
+import time
 import tomllib
+import typing
+from dataclasses import dataclass
 from json import JSONDecodeError
 
+import numpy as np
 import sqlalchemy
 from google.cloud.sql.connector.connector import Connector
 from sqlalchemy import DECIMAL, Integer, String, select
 from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from app.utils import utils_cache
+from app.utils.utils_metrics import register_metrics
 
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
     sql_cfg = config["sql"]
 
+BACKEND = sql_cfg.get("backend", "cloudsql")
+SQLITE_PATH = sql_cfg.get("sqlite_path", "")
+SQLITE_SEED_FILES = sql_cfg.get("sqlite_seed_files", [])
 PROJECT_ID = sql_cfg["project"]
 REGION = sql_cfg["region"]
 INSTANCE_NAME = sql_cfg["instance_name"]
 INSTANCE_CONNECTION_NAME = f"{PROJECT_ID}:{REGION}:{INSTANCE_NAME}"
 DB_USER = sql_cfg["db_user"]
 DB_NAME = sql_cfg["db_name"]
-
-# initialize Connector object
-connector = Connector()
+PRODUCT_CACHE_MAX_SIZE = sql_cfg.get("product_cache_max_size", 1024)
+PRODUCT_CACHE_TTL_SECONDS = sql_cfg.get("product_cache_ttl_seconds", 300)
+POOL_SIZE = sql_cfg.get("pool_size", 5)
+POOL_MAX_OVERFLOW = sql_cfg.get("pool_max_overflow", 2)
+POOL_TIMEOUT = sql_cfg.get("pool_timeout", 30)
+POOL_RECYCLE = sql_cfg.get("pool_recycle", 1800)
+POOL_PRE_PING = sql_cfg.get("pool_pre_ping", True)
+PRODUCT_ID_INDEX_REFRESH_SECONDS = sql_cfg.get(
+    "product_id_index_refresh_seconds", 600
+)
 
 
 class Base(DeclarativeBase):  # pylint: disable=too-few-public-methods
@@ -60,30 +87,428 @@ class Product(Base):  # pylint: disable=too-few-public-methods
     quantity: Mapped[int] = mapped_column(Integer)
 
 
-# function to return the database connection object
-def getconn():
-    """Gets the DB-API connection to the database
+def _parse_list_column(value: str | None, product_id=None) -> list:
+    """Parses a list stored as a string column (e.g. "['a', 'b']")"""
+    if not value:
+        return []
+    try:
+        return json.loads(value.replace("'", '"'))
+    except JSONDecodeError as e:
+        print(f"Could not parse column of product {product_id}: {e}")
+    return []
+
+
+@dataclass(frozen=True, slots=True)
+class ProductSnapshot:
+    """Normalized, read-only projection of a product row.
+
+    The features and categories columns are parsed only once, when the
+    snapshot is created from the database row.
+    """
+
+    id: int
+    title: str
+    description: str
+    image: str
+    features: tuple
+    categories: tuple
+    price: float
+    quantity: int
+
+    @classmethod
+    def from_product(cls, product: Product) -> "ProductSnapshot":
+        """Creates a snapshot from a Product row
+
+        Args:
+            product: Product
+                A Product instance
+
+        Returns:
+            ProductSnapshot
+        """
+        return cls(
+            id=int(product.id),
+            title=str(product.title),
+            description=str(product.description),
+            image=str(product.image),
+            features=tuple(_parse_list_column(product.features, product.id)),
+            categories=tuple(
+                _parse_list_column(product.categories, product.id)
+            ),
+            price=float(product.price),
+            quantity=int(product.quantity),
+        )
+
+    def to_dict(self) -> dict:
+        """Returns the dict representation of the product"""
+        return {
+            "id": self.id,
+            "title": self.title,
+            "description": self.description,
+            "image": self.image,
+            "features": list(self.features),
+            "categories": list(self.categories),
+            "price": self.price,
+            "quantity": self.quantity,
+        }
+
+
+product_cache = utils_cache.TTLCache(
+    max_size=PRODUCT_CACHE_MAX_SIZE, ttl_seconds=PRODUCT_CACHE_TTL_SECONDS
+)
+
+
+def _product_cache_key(product_id: int | str) -> int | str:
+    """Normalizes a product id so int and str ids share the same entry"""
+    try:
+        return int(product_id)
+    except (TypeError, ValueError):
+        return product_id
+
+
+def invalidate_product(product_id: int | str):
+    """Removes a product from the product cache.
+       Must be called whenever a product is written.
+
+    Args:
+        product_id: int | str
+            id of the product to be invalidated
+    """
+    product_cache.invalidate(_product_cache_key(product_id))
+
+
+def clear_product_cache():
+    """Removes all products from the product cache"""
+    product_cache.clear()
+
+
+def get_product_cache_stats() -> dict:
+    """Gets the product cache counters
 
     Returns:
-        A DB-API connection to the specified Cloud SQL instance.
+        dict
+            Size, hits, misses and evictions of the product cache
     """
-    conn = connector.connect(
-        INSTANCE_CONNECTION_NAME,
-        "pymysql",
-        user=DB_USER,
-        enable_iam_auth=True,
-        db=DB_NAME,
-    )
-    return conn
+    return product_cache.stats()
 
 
-pool = sqlalchemy.create_engine(
-    "mysql+pymysql://",
-    creator=getconn,
-)
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out
+       a connection (including the time to open new connections)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.checkout_wait_total += waited
+                self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+    def stats(self) -> dict:
+        """Returns the pool counters
+
+        Returns:
+            dict
+                Pool size, checked out / in connections, overflow and
+                checkout wait times in milliseconds
+        """
+        with self._stats_lock:
+            checkouts = self.checkouts
+            wait_total = self.checkout_wait_total
+            wait_max = self.checkout_wait_max
+        return {
+            "pool_size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": self.overflow(),
+            "checkouts": checkouts,
+            "checkout_wait_avg_ms": (
+                wait_total / checkouts * 1000 if checkouts else 0.0
+            ),
+            "checkout_wait_max_ms": wait_max * 1000,
+        }
+
+
+class ProductRepository(abc.ABC):
+    """Interface of the product catalog backends"""
+
+    @abc.abstractmethod
+    def get_product(self, product_id: int) -> ProductSnapshot | None:
+        """Gets a product by id
+
+        Args:
+            product_id: int
+                id of the product to be queried.
+
+        Returns:
+            ProductSnapshot if found or None
+        """
+
+    @abc.abstractmethod
+    def get_products(self, id_list: list) -> list[ProductSnapshot]:
+        """Gets the products with the given ids
+
+        Args:
+            id_list: list
+                list of ids to be queried
+
+        Returns:
+            list[ProductSnapshot]
+                The products found, in no particular order
+        """
+
+    @abc.abstractmethod
+    def get_id_index_rows(self) -> list:
+        """Gets the id and categories of every product
+
+        Returns:
+            list
+                (id, categories) rows used by the ProductIdIndex
+        """
+
+    def stats(self) -> dict:
+        """Gets the backend counters
+
+        Returns:
+            dict
+                Backend specific counters
+        """
+        return {}
+
+
+class SqlAlchemyProductRepository(ProductRepository):
+    """Product repository backed by a SQLAlchemy engine"""
+
+    def __init__(self, engine: sqlalchemy.Engine):
+        self.engine = engine
+
+    def get_product(self, product_id: int) -> ProductSnapshot | None:
+        with Session(self.engine) as session:
+            stmt = select(Product).where(Product.id == product_id)
+            for row in session.execute(stmt):
+                return ProductSnapshot.from_product(row[0])
+        return None
+
+    def get_products(self, id_list: list) -> list[ProductSnapshot]:
+        with Session(self.engine) as session:
+            # select Product where id in id_list
+            stmt = select(Product).where(Product.id.in_(id_list))
+            return [
+                ProductSnapshot.from_product(row[0])
+                for row in session.execute(stmt)
+            ]
+
+    def get_id_index_rows(self) -> list:
+        with Session(self.engine) as session:
+            stmt = select(Product.id, Product.categories)
+            return list(session.execute(stmt))
+
+    def stats(self) -> dict:
+        if isinstance(self.engine.pool, InstrumentedQueuePool):
+            return self.engine.pool.stats()
+        return {}
+
+
+class CloudSqlProductRepository(SqlAlchemyProductRepository):
+    """Product repository backed by Cloud SQL for MySQL, using the
+       Cloud SQL Python Connector with IAM authentication."""
+
+    def __init__(self):
+        self.connector = Connector()
+        super().__init__(
+            sqlalchemy.create_engine(
+                "mysql+pymysql://",
+                creator=self.getconn,
+                poolclass=InstrumentedQueuePool,
+                pool_size=POOL_SIZE,
+                max_overflow=POOL_MAX_OVERFLOW,
+                pool_timeout=POOL_TIMEOUT,
+                pool_recycle=POOL_RECYCLE,
+                pool_pre_ping=POOL_PRE_PING,
+            )
+        )
+
+    def getconn(self):
+        """Gets the DB-API connection to the database
+
+        Returns:
+            A DB-API connection to the specified Cloud SQL instance.
+        """
+        conn = self.connector.connect(
+            INSTANCE_CONNECTION_NAME,
+            "pymysql",
+            user=DB_USER,
+            enable_iam_auth=True,
+            db=DB_NAME,
+        )
+        return conn
+
+
+def _product_row_from_dataset(line: dict) -> dict:
+    """Maps a line of the products datasets to Product columns.
+       Supports both search_products.jsonl and recommendation_products.jsonl.
+    """
+    data = json.loads(line["jsonData"]) if "jsonData" in line else line
+    row = {"id": int(line["id"])}
+    for column in ("title", "description"):
+        if column in data:
+            row[column] = data[column]
+    if "price" in data:
+        row["price"] = float(data["price"])
+    elif "priceInfo" in line:
+        row["price"] = float(line["priceInfo"]["price"])
+    if "categories" in line:
+        categories = line["categories"]
+        if isinstance(categories, str):
+            categories = [categories]
+        row["categories"] = json.dumps(categories)
+    if line.get("images"):
+        row["image"] = line["images"][0]["uri"]
+    if "availableQuantity" in line:
+        row["quantity"] = int(line["availableQuantity"])
+    return row
+
+
+class SqliteProductRepository(SqlAlchemyProductRepository):
+    """Product repository backed by SQLite, for local development and
+       load testing without a Cloud SQL instance.
+
+    An empty `path` creates an in-memory database. When the database is
+    empty it is seeded from `seed_files`; lines with the same id are merged,
+    so later files can add the columns missing from the first ones.
+    """
+
+    def __init__(self, path: str = "", seed_files: list[str] | None = None):
+        if path:
+            engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        else:
+            engine = sqlalchemy.create_engine(
+                "sqlite://",
+                connect_args={"check_same_thread": False},
+                poolclass=StaticPool,
+            )
+        super().__init__(engine)
+        Base.metadata.create_all(engine)
+        if seed_files:
+            self.seed(seed_files)
+
+    def seed(self, seed_files: list[str]):
+        """Loads the products from JSONL datasets if the table is empty
+
+        Args:
+            seed_files: list[str]
+                Paths of the JSONL datasets
+        """
+        with Session(self.engine) as session:
+            if session.scalar(select(sqlalchemy.func.count(Product.id))):
+                return
+
+            rows: dict[int, dict] = {}
+            for seed_file in seed_files:
+                with open(seed_file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        row = _product_row_from_dataset(json.loads(line))
+                        rows.setdefault(row["id"], {}).update(row)
+
+            session.add_all(
+                Product(
+                    id=row["id"],
+                    title=row.get("title", ""),
+                    description=row.get("description", ""),
+                    image=row.get("image", ""),
+                    features=row.get("features", "[]"),
+                    categories=row.get("categories", "[]"),
+                    price=row.get("price", 0.0),
+                    quantity=row.get("quantity", 0),
+                )
+                for row in rows.values()
+            )
+            session.commit()
+
+
+_repository: ProductRepository | None = None
+_repository_lock = threading.Lock()
+
+
+def create_repository() -> ProductRepository:
+    """Creates the product repository selected by the `backend`
+       key of the [sql] section of config.toml
+
+    Raises:
+        ValueError:
+            If the backend is unknown
+
+    Returns:
+        ProductRepository
+    """
+    if BACKEND == "cloudsql":
+        return CloudSqlProductRepository()
+    if BACKEND == "sqlite":
+        return SqliteProductRepository(
+            path=SQLITE_PATH, seed_files=SQLITE_SEED_FILES
+        )
+    raise ValueError(f"Unknown product repository backend: {BACKEND}")
+
+
+def get_repository() -> ProductRepository:
+    """Gets the product repository, creating it on first use
+
+    Returns:
+        ProductRepository
+    """
+    global _repository  # pylint: disable=global-statement
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                _repository = create_repository()
+    return _repository
+
 
+def set_repository(repository: ProductRepository | None):
+    """Replaces the product repository and clears the product caches.
+       Passing None recreates the configured repository on next use.
 
-def get_product(product_id: int) -> Product | None:
+    Args:
+        repository: ProductRepository | None
+            The repository to be used
+    """
+    global _repository  # pylint: disable=global-statement
+    with _repository_lock:
+        _repository = repository
+    clear_product_cache()
+    product_id_index.invalidate()
+
+
+def get_pool_stats() -> dict:
+    """Gets the connection pool counters, without creating the repository
+
+    Returns:
+        dict
+            Pool size, checked out / in connections, overflow and
+            checkout wait times in milliseconds. Empty until the
+            repository is created.
+    """
+    repository = _repository
+    return repository.stats() if repository is not None else {}
+
+
+register_metrics("cloud_sql_pool", get_pool_stats)
+register_metrics("product_cache", get_product_cache_stats)
+
+
+def get_product(product_id: int) -> ProductSnapshot | None:
     """Gets the product from the database using the id
 
     Args:
@@ -91,75 +516,184 @@ def get_product(product_id: int) -> Product | None:
             id of the product to be queried.
 
     Returns:
-        Product if found or None
+        ProductSnapshot if found or None
 
     """
-    with Session(pool) as session:
-        stmt = select(Product).where(Product.id == product_id)
-        for row in session.execute(stmt):
-            return row[0]
-    return None
+    key = _product_cache_key(product_id)
+    product = product_cache.get(key)
+    if product is not None:
+        return product
+
+    product = get_repository().get_product(product_id)
+    if product is not None:
+        product_cache.set(key, product)
+    return product
 
 
-def convert_product_to_dict(product: Product) -> dict:
+def convert_product_to_dict(product: Product | ProductSnapshot) -> dict:
     """Converts a product instance to a dict representation.
 
     Args:
-        product: Product
-            A Product instance
+        product: Product | ProductSnapshot
+            A Product instance or its snapshot
 
     Returns:
         dict
             A dict representing the product
 
     """
-    features = []
-    if product.features:
-        try:
-            features = json.loads(product.features.replace("'", '"'))
-        except JSONDecodeError as e:
-            print(e)
+    if not isinstance(product, ProductSnapshot):
+        product = ProductSnapshot.from_product(product)
+    return product.to_dict()
+
 
-    categories = []
-    if product.categories:
+class ProductIdIndex:
+    """In-memory array of product ids used to sample random products
+       without sorting the whole table in the database.
+
+    The index is loaded with `loader` on first use and reloaded when it is
+    older than `refresh_seconds`. A single thread reloads a stale index,
+    while the others keep sampling the previous ids.
+    """
+
+    def __init__(self, loader: typing.Callable, refresh_seconds: float = 600):
+        self.loader = loader
+        self.refresh_seconds = refresh_seconds
+        self.ids = np.empty(0, dtype=np.int64)
+        self.category_codes = np.empty(0, dtype=np.int64)
+        self._loaded_at: float | None = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """Reloads the product ids and categories"""
+        with self._refresh_lock:
+            self._load()
+
+    def _load(self):
+        rows = self.loader()
+        ids = np.array([int(row[0]) for row in rows], dtype=np.int64)
+        first_categories = []
+        for row in rows:
+            categories = _parse_list_column(row[1])
+            first_categories.append(str(categories[0]) if categories else "")
+        _, category_codes = np.unique(
+            np.array(first_categories, dtype=str), return_inverse=True
+        )
+        with self._lock:
+            self.ids = ids
+            self.category_codes = category_codes.astype(np.int64)
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Forces a reload of the index on next use"""
+        with self._lock:
+            self._loaded_at = None
+
+    def _is_stale(self) -> bool:
+        with self._lock:
+            loaded_at = self._loaded_at
+        return (
+            loaded_at is None
+            or time.monotonic() - loaded_at > self.refresh_seconds
+        )
+
+    def _refresh_if_stale(self):
+        if not self._is_stale():
+            return
+        with self._lock:
+            loaded = self._loaded_at is not None
+        # Without ids to sample, wait for the thread loading them
+        if not self._refresh_lock.acquire(blocking=not loaded):
+            return
         try:
-            categories = json.loads(product.categories.replace("'", '"'))
-        except JSONDecodeError as e:
-            print(e)
-
-    return_dict = {
-        "id": int(product.id),
-        "title": str(product.title),
-        "description": str(product.description),
-        "image": str(product.image),
-        "features": features,
-        "categories": categories,
-        "price": float(product.price),
-        "quantity": int(product.quantity),
-    }
-    return return_dict
+            if self._is_stale():
+                self._load()
+        finally:
+            self._refresh_lock.release()
+
+    def sample(
+        self,
+        size: int,
+        seed: int | None = None,
+        stratify_by_category: bool = False,
+    ) -> list[int]:
+        """Draws random product ids without replacement
+
+        Args:
+            size: int
+                Number of ids to draw
+            seed: int | None
+                Seed for a reproducible sample
+            stratify_by_category: bool
+                Spread the sample across the product categories
+                (round robin over the categories in random order)
+
+        Returns:
+            list[int]
+                Sampled product ids
+        """
+        self._refresh_if_stale()
+        with self._lock:
+            ids = self.ids
+            category_codes = self.category_codes
+
+        size = min(size, len(ids))
+        if size <= 0:
+            return []
+
+        rng = np.random.default_rng(seed)
+        if not stratify_by_category:
+            return ids[rng.choice(len(ids), size=size, replace=False)].tolist()
+
+        groups = [
+            rng.permutation(np.flatnonzero(category_codes == code))
+            for code in rng.permutation(int(category_codes.max()) + 1)
+        ]
+        picked = []
+        for rank in range(max(len(group) for group in groups)):
+            for group in groups:
+                if rank < len(group):
+                    picked.append(group[rank])
+                if len(picked) == size:
+                    return ids[picked].tolist()
+        return ids[picked].tolist()
+
+
+product_id_index = ProductIdIndex(
+    loader=lambda: get_repository().get_id_index_rows(),
+    refresh_seconds=PRODUCT_ID_INDEX_REFRESH_SECONDS,
+)
 
 
-def get_random_products(size: int = 10) -> list[dict]:
+def get_random_products(
+    size: int = 10,
+    seed: int | None = None,
+    stratify_by_category: bool = False,
+) -> list[dict]:
     """Gets random products from the database and returns
        a list of dicts representing the products
 
     Args:
         size: int
             Size of the list to return
+        seed: int | None
+            Seed for a reproducible sample
+        stratify_by_category: bool
+            Spread the products across the categories
 
     Returns:
         list[dict]
             A list of dict representations of random products
 
     """
-    results = []
-    with Session(pool) as session:
-        # select Product order by RAND() limit to size
-        stmt = select(Product).order_by(sqlalchemy.func.rand()).limit(size)
-        for row in session.execute(stmt):
-            results.append(convert_product_to_dict(row[0]))
-    return results
+    sampled_ids = product_id_index.sample(
+        size=size, seed=seed, stratify_by_category=stratify_by_category
+    )
+    products = {
+        product["id"]: product for product in get_products(sampled_ids)
+    }
+    return [products[i] for i in sampled_ids if i in products]
 
 
 def get_products(id_list: list) -> list[dict]:
@@ -177,9 +711,70 @@ def get_products(id_list: list) -> list[dict]:
 
     """
     results = []
-    with Session(pool) as session:
-        # select Product where id in id_list
-        stmt = select(Product).where(Product.id.in_(id_list))
-        for row in session.execute(stmt):
-            results.append(convert_product_to_dict(row[0]))
+    missing_ids = []
+    for product_id in id_list:
+        product = product_cache.get(_product_cache_key(product_id))
+        if product is not None:
+            results.append(product.to_dict())
+        else:
+            missing_ids.append(product_id)
+
+    if not missing_ids:
+        return results
+
+    for product in get_repository().get_products(missing_ids):
+        product_cache.set(product.id, product)
+        results.append(product.to_dict())
     return results
+
+
+class HydratedNeighbors(typing.NamedTuple):
+    """Products hydrated from Vector Search neighbors"""
+
+    results: list[dict]
+    missing_ids: list[str]
+
+
+def hydrate_neighbors(neighbors, max_results: int = 10) -> HydratedNeighbors:
+    """Gets the products for a list of Vector Search neighbors
+       with a single query, preserving the neighbors rank order.
+
+    Args:
+        neighbors:
+            Neighbors returned by Vector Search
+            (nearest_neighbors[0].neighbors)
+        max_results: int
+            Maximum number of neighbors to hydrate
+
+    Returns:
+        HydratedNeighbors
+            results: list of dicts with the datapoint id, the neighbor
+            distance and the product snapshot (empty if not found),
+            in rank order.
+            missing_ids: datapoint ids not found in the database.
+
+    """
+    neighbors = list(neighbors)[:max_results]
+    datapoint_ids = [n.datapoint.datapoint_id for n in neighbors]
+    products = {}
+    if datapoint_ids:
+        products = {
+            product["id"]: product
+            for product in get_products([int(i) for i in datapoint_ids])
+        }
+
+    results = []
+    missing_ids = []
+    for neighbor, datapoint_id in zip(neighbors, datapoint_ids):
+        snapshot = products.get(int(datapoint_id), {})
+        if not snapshot:
+            missing_ids.append(datapoint_id)
+        results.append(
+            {
+                "id": datapoint_id,
+                "distance": neighbor.distance,
+                "snapshot": snapshot,
+            }
+        )
+    return HydratedNeighbors(results=results, missing_ids=missing_ids)
+
@@ -17,7 +17,9 @@ Utils for Cloud Translation API
 
 from google.cloud import translate_v2 as translate
 
-translate_client = translate.Client()
+from app.utils.utils_lazy import lazy
+
+translate_client = lazy(translate.Client)
 
 
 def translate_text_cloud_api(
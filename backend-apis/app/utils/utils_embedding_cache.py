@@ -0,0 +1,292 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Content-hash cache of text and image embeddings
+
+Embeddings are keyed by the model id and the SHA-256 of the normalized
+text or of the image bytes, and stored as float32 vectors:
+- in an in-process LRU tier
+- optionally, in a memory-mapped file on disk (a ring buffer of
+  `memmap_capacity` vectors with a shelve index), so warm embeddings
+  survive restarts. The disk tier is meant for a single process.
+"""
+
+import hashlib
+import os
+import shelve
+import threading
+import tomllib
+import unicodedata
+
+import numpy as np
+
+from app.utils.utils_cache import TTLCache
+from app.utils.utils_metrics import register_metrics
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    embedding_cache_cfg = config.get("embedding_cache", {})
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes a text before hashing it: NFC, collapsed whitespace
+
+    Args:
+        text: str
+            Text
+
+    Returns:
+        str
+            Normalized text
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_key(model: str, text: str = "", image_bytes: bytes = b"") -> str:
+    """Builds the cache key of a text or an image embedding
+
+    Args:
+        model: str
+            Model id, including any parameter that changes the embedding
+        text: str
+            Text
+        image_bytes: bytes
+            Image bytes
+
+    Returns:
+        str
+            Cache key
+    """
+    if image_bytes:
+        content = b"image\0" + image_bytes
+    else:
+        content = b"text\0" + normalize_text(text).encode("utf-8")
+    return f"{model}:{hashlib.sha256(content).hexdigest()}"
+
+
+class MemmapVectorStore:
+    """Fixed size store of float32 vectors in a memory-mapped file.
+
+    Vectors are written in a ring buffer: when the store is full, the
+    oldest vector is overwritten.
+    """
+
+    def __init__(self, path: str, dim: int, capacity: int):
+        """
+        Args:
+            path: str
+                Path prefix of the vectors (.f32) and index files
+            dim: int
+                Dimension of the vectors
+            capacity: int
+                Number of vectors of the store
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.dim = dim
+        self.capacity = capacity
+        vectors_path = f"{path}.f32"
+        size = capacity * dim * np.dtype(np.float32).itemsize
+        reuse = (
+            os.path.exists(vectors_path)
+            and os.path.getsize(vectors_path) == size
+        )
+        self._vectors = np.memmap(
+            vectors_path,
+            dtype=np.float32,
+            mode="r+" if reuse else "w+",
+            shape=(capacity, dim),
+        )
+        self._index = shelve.open(f"{path}.idx", flag="c" if reuse else "n")
+        self._next = self._index.get("__next__", 0)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Gets a copy of a stored vector
+
+        Args:
+            key: str
+                Cache key
+
+        Returns:
+            np.ndarray | None
+                Vector, or None if missing
+        """
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None:
+                return None
+            return np.array(self._vectors[slot])
+
+    def set(self, key: str, vector: np.ndarray):
+        """Stores a vector, overwriting the oldest one if full
+
+        Args:
+            key: str
+                Cache key
+            vector: np.ndarray
+                Vector of dimension `dim`
+        """
+        if vector.shape != (self.dim,):
+            return
+        with self._lock:
+            if key in self._index:
+                return
+            slot = self._next
+            previous_key = self._index.get(f"slot:{slot}")
+            if previous_key is not None:
+                self._index.pop(previous_key, None)
+            self._vectors[slot] = vector
+            self._index[key] = slot
+            self._index[f"slot:{slot}"] = key
+            self._next = (slot + 1) % self.capacity
+            self._index["__next__"] = self._next
+
+    def close(self):
+        """Flushes the vectors and closes the index"""
+        with self._lock:
+            self._vectors.flush()
+            self._index.close()
+
+
+class EmbeddingCache:
+    """Embeddings of a model, in an LRU tier and an optional disk tier"""
+
+    def __init__(
+        self,
+        model: str,
+        max_entries: int = 5000,
+        disk_tier: MemmapVectorStore | None = None,
+    ):
+        """
+        Args:
+            model: str
+                Model id, used in the keys
+            max_entries: int
+                Size of the LRU tier. 0 disables the cache.
+            disk_tier: MemmapVectorStore | None
+                Memory-mapped tier
+        """
+        self.model = model
+        self.enabled = max_entries > 0
+        self.memory = TTLCache(max_size=max_entries, ttl_seconds=float("inf"))
+        self.disk = disk_tier
+        self.disk_hits = 0
+
+    def key(self, text: str = "", image_bytes: bytes = b"") -> str:
+        """Builds the key of a text or an image of this model"""
+        return embedding_key(self.model, text, image_bytes)
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Gets a cached embedding
+
+        Args:
+            key: str
+                Cache key
+
+        Returns:
+            np.ndarray | None
+                Read-only float32 vector, or None if missing
+        """
+        if not self.enabled:
+            return None
+        vector = self.memory.get(key)
+        if vector is None and self.disk is not None:
+            vector = self.disk.get(key)
+            if vector is not None:
+                self.disk_hits += 1
+                vector.setflags(write=False)
+                self.memory.set(key, vector)
+        return vector
+
+    def set(self, key: str, vector):
+        """Stores an embedding as a float32 vector
+
+        Args:
+            key: str
+                Cache key
+            vector:
+                Embedding values
+        """
+        if not self.enabled:
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        self.memory.set(key, vector)
+        if self.disk is not None:
+            self.disk.set(key, vector)
+
+    def stats(self) -> dict:
+        """Returns the cache counters
+
+        Returns:
+            dict
+                Counters of the LRU tier and hits of the disk tier
+        """
+        return {**self.memory.stats(), "disk_hits": self.disk_hits}
+
+
+def create_embedding_cache(model: str, dim: int, cfg: dict) -> EmbeddingCache:
+    """Creates the embedding cache of a model from the [embedding_cache]
+       section of config.toml
+
+    Args:
+        model: str
+            Model id
+        dim: int
+            Dimension of the embeddings, used by the disk tier
+        cfg: dict
+            [embedding_cache] section
+
+    Returns:
+        EmbeddingCache
+    """
+    if not cfg.get("enabled", True):
+        return EmbeddingCache(model, max_entries=0)
+
+    disk_tier = None
+    if cfg.get("memmap_dir"):
+        disk_tier = MemmapVectorStore(
+            path=os.path.join(
+                cfg["memmap_dir"], model.replace("/", "_").replace("@", "_")
+            ),
+            dim=dim,
+            capacity=cfg.get("memmap_capacity", 100000),
+        )
+    return EmbeddingCache(
+        model, max_entries=cfg.get("max_entries", 5000), disk_tier=disk_tier
+    )
+
+
+multimodal_embedding_cache = create_embedding_cache(
+    "multimodalembedding@001", 1408, embedding_cache_cfg
+)
+text_embedding_cache = create_embedding_cache(
+    "textembedding-gecko@003/CLUSTERING", 768, embedding_cache_cfg
+)
+
+
+def get_embedding_cache_stats() -> dict:
+    """Gets the embedding cache counters
+
+    Returns:
+        dict
+            Counters of the multimodal and text embedding caches
+    """
+    return {
+        "multimodal": multimodal_embedding_cache.stats(),
+        "text": text_embedding_cache.stats(),
+    }
+
+
+register_metrics("embedding_cache", get_embedding_cache_stats)
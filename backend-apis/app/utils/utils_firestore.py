@@ -0,0 +1,73 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Utils for batched Firestore reads
+"""
+
+from google.cloud import firestore
+
+from app.utils.utils_cache import TTLCache
+
+
+def get_documents(
+    client: firestore.Client,
+    collection: str,
+    document_ids: list[str],
+    field_paths: list[str] | None = None,
+    cache: TTLCache | None = None,
+) -> list[dict | None]:
+    """Gets several documents of a collection with a single get_all call,
+    in the order of the ids
+
+    Args:
+        client: firestore.Client
+            Firestore client
+        collection: str
+            Collection name
+        document_ids: list[str]
+            Document ids
+        field_paths: list[str] | None
+            Fields to read. None reads the whole documents.
+        cache: TTLCache | None
+            Documents cache, keyed by collection and document id. Only for
+            collections that do not change, as it is not invalidated.
+
+    Returns:
+        list[dict | None]
+            Document of each id, None if it does not exist
+    """
+    documents = {}
+    missing_ids = []
+    for document_id in dict.fromkeys(document_ids):
+        document = cache.get((collection, document_id)) if cache else None
+        if document is None:
+            missing_ids.append(document_id)
+        else:
+            documents[document_id] = document
+
+    if missing_ids:
+        collection_ref = client.collection(collection)
+        snapshots = client.get_all(
+            [collection_ref.document(i) for i in missing_ids],
+            field_paths=field_paths,
+        )
+        # get_all returns the snapshots in any order
+        for snapshot in snapshots:
+            if not snapshot.exists:
+                continue
+            documents[snapshot.id] = snapshot.to_dict()
+            if cache:
+                cache.set((collection, snapshot.id), documents[snapshot.id])
+
+    return [documents.get(document_id) for document_id in document_ids]
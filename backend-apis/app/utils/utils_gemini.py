@@ -16,13 +16,25 @@
 Utils module for Vertex AI Gemini
 """
 import asyncio
-import functools
+import json
+from typing import Iterable, Iterator
+
 from google.api_core.exceptions import GoogleAPICallError
 from vertexai.generative_models._generative_models import GenerationResponse
 from vertexai.preview.generative_models import GenerativeModel
 
-gemini_pro_vision = GenerativeModel("gemini-1.5-pro")
-gemini_pro_text = GenerativeModel("gemini-1.5-pro")
+from app.utils.utils_cache import llm_response_cache
+from app.utils.utils_lazy import lazy
+from app.utils.utils_llm_executor import llm_executor
+from app.utils.utils_singleflight import get_group
+
+# Identical concurrent prompts share one Gemini call
+llm_singleflight = get_group("llm")
+
+GEMINI_PRO_TEXT_MODEL = "gemini-1.5-pro"
+
+gemini_pro_vision = lazy(lambda: GenerativeModel("gemini-1.5-pro"))
+gemini_pro_text = lazy(lambda: GenerativeModel(GEMINI_PRO_TEXT_MODEL))
 
 def generate_gemini_pro_vision(contents: list) -> GenerationResponse:
     """
@@ -50,35 +62,158 @@ def generate_gemini_pro_text(
         temperature: float = 0.2,
         top_k: int = 40,
         top_p: float = 0.9,
-        candidate_count: int = 1
+        candidate_count: int = 1,
+        use_cache: bool = False,
+        cache_ttl_seconds: float | None = None,
 ) -> str:
     """
     Args:
         prompt:
+        use_cache:
+            Serve identical requests from the LLM response cache. Only
+            for deterministic prompts, e.g. product summaries.
+        cache_ttl_seconds:
+            TTL of the cached response. Defaults to the cache TTL.
 
     Returns:
         LLM response
     """
-    response = gemini_pro_text.generate_content(
-        contents=[prompt],
-        generation_config={
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
-            "candidate_count": candidate_count,
-            "max_output_tokens": max_output_tokens,
-        }
+    generation_config = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "candidate_count": candidate_count,
+        "max_output_tokens": max_output_tokens,
+    }
+    key = llm_response_cache.make_key(
+        GEMINI_PRO_TEXT_MODEL, generation_config, prompt
     )
+    if use_cache:
+        cached_response = llm_response_cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    def generate() -> str:
+        response = gemini_pro_text.generate_content(
+            contents=[prompt],
+            generation_config=generation_config
+        )
+        if use_cache and response.text:
+            llm_response_cache.set(key, response.text, cache_ttl_seconds)
+        return response.text
+
+    return llm_singleflight.do(key, generate)
+
+
+def stream_gemini_pro_text(
+        prompt: str,
+        max_output_tokens: int = 2048,
+        temperature: float = 0.2,
+        top_k: int = 40,
+        top_p: float = 0.9,
+        use_cache: bool = False,
+        cache_ttl_seconds: float | None = None,
+) -> Iterator[str]:
+    """Streams the response of Gemini as it is generated.
+
+    Cached responses are returned as a single chunk. If the stream fails
+    before the first chunk, the response is generated without streaming.
+    A slot of the model limiter (see utils_llm_executor) is held while
+    the response is streamed.
+
+    Args:
+        prompt:
+        use_cache:
+            Serve identical requests from the LLM response cache. Only
+            for deterministic prompts, e.g. product summaries.
+        cache_ttl_seconds:
+            TTL of the cached response. Defaults to the cache TTL.
+
+    Yields:
+        Text chunks of the LLM response
+    """
+    # Same parameters as generate_gemini_pro_text, to share the cache
+    generation_config = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "candidate_count": 1,
+        "max_output_tokens": max_output_tokens,
+    }
+    cache_key = ""
+    if use_cache:
+        cache_key = llm_response_cache.make_key(
+            GEMINI_PRO_TEXT_MODEL, generation_config, prompt
+        )
+        cached_response = llm_response_cache.get(cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+    chunks = []
+    # The model slot is held until the stream is consumed or closed
+    with llm_executor.hold(GEMINI_PRO_TEXT_MODEL):
+        try:
+            for response in gemini_pro_text.generate_content(
+                contents=[prompt],
+                generation_config=generation_config,
+                stream=True,
+            ):
+                try:
+                    chunk = response.text
+                except ValueError:
+                    # Chunks without text, e.g. the final finish reason
+                    continue
+                chunks.append(chunk)
+                yield chunk
+        except GoogleAPICallError as e:
+            if chunks:
+                raise
+            print(f"Streaming failed, generating without streaming. {e}")
+            response = gemini_pro_text.generate_content(
+                contents=[prompt],
+                generation_config=generation_config,
+            )
+            chunks.append(response.text)
+            yield response.text
+
+    if cache_key and chunks:
+        llm_response_cache.set(cache_key, "".join(chunks), cache_ttl_seconds)
+
+
+def to_sse_events(chunks: Iterable[str]) -> Iterator[str]:
+    """Formats text chunks as server-sent events.
 
-    return response.text
+    Each chunk is sent as a JSON `{"text": ...}` data event. The stream
+    ends with a `done` event, or an `error` event if generation failed.
+
+    Args:
+        chunks:
+            Text chunks
+
+    Yields:
+        Server-sent events
+    """
+    try:
+        for chunk in chunks:
+            yield f"data: {json.dumps({'text': chunk})}\n\n"
+    except GoogleAPICallError as e:
+        print(e)
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+        return
+    yield "event: done\ndata: {}\n\n"
 
 
 async def async_predict_text_llm(
     prompt: str,
-    max_output_tokens: int = 1024,
-    temperature: float = 0.2,
-    top_k: int = 40,
-    top_p: float = 0.8,
+    max_output_tokens: int | None = None,
+    temperature: float | None = None,
+    top_k: int | None = None,
+    top_p: float | None = None,
+    use_cache: bool = False,
+    cache_ttl_seconds: float | None = None,
+    timeout: float | None = None,
+    response_mime_type: str | None = None,
 ) -> str:
     """
 
@@ -89,13 +224,44 @@ async def async_predict_text_llm(
         temperature:
         top_k:
         top_p:
+            Generation parameters. Only the ones given are sent, the
+            others keep the model defaults.
+        use_cache:
+            Serve identical requests from the LLM response cache. Only
+            for deterministic prompts, e.g. product summaries.
+        cache_ttl_seconds:
+            TTL of the cached response. Defaults to the cache TTL.
+        timeout:
+            Seconds to wait for the response. An empty string is
+            returned on timeout, and when the call fails or the response
+            has no text.
+        response_mime_type:
+            Response MIME type, e.g. "application/json" for JSON mode
 
     Returns:
 
     """
-    loop = asyncio.get_running_loop()
-    generated_response = None
-    try:
+    generation_config = {
+        name: value
+        for name, value in {
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "max_output_tokens": max_output_tokens,
+            "response_mime_type": response_mime_type,
+        }.items()
+        if value is not None
+    }
+
+    key = llm_response_cache.make_key(
+        GEMINI_PRO_TEXT_MODEL, generation_config, prompt
+    )
+    if use_cache:
+        cached_response = llm_response_cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    async def generate() -> str:
         """
         generate_content(
             contents: content_types.ContentsType,
@@ -108,27 +274,45 @@ async def async_predict_text_llm(
             request_options: (helper_types.RequestOptionsType | None) = None
         ) -> generation_types.GenerateContentResponse
         """
-        generated_response = await loop.run_in_executor(
-            None,
-            functools.partial(
-                gemini_pro_text.generate_content,
-                contents=prompt
-            ),
+        generated_response = await llm_executor.run(
+            GEMINI_PRO_TEXT_MODEL,
+            gemini_pro_text.generate_content,
+            contents=prompt,
+            generation_config=generation_config or None,
         )
-    except GoogleAPICallError as e:
-        print(e)
-        return ""
-
-    if generated_response and generated_response.text:
+        if not (generated_response and generated_response.text):
+            return ""
         generated_response = generated_response.text.replace("```json", "")
         generated_response = generated_response.replace("```JSON", "")
         generated_response = generated_response.replace("```", "")
+        if use_cache:
+            llm_response_cache.set(key, generated_response, cache_ttl_seconds)
         return generated_response
-    return ""
+
+    try:
+        # Each caller applies its own timeout to the shared call
+        return await asyncio.wait_for(
+            llm_singleflight.do_async(key, generate), timeout
+        )
+    except GoogleAPICallError as e:
+        print(e)
+        return ""
+    except asyncio.TimeoutError:
+        print(f"Gemini call timed out after {timeout} seconds")
+        return ""
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # e.g. ValueError reading the text of a blocked response
+        print(f"Gemini call failed. {e!r}")
+        return ""
 
 
 async def run_predict_text_llm(
-    prompts: list, temperature: float = 0.2
+    prompts: list,
+    temperature: float | None = None,
+    use_cache: bool = False,
+    cache_ttl_seconds: float | None = None,
+    max_output_tokens: int | None = None,
+    timeout: float | None = None,
 ) -> list:
     """
 
@@ -136,14 +320,32 @@ async def run_predict_text_llm(
         prompts:
         model:
         temperature:
+        use_cache:
+        cache_ttl_seconds:
+        max_output_tokens:
+        timeout:
+            Seconds to wait for each response. Responses that time out
+            or fail are returned as empty strings.
 
     Returns:
 
     """
     tasks = [
-        async_predict_text_llm(prompt=prompt, temperature=temperature)
+        async_predict_text_llm(
+            prompt=prompt,
+            temperature=temperature,
+            use_cache=use_cache,
+            cache_ttl_seconds=cache_ttl_seconds,
+            max_output_tokens=max_output_tokens,
+            timeout=timeout,
+        )
         for prompt in prompts
     ]
-    results = await asyncio.gather(*tasks)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # One failed prompt must not fail the others
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Gemini call failed. {result!r}")
+            results[index] = ""
     return results
 
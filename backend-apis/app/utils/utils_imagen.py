@@ -17,7 +17,6 @@ Utils for Imagen
 """
 
 import asyncio
-import functools
 import tomllib
 import uuid
 
@@ -28,18 +27,25 @@ from requests.exceptions import ReadTimeout
 from vertexai.preview.vision_models import ImageGenerationModel
 from vertexai.vision_models import Image, ImageCaptioningModel
 
+from app.utils.utils_llm_executor import llm_executor
+from app.utils.utils_lazy import lazy
+
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
 
 images_bucket_name = config["global"]["images_bucket_name"]
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(images_bucket_name)
+storage_client = lazy(storage.Client)
+bucket = lazy(lambda: storage_client.bucket(images_bucket_name))
+
+vision_client = lazy(vision.ImageAnnotatorClient)
+IMAGE_CAPTION_MODEL = "imagetext"
 
-vision_client = vision.ImageAnnotatorClient()
-image_caption_model = ImageCaptioningModel.from_pretrained("imagetext")
-image_generate_model = ImageGenerationModel.from_pretrained(
-    "imagegeneration@002"
+image_caption_model = lazy(
+    lambda: ImageCaptioningModel.from_pretrained(IMAGE_CAPTION_MODEL)
+)
+image_generate_model = lazy(
+    lambda: ImageGenerationModel.from_pretrained("imagegeneration@002")
 )
 
 
@@ -126,16 +132,13 @@ async def async_get_image_captions(image_bytes: bytes) -> list:
     Returns:
 
     """
-    loop = asyncio.get_running_loop()
     try:
-        captions = await loop.run_in_executor(
-            None,
-            functools.partial(
-                image_caption_model.get_captions,
-                image=Image(image_bytes=image_bytes),
-                number_of_results=1,
-                language="en",
-            ),
+        captions = await llm_executor.run(
+            IMAGE_CAPTION_MODEL,
+            image_caption_model.get_captions,
+            image=Image(image_bytes=image_bytes),
+            number_of_results=1,
+            language="en",
         )
         if not captions:
             return ["awesome funiture product"]
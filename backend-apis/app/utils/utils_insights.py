@@ -0,0 +1,181 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Utils for conversations and reviews insights
+
+Two generation modes are available:
+- parts: one Gemini call per part, all sent concurrently
+- bundle: a single Gemini call returning every part in a JSON object.
+  Parts missing from the JSON object are generated individually.
+"""
+
+import asyncio
+import json
+from json import JSONDecodeError
+
+from fastapi import HTTPException
+
+from app.utils import utils_cloud_nlp, utils_gemini
+
+INSIGHTS_PARTS = ("summary", "insights", "pending_tasks", "next_best_action")
+
+
+def parse_insights_bundle(response: str) -> tuple[dict, list]:
+    """Parses and validates the JSON object of a bundle response
+
+    Args:
+        response: str
+            Gemini response
+
+    Returns:
+        tuple[dict, list]
+            Valid parts and names of the missing or invalid parts
+    """
+    try:
+        bundle = json.loads(response)
+    except JSONDecodeError as e:
+        print(f"Invalid insights bundle. {e}")
+        bundle = {}
+    if not isinstance(bundle, dict):
+        bundle = {}
+
+    parts = {}
+    invalid_parts = []
+    for name in INSIGHTS_PARTS:
+        value = bundle.get(name)
+        if isinstance(value, str) and value.strip():
+            parts[name] = value
+        else:
+            invalid_parts.append(name)
+    return parts, invalid_parts
+
+
+async def _analyze_entities(input_text: str, timeout: float | None):
+    try:
+        return await utils_cloud_nlp.async_nlp_analyze_entities(
+            input_text, timeout=timeout
+        )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"Error calling Google Cloud NL API. {e!r}")
+        return None
+
+
+async def _generate_parts(
+    prompts: dict[str, str], input_text: str, timeout: float | None
+) -> dict:
+    texts = await utils_gemini.run_predict_text_llm(
+        prompts=[prompt.format(input_text) for prompt in prompts.values()],
+        max_output_tokens=2048,
+        timeout=timeout,
+    )
+    return dict(zip(prompts.keys(), texts))
+
+
+def _insights_result(parts: dict, entities: list | None) -> dict:
+    failed_parts = [name for name in INSIGHTS_PARTS if not parts.get(name)]
+    if entities is None:
+        failed_parts.append("entities")
+    if len(failed_parts) == len(INSIGHTS_PARTS) + 1:
+        raise HTTPException(
+            status_code=400,
+            detail="Error generating insights with Gemini and Cloud NL API.",
+        )
+    return {
+        **{name: parts.get(name, "") for name in INSIGHTS_PARTS},
+        "entities": entities or [],
+        "failed_parts": failed_parts,
+    }
+
+
+async def generate_insights(
+    prompts: dict[str, str], input_text: str, timeout: float | None = None
+) -> dict:
+    """Generates all the insights parts concurrently.
+
+    Parts that fail or time out are returned empty and listed in
+    failed_parts.
+
+    Args:
+        prompts: dict[str, str]
+            Prompt template of each part (summary, insights, ...)
+        input_text: str
+            Conversations or reviews JSON
+        timeout: float | None
+            Seconds to wait for each part
+
+    Raises:
+        HTTPException:
+            If every part failed
+
+    Returns:
+        dict
+            Parts, entities and failed_parts
+    """
+    parts, entities = await asyncio.gather(
+        _generate_parts(prompts, input_text, timeout),
+        _analyze_entities(input_text, timeout),
+    )
+    return _insights_result(parts, entities)
+
+
+async def generate_insights_bundle(
+    bundle_prompt: str,
+    prompts: dict[str, str],
+    input_text: str,
+    timeout: float | None = None,
+) -> dict:
+    """Generates all the insights parts with a single JSON mode call.
+
+    Parts missing from the response, or that are not a non-empty string,
+    are generated individually with their own prompt.
+
+    Args:
+        bundle_prompt: str
+            Prompt template asking for every part in a JSON object
+        prompts: dict[str, str]
+            Prompt template of each part, used for the retries
+        input_text: str
+            Conversations or reviews JSON
+        timeout: float | None
+            Seconds to wait for the bundle and for each retry
+
+    Raises:
+        HTTPException:
+            If every part failed
+
+    Returns:
+        dict
+            Parts, entities and failed_parts
+    """
+    response, entities = await asyncio.gather(
+        utils_gemini.async_predict_text_llm(
+            prompt=bundle_prompt.format(input_text),
+            max_output_tokens=8192,
+            timeout=timeout,
+            response_mime_type="application/json",
+        ),
+        _analyze_entities(input_text, timeout),
+    )
+
+    parts, invalid_parts = parse_insights_bundle(response)
+    if invalid_parts:
+        print(f"Retrying insights parts: {invalid_parts}")
+        parts.update(
+            await _generate_parts(
+                {name: prompts[name] for name in invalid_parts},
+                input_text,
+                timeout,
+            )
+        )
+    return _insights_result(parts, entities)
@@ -0,0 +1,204 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Lazy, thread-safe initialization of clients and models
+
+Module level clients are declared with `lazy(factory)`. The factory runs
+on first attribute access instead of at import, which keeps the import of
+app.main (and the Cloud Run cold start) free of network calls. The proxy
+forwards every attribute to the created object, so call sites do not
+change.
+
+Measure the import time of each module with:
+    python -m app.utils.utils_lazy
+
+genai-for-marketing/backend_apis/app/utils_lazy.py is a copy of this
+module, change both.
+"""
+
+import argparse
+import importlib
+import sys
+import threading
+import time
+import typing
+
+_lazy_clients: list["LazyClient"] = []
+_lazy_clients_lock = threading.Lock()
+
+
+class LazyClient:
+    """Proxy that creates its object on first use"""
+
+    def __init__(self, factory: typing.Callable, name: str = ""):
+        """
+        Args:
+            factory: typing.Callable
+                Function without arguments that creates the object
+            name: str
+                Name used in the initialization stats
+        """
+        self._factory = factory
+        self._name = name or getattr(factory, "__qualname__", repr(factory))
+        self._instance = None
+        self._init_seconds = None
+        self._lock = threading.Lock()
+        with _lazy_clients_lock:
+            _lazy_clients.append(self)
+
+    def get(self):
+        """Gets the object, creating it on first use
+
+        Returns:
+            The object created by the factory
+        """
+        instance = self._instance
+        if instance is not None:
+            return instance
+        with self._lock:
+            if self._instance is None:
+                started_at = time.perf_counter()
+                self._instance = self._factory()
+                self._init_seconds = time.perf_counter() - started_at
+            return self._instance
+
+    @property
+    def initialized(self) -> bool:
+        """True if the object was created"""
+        return self._instance is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+    def __repr__(self) -> str:
+        state = "initialized" if self.initialized else "not initialized"
+        return f"<LazyClient {self._name} ({state})>"
+
+
+def lazy(factory: typing.Callable, name: str = "") -> typing.Any:
+    """Declares an object created on first use
+
+    Args:
+        factory: typing.Callable
+            Function without arguments that creates the object, e.g.
+            firestore.Client
+        name: str
+            Name used in the initialization stats
+
+    Returns:
+        typing.Any
+            Proxy of the object
+    """
+    return LazyClient(factory, name)
+
+
+def get_lazy_clients_stats() -> list[dict]:
+    """Gets the initialization state and time of the lazy clients
+
+    Returns:
+        list[dict]
+            Name, initialized flag and initialization time of each client
+    """
+    with _lazy_clients_lock:
+        clients = list(_lazy_clients)
+    return [
+        {
+            "name": client._name,  # pylint: disable=protected-access
+            "initialized": client.initialized,
+            "init_ms": (
+                client._init_seconds * 1000  # pylint: disable=protected-access
+                if client.initialized
+                else None
+            ),
+        }
+        for client in clients
+    ]
+
+
+def benchmark_imports(modules: list[str]) -> list[tuple[str, float]]:
+    """Imports modules one by one and measures the time of each import.
+
+    Dependencies imported by an earlier module are not measured again, so
+    run it in a fresh interpreter.
+
+    Args:
+        modules: list[str]
+            Module names, in import order
+
+    Returns:
+        list[tuple[str, float]]
+            Module name and import time in seconds
+    """
+    timings = []
+    for module in modules:
+        started_at = time.perf_counter()
+        importlib.import_module(module)
+        timings.append((module, time.perf_counter() - started_at))
+    return timings
+
+
+STARTUP_MODULES = [
+    "app.utils.utils_cache",
+    "app.utils.utils_llm_executor",
+    "app.utils.utils_cloud_sql",
+    "app.utils.utils_gemini",
+    "app.utils.utils_palm",
+    "app.utils.utils_imagen",
+    "app.utils.utils_cloud_nlp",
+    "app.utils.utils_search",
+    "app.utils.utils_workspace",
+    "app.utils.utils_salesforce",
+    "app.utils.utils_sentiment",
+    "app.routers.p1_customer",
+    "app.routers.p2_content_creator",
+    "app.routers.p4_customer_service_agent",
+    "app.routers.p5_contact_center_analyst",
+    "app.routers.p6_field_service_agent",
+    "app.routers.p7_return_agent",
+    "app.main",
+]
+
+
+def main():
+    """Prints the import time of each module of the app"""
+    parser = argparse.ArgumentParser(
+        description="Measure the import time of the app modules"
+    )
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=STARTUP_MODULES,
+        help="Modules to import, in order",
+    )
+    args = parser.parse_args()
+
+    already_imported = [m for m in args.modules if m in sys.modules]
+    if already_imported:
+        print(f"Already imported, not measured: {already_imported}")
+
+    total = 0.0
+    for module, seconds in benchmark_imports(args.modules):
+        total += seconds
+        print(f"{seconds * 1000:10.1f} ms  {module}")
+    print(f"{total * 1000:10.1f} ms  total")
+
+    initialized = [
+        client for client in get_lazy_clients_stats() if client["initialized"]
+    ]
+    if initialized:
+        print(f"Clients initialized during import: {initialized}")
+
+
+if __name__ == "__main__":
+    main()
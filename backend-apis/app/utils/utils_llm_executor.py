@@ -0,0 +1,346 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shared execution layer for blocking model calls (Gemini, PaLM, Imagen)
+
+Calls run on a dedicated, sized thread pool. Before a call is submitted,
+it waits in the event loop for a slot of its model semaphore and for a
+token of its model rate limiter, so a busy model does not hold threads
+needed by the other models. The limits are shared by every event loop of
+the process, including the ones created with asyncio.run by sync routes.
+
+genai-for-marketing/backend_apis/app/utils_llm_executor.py is a copy of this
+module, change both.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import threading
+import time
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.utils_metrics import register_metrics
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    llm_executor_cfg = config.get("llm_executor", {})
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    Tokens are added at `rate` per second, up to `burst` tokens. A rate of
+    0 disables the limiter.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Takes a token if one is available
+
+        Returns:
+            float
+                0 if a token was taken, otherwise the seconds to wait
+                before the next token is available
+        """
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated_at) * self.rate,
+            )
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        """Waits until a token is available and takes it"""
+        while (delay := self.try_acquire()) > 0:
+            await asyncio.sleep(delay)
+
+
+class CrossLoopSemaphore:
+    """Asyncio semaphore that can be shared by several event loops running
+    in different threads."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: collections.deque = collections.deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        """Waits for a slot and takes it"""
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+                    raise
+            # The slot was handed over before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """Releases a slot, handing it over to the oldest waiter"""
+        with self._lock:
+            if not self._waiters:
+                self._value += 1
+                return
+            future = self._waiters.popleft()
+        try:
+            future.get_loop().call_soon_threadsafe(self._wake, future)
+        except RuntimeError:
+            # Event loop of the waiter is closed
+            self.release()
+
+    def _wake(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *_):
+        self.release()
+
+
+class ModelLimiter:
+    """Concurrency and rate limits of a single model, with its metrics"""
+
+    def __init__(
+        self, max_concurrency: int, requests_per_minute: float = 0
+    ):
+        self.max_concurrency = max_concurrency
+        self.semaphore = CrossLoopSemaphore(max_concurrency)
+        self.bucket = TokenBucket(
+            rate=requests_per_minute / 60,
+            burst=max_concurrency,
+        )
+        self.queued = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.lock = threading.Lock()
+
+    def stats(self) -> dict:
+        """Returns the limiter counters
+
+        Returns:
+            dict
+                Queue depth, in flight calls and wait times
+        """
+        with self.lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "errors": self.errors,
+                "wait_avg_ms": (
+                    self.wait_total / self.calls * 1000 if self.calls else 0.0
+                ),
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+
+class LlmExecutor:
+    """Runs blocking model calls on a dedicated thread pool, limited per
+    model by a semaphore and a token bucket."""
+
+    def __init__(self, max_workers: int = 32, models: dict | None = None):
+        """
+        Args:
+            max_workers: int
+                Size of the thread pool
+            models: dict | None
+                Limits per model name: max_concurrency and
+                requests_per_minute. The "default" entry applies to the
+                models that are not listed.
+        """
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="llm"
+        )
+        self.models_cfg = models or {}
+        self._limiters: dict[str, ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model: str) -> ModelLimiter:
+        """Gets the limiter of a model
+
+        Args:
+            model: str
+                Model name
+
+        Returns:
+            ModelLimiter
+        """
+        with self._lock:
+            if model not in self._limiters:
+                model_cfg = self.models_cfg.get(
+                    model, self.models_cfg.get("default", {})
+                )
+                self._limiters[model] = ModelLimiter(
+                    max_concurrency=model_cfg.get(
+                        "max_concurrency", self.max_workers
+                    ),
+                    requests_per_minute=model_cfg.get(
+                        "requests_per_minute", 0
+                    ),
+                )
+            return self._limiters[model]
+
+    async def _acquire(self, limiter: ModelLimiter):
+        """Waits for a slot of the model semaphore and a token of its rate
+        limiter"""
+        enqueued_at = time.monotonic()
+        with limiter.lock:
+            limiter.queued += 1
+        try:
+            await limiter.semaphore.acquire()
+            try:
+                await limiter.bucket.acquire()
+            except BaseException:
+                limiter.semaphore.release()
+                raise
+        finally:
+            with limiter.lock:
+                limiter.queued -= 1
+        wait = time.monotonic() - enqueued_at
+        with limiter.lock:
+            limiter.calls += 1
+            limiter.wait_total += wait
+            limiter.wait_max = max(limiter.wait_max, wait)
+            limiter.in_flight += 1
+
+    def _release(self, limiter: ModelLimiter, failed: bool):
+        with limiter.lock:
+            limiter.in_flight -= 1
+            if failed:
+                limiter.errors += 1
+        limiter.semaphore.release()
+
+    async def run(self, model: str, func, /, *args, **kwargs):
+        """Runs a blocking model call
+
+        Args:
+            model: str
+                Model name, used to select the limiter
+            func:
+                Blocking function
+            *args:
+                Positional arguments of func
+            **kwargs:
+                Keyword arguments of func
+
+        Returns:
+            The result of func
+        """
+        limiter = self.limiter(model)
+        loop = asyncio.get_running_loop()
+        await self._acquire(limiter)
+        failed = False
+        try:
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            )
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._release(limiter, failed)
+
+    @contextlib.contextmanager
+    def hold(self, model: str):
+        """Holds a slot of a model for a call made by the caller thread,
+        e.g. a response stream consumed by a sync generator. Must not be
+        used from an event loop thread.
+
+        Args:
+            model: str
+                Model name, used to select the limiter
+        """
+        limiter = self.limiter(model)
+        asyncio.run(self._acquire(limiter))
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._release(limiter, failed)
+
+    def stats(self) -> dict:
+        """Returns the executor and per model counters
+
+        Returns:
+            dict
+                Executor queue depth and the counters of each model
+        """
+        with self._lock:
+            limiters = dict(self._limiters)
+        # pylint: disable-next=protected-access
+        queue_depth = self.executor._work_queue.qsize()
+        return {
+            "max_workers": self.max_workers,
+            "executor_queue_depth": queue_depth,
+            "models": {
+                model: limiter.stats() for model, limiter in limiters.items()
+            },
+        }
+
+
+llm_executor = LlmExecutor(
+    max_workers=llm_executor_cfg.get("max_workers", 32),
+    models=llm_executor_cfg.get("models", {}),
+)
+
+
+def get_llm_executor_stats() -> dict:
+    """Gets the LLM executor counters
+
+    Returns:
+        dict
+            Executor queue depth and per model queue depth, in flight
+            calls and wait times
+    """
+    return llm_executor.stats()
+
+
+register_metrics("llm_executor", get_llm_executor_stats)
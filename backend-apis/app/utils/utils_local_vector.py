@@ -0,0 +1,346 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-process nearest neighbor index, a stand-in for Vector Search
+
+The index is built from the vector_metadata.json file written by
+deployment_scripts/vertex_vector_generate_embeddings.py (or from a JSONL
+file of {"id", "embedding"} datapoints) and scores with the dot product,
+like the deployed indexes (DOT_PRODUCT_DISTANCE). The search is exact, or
+approximate over inverted lists (IVF) when `ivf_n_lists` is set.
+
+Compare the exact and the IVF search of an index with:
+    python -m app.utils.utils_local_vector vector_metadata.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from google.cloud import aiplatform_v1
+
+
+def read_datapoints(path: str) -> tuple[list[str], np.ndarray]:
+    """Reads the datapoints of a vector_metadata.json or JSONL file
+
+    Args:
+        path: str
+            {"datapoints": [{"datapoint_id", "feature_vector"}]} JSON file,
+            or JSONL file of {"id", "embedding"} datapoints
+
+    Returns:
+        tuple[list[str], np.ndarray]
+            Datapoint ids and float32 matrix of the vectors
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    try:
+        datapoints = json.loads(content)["datapoints"]
+    except json.JSONDecodeError:
+        datapoints = [
+            json.loads(line) for line in content.splitlines() if line
+        ]
+
+    ids = [str(d.get("datapoint_id", d.get("id"))) for d in datapoints]
+    vectors = np.array(
+        [d.get("feature_vector", d.get("embedding")) for d in datapoints],
+        dtype=np.float32,
+    )
+    return ids, vectors
+
+
+def _memmap_vectors(
+    path: str, memmap_dir: str
+) -> tuple[list[str], np.ndarray]:
+    """Reads the datapoints once into a memory-mapped float32 file, reused
+    while it is newer than the source file.
+    """
+    name = os.path.basename(path)
+    vectors_path = os.path.join(memmap_dir, f"{name}.f32")
+    ids_path = os.path.join(memmap_dir, f"{name}.ids.json")
+    if (
+        os.path.exists(ids_path)
+        and os.path.exists(vectors_path)
+        and os.path.getmtime(ids_path) >= os.path.getmtime(path)
+    ):
+        with open(ids_path, "r", encoding="utf-8") as f:
+            ids = json.load(f)
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode="r")
+        return ids, vectors.reshape(len(ids), -1)
+
+    ids, vectors = read_datapoints(path)
+    os.makedirs(memmap_dir, exist_ok=True)
+    mapped = np.memmap(
+        vectors_path, dtype=np.float32, mode="w+", shape=vectors.shape
+    )
+    mapped[:] = vectors
+    mapped.flush()
+    # The ids are written last, they mark the vectors as complete
+    with open(ids_path, "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    return ids, np.memmap(
+        vectors_path, dtype=np.float32, mode="r", shape=vectors.shape
+    )
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores of each row, best first"""
+    k = min(k, scores.shape[-1])
+    if k == 0:
+        return np.empty((*scores.shape[:-1], 0), dtype=np.int64)
+    if k < scores.shape[-1]:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(
+            np.arange(scores.shape[-1]), scores.shape
+        )
+    order = np.argsort(
+        -np.take_along_axis(scores, candidates, axis=-1),
+        axis=-1,
+        kind="stable",
+    )
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+class LocalVectorIndex:
+    """Dot product nearest neighbor index over a float32 matrix"""
+
+    def __init__(
+        self,
+        ids: list[str],
+        vectors: np.ndarray,
+        ivf_n_lists: int = 0,
+        ivf_n_probe: int = 8,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            ids: list[str]
+                Datapoint id of each vector
+            vectors: np.ndarray
+                float32 matrix, one vector per row. May be memory-mapped.
+            ivf_n_lists: int
+                Inverted lists of the approximate search. 0 for an exact
+                search.
+            ivf_n_probe: int
+                Inverted lists scanned per query
+            seed: int
+                Seed of the k-means clustering of the inverted lists
+        """
+        self.ids = list(ids)
+        self.vectors = np.asanyarray(vectors, dtype=np.float32)
+        self.n_probe = ivf_n_probe
+        self.centroids = None
+        self.lists = []
+        if 0 < ivf_n_lists < len(self.ids):
+            self._build_ivf(ivf_n_lists, seed)
+
+    def _build_ivf(self, n_lists: int, seed: int, iterations: int = 10):
+        rng = np.random.default_rng(seed)
+        centroids = self.vectors[
+            rng.choice(len(self.ids), size=n_lists, replace=False)
+        ].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(self.vectors @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = self.vectors[assignments == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+        assignments = np.argmax(self.vectors @ centroids.T, axis=1)
+        self.centroids = centroids
+        self.lists = [
+            np.flatnonzero(assignments == i) for i in range(n_lists)
+        ]
+
+    def search(
+        self, queries: np.ndarray, k: int
+    ) -> tuple[list[list[str]], list[np.ndarray]]:
+        """Finds the k nearest neighbors of each query
+
+        Args:
+            queries: np.ndarray
+                Query vector, or matrix of one query per row
+            k: int
+                Number of neighbors per query
+
+        Returns:
+            tuple[list[list[str]], list[np.ndarray]]
+                Neighbor ids and dot products of each query, best first
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.centroids is None:
+            # One matrix product for all the queries
+            scores = queries @ self.vectors.T
+            indices = _top_k(scores, k)
+            return (
+                [[self.ids[i] for i in row] for row in indices],
+                list(np.take_along_axis(scores, indices, axis=1)),
+            )
+
+        probes = _top_k(queries @ self.centroids.T, self.n_probe)
+        neighbor_ids = []
+        distances = []
+        for query, query_probes in zip(queries, probes):
+            candidates = np.concatenate([self.lists[i] for i in query_probes])
+            scores = self.vectors[candidates] @ query
+            best = _top_k(scores, k)
+            neighbor_ids.append([self.ids[candidates[i]] for i in best])
+            distances.append(scores[best])
+        return neighbor_ids, distances
+
+    def find_neighbors(
+        self,
+        feature_vector: np.ndarray | list,
+        datapoint_id: str = "0",
+        neighbor_count: int = 10,
+    ) -> aiplatform_v1.FindNeighborsResponse:
+        """Finds the neighbors of a vector, in the response shape of the
+        Vector Search find_neighbors call
+
+        Args:
+            feature_vector: np.ndarray | list
+                Query vector
+            datapoint_id: str
+                Id of the query
+            neighbor_count: int
+                Number of neighbors
+
+        Returns:
+            aiplatform_v1.FindNeighborsResponse
+        """
+        return self.find_neighbors_batch(
+            [(feature_vector, datapoint_id, neighbor_count)]
+        )
+
+    def find_neighbors_batch(
+        self, queries: list[tuple]
+    ) -> aiplatform_v1.FindNeighborsResponse:
+        """Finds the neighbors of several vectors in one search, in the
+        response shape of the Vector Search find_neighbors call
+
+        Args:
+            queries: list[tuple]
+                (feature_vector, datapoint_id, neighbor_count) of each
+                query
+
+        Returns:
+            aiplatform_v1.FindNeighborsResponse
+                Nearest neighbors of each query, in order
+        """
+        if not queries:
+            return aiplatform_v1.FindNeighborsResponse()
+        neighbor_ids, distances = self.search(
+            np.stack([np.asarray(q[0], dtype=np.float32) for q in queries]),
+            max(q[2] for q in queries),
+        )
+        nearest_neighbors = []
+        for query, query_ids, query_distances in zip(
+            queries, neighbor_ids, distances
+        ):
+            _, datapoint_id, neighbor_count = query
+            nearest_neighbors.append(
+                aiplatform_v1.FindNeighborsResponse.NearestNeighbors(
+                    id=datapoint_id,
+                    neighbors=[
+                        aiplatform_v1.FindNeighborsResponse.Neighbor(
+                            datapoint=aiplatform_v1.IndexDatapoint(
+                                datapoint_id=neighbor_id
+                            ),
+                            distance=float(distance),
+                        )
+                        for neighbor_id, distance in zip(
+                            query_ids[:neighbor_count],
+                            query_distances[:neighbor_count],
+                        )
+                    ],
+                )
+            )
+        return aiplatform_v1.FindNeighborsResponse(
+            nearest_neighbors=nearest_neighbors
+        )
+
+
+def load_local_index(path: str, cfg: dict) -> LocalVectorIndex:
+    """Loads a local index from the [local_vector] section of config.toml
+
+    Args:
+        path: str
+            vector_metadata.json or JSONL datapoints file
+        cfg: dict
+            [local_vector] section
+
+    Returns:
+        LocalVectorIndex
+    """
+    if cfg.get("memmap_dir"):
+        ids, vectors = _memmap_vectors(path, cfg["memmap_dir"])
+    else:
+        ids, vectors = read_datapoints(path)
+    return LocalVectorIndex(
+        ids,
+        vectors,
+        ivf_n_lists=cfg.get("ivf_n_lists", 0),
+        ivf_n_probe=cfg.get("ivf_n_probe", 8),
+    )
+
+
+def main():
+    """Prints the latency and the recall of the exact and IVF searches"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the local nearest neighbor index"
+    )
+    parser.add_argument("path", help="vector_metadata.json file")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--neighbors", type=int, default=10)
+    parser.add_argument("--ivf-n-lists", type=int, default=16)
+    parser.add_argument("--ivf-n-probe", type=int, default=4)
+    args = parser.parse_args()
+
+    ids, vectors = read_datapoints(args.path)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.integers(len(ids), size=args.queries)]
+    queries = queries + rng.normal(0, 0.01, queries.shape).astype(np.float32)
+
+    exact = LocalVectorIndex(ids, vectors)
+    started_at = time.perf_counter()
+    expected, _ = exact.search(queries, args.neighbors)
+    seconds = time.perf_counter() - started_at
+    print(
+        f"exact: {len(ids)} vectors, "
+        f"{seconds * 1000 / args.queries:.3f} ms/query (batched)"
+    )
+
+    ivf = LocalVectorIndex(
+        ids,
+        vectors,
+        ivf_n_lists=args.ivf_n_lists,
+        ivf_n_probe=args.ivf_n_probe,
+    )
+    started_at = time.perf_counter()
+    found, _ = ivf.search(queries, args.neighbors)
+    seconds = time.perf_counter() - started_at
+    recall = np.mean(
+        [len(set(e) & set(f)) / len(e) for e, f in zip(expected, found)]
+    )
+    print(
+        f"ivf ({args.ivf_n_lists} lists, {args.ivf_n_probe} probes): "
+        f"{seconds * 1000 / args.queries:.3f} ms/query, "
+        f"recall@{args.neighbors} {recall:.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Registry of the in-process metrics, served by the /metrics route
+
+Modules register a function returning their counters when they are
+imported. get_metrics calls each of them, so the counters are read only
+when the metrics are requested.
+"""
+
+import threading
+import typing
+
+_sources: dict[str, typing.Callable[[], typing.Any]] = {}
+_sources_lock = threading.Lock()
+
+
+def register_metrics(name: str, source: typing.Callable[[], typing.Any]):
+    """Registers a source of metrics
+
+    Args:
+        name: str
+            Name of the metrics, e.g. "cloud_sql_pool"
+        source: typing.Callable[[], typing.Any]
+            Function without arguments returning JSON serializable
+            counters
+    """
+    with _sources_lock:
+        _sources[name] = source
+
+
+def get_metrics() -> dict:
+    """Gets the counters of every registered source
+
+    Returns:
+        dict
+            Counters of each source, by name. A failing source reports
+            its error instead.
+    """
+    with _sources_lock:
+        sources = dict(_sources)
+    metrics = {}
+    for name, source in sorted(sources.items()):
+        try:
+            metrics[name] = source()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            metrics[name] = {"error": str(e)}
+    return metrics
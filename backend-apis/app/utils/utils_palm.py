@@ -19,23 +19,57 @@ Utils for PaLM
 
 import asyncio
 import base64
-import functools
+import hashlib
+import tomllib
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from google.api_core.exceptions import GoogleAPICallError
+from google.api_core.exceptions import GoogleAPICallError, InvalidArgument
 from google.cloud import aiplatform
 from google.protobuf import struct_pb2
-from google.protobuf.json_format import MessageToDict
 from vertexai.preview.language_models import (
     TextEmbeddingInput,
     TextEmbeddingModel,
     TextGenerationModel,
 )
 
-model = TextGenerationModel.from_pretrained(model_name="text-bison@002")
-text_embedding_model = TextEmbeddingModel.from_pretrained(
-    "textembedding-gecko@003"
+from app.utils.utils_cache import llm_response_cache
+from app.utils.utils_embedding_cache import (
+    multimodal_embedding_cache,
+    text_embedding_cache,
+)
+from app.utils.utils_llm_executor import llm_executor
+from app.utils.utils_singleflight import get_group, make_key
+from app.utils.utils_lazy import lazy
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    multimodal_cfg = config["multimodal"]
+
+TEXT_GENERATION_MODEL = "text-bison@002"
+MULTIMODAL_EMBEDDING_MODEL = "multimodalembedding@001"
+EMBEDDING_MAX_INSTANCES_PER_REQUEST = multimodal_cfg.get(
+    "embedding_max_instances_per_request", 1
+)
+
+# Predict requests of a batch are sent concurrently on this executor
+embeddings_executor = ThreadPoolExecutor(
+    max_workers=multimodal_cfg.get("embedding_max_concurrency", 4),
+    thread_name_prefix="embeddings",
+)
+
+# Identical concurrent requests share one model call
+llm_singleflight = get_group("llm")
+embeddings_singleflight = get_group("embeddings")
+
+model = lazy(
+    lambda: TextGenerationModel.from_pretrained(
+        model_name=TEXT_GENERATION_MODEL
+    )
+)
+text_embedding_model = lazy(
+    lambda: TextEmbeddingModel.from_pretrained("textembedding-gecko@003")
 )
 
 
@@ -45,6 +79,8 @@ def text_generation(
     temperature: float = 0.2,
     top_k: int = 40,
     top_p: float = 0.8,
+    use_cache: bool = False,
+    cache_ttl_seconds: float | None = None,
 ) -> str:
     """
 
@@ -55,24 +91,95 @@ def text_generation(
         temperature:
         top_k:
         top_p:
+        use_cache:
+            Serve identical requests from the LLM response cache. Only
+            for deterministic prompts.
+        cache_ttl_seconds:
+            TTL of the cached response. Defaults to the cache TTL.
 
     Returns:
 
     """
-    return model.predict(
-        prompt=prompt,
-        max_output_tokens=max_output_tokens,
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    ).text
+    key = _text_cache_key(prompt, max_output_tokens, temperature, top_k, top_p)
+    if use_cache:
+        cached_response = llm_response_cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    def generate() -> str:
+        response_text = model.predict(
+            prompt=prompt,
+            max_output_tokens=max_output_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+        ).text
+        if use_cache and response_text:
+            llm_response_cache.set(key, response_text, cache_ttl_seconds)
+        return response_text
+
+    return llm_singleflight.do(key, generate)
+
+
+def _text_cache_key(
+    prompt: str,
+    max_output_tokens: int,
+    temperature: float,
+    top_k: int,
+    top_p: float,
+) -> str:
+    return llm_response_cache.make_key(
+        TEXT_GENERATION_MODEL,
+        {
+            "max_output_tokens": max_output_tokens,
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p,
+        },
+        prompt,
+    )
 
 
 class EmbeddingResponse(typing.NamedTuple):
-    """Embedding Response"""
+    """Embedding Response, as read-only float32 vectors. The embedding of
+    a missing text or image is empty.
+    """
+
+    text_embedding: np.ndarray
+    image_embedding: np.ndarray
+
+
+class EmbeddingInput(typing.NamedTuple):
+    """Text and/or image to embed"""
+
+    text: str = ""
+    image_bytes: bytes = b""
+
+
+EMPTY_EMBEDDING = np.empty(0, dtype=np.float32)
+EMPTY_EMBEDDING.setflags(write=False)
+
 
-    text_embedding: list[float]
-    image_embedding: list[float]
+def _decode_embedding(prediction: struct_pb2.Value, field: str) -> np.ndarray:
+    """Decodes an embedding of a prediction into a float32 vector, without
+    converting the prediction to a dict or a list first.
+
+    Args:
+        prediction: struct_pb2.Value
+            Prediction of the multimodal embedding model
+        field: str
+            textEmbedding | imageEmbedding
+
+    Returns:
+        np.ndarray
+            Contiguous float32 vector
+    """
+    values = prediction.struct_value.fields[field].list_value.values
+    return np.fromiter(
+        (value.number_value for value in values),
+        dtype=np.float32,
+        count=len(values),
+    )
 
 
 class EmbeddingPredictionClient:
@@ -101,6 +208,14 @@ class EmbeddingPredictionClient:
             client_options=client_options
         )
 
+    @property
+    def endpoint(self) -> str:
+        """Multimodal embedding model endpoint"""
+        return (
+            f"projects/{self.project}/locations/{self.location}"
+            f"/publishers/google/models/{MULTIMODAL_EMBEDDING_MODEL}"
+        )
+
     def get_embedding(self, text: str = "", image_bytes: bytes = b""):
         """
 
@@ -119,60 +234,211 @@ class EmbeddingPredictionClient:
                 "At least one of text or image_bytes must be specified."
             )
 
-        instance = struct_pb2.Value()
-        if text:
-            instance.struct_value.update({"text": text})
+        return embeddings_singleflight.do(
+            make_key(
+                MULTIMODAL_EMBEDDING_MODEL,
+                text,
+                hashlib.sha256(image_bytes).hexdigest(),
+            ),
+            lambda: self.get_embeddings([EmbeddingInput(text, image_bytes)])[0],
+        )
+
+    def get_embeddings(
+        self, batch: list[EmbeddingInput]
+    ) -> list[EmbeddingResponse]:
+        """Gets the embeddings of several texts and/or images.
+
+        Texts and images found in the embedding cache are not sent, and
+        identical inputs are embedded once. The other inputs are packed
+        into predict requests of up to EMBEDDING_MAX_INSTANCES_PER_REQUEST
+        instances, sent concurrently. The embeddings are returned in the
+        order of the batch.
+
+        Args:
+            batch: list[EmbeddingInput]
+                Texts and/or images to embed
+
+        Raises:
+            ValueError:
+                If an input has neither text nor image_bytes, or if the
+                model returns fewer or more predictions than instances
+
+        Returns:
+            list[EmbeddingResponse]
+                Embedding of each input
+        """
+        if any(not (i.text or i.image_bytes) for i in batch):
+            raise ValueError(
+                "At least one of text or image_bytes must be specified."
+            )
 
-        if image_bytes:
-            encoded_content = base64.b64encode(image_bytes).decode("utf-8")
-            instance.struct_value.update(
-                {"image": {"bytesBase64Encoded": encoded_content}}
+        # Text and image embeddings are independent, so they are cached
+        # separately and a cached text is not sent with a new image
+        cache = multimodal_embedding_cache
+        texts = {}
+        images = {}
+        for embedding_input in batch:
+            if embedding_input.text and embedding_input.text not in texts:
+                vector = cache.get(cache.key(text=embedding_input.text))
+                if vector is not None:
+                    texts[embedding_input.text] = vector
+            image_bytes = embedding_input.image_bytes
+            if image_bytes and image_bytes not in images:
+                vector = cache.get(cache.key(image_bytes=image_bytes))
+                if vector is not None:
+                    images[image_bytes] = vector
+
+        missing_inputs = []
+        for embedding_input in batch:
+            missing_input = EmbeddingInput(
+                text=(
+                    embedding_input.text
+                    if embedding_input.text not in texts
+                    else ""
+                ),
+                image_bytes=(
+                    embedding_input.image_bytes
+                    if embedding_input.image_bytes not in images
+                    else b""
+                ),
+            )
+            if missing_input.text or missing_input.image_bytes:
+                missing_inputs.append(missing_input)
+        missing_inputs = list(dict.fromkeys(missing_inputs))
+
+        for embedding_input, embedding in zip(
+            missing_inputs, self._predict_batches(missing_inputs)
+        ):
+            if embedding_input.text:
+                key = cache.key(text=embedding_input.text)
+                cache.set(key, embedding.text_embedding)
+                texts[embedding_input.text] = embedding.text_embedding
+            if embedding_input.image_bytes:
+                key = cache.key(image_bytes=embedding_input.image_bytes)
+                cache.set(key, embedding.image_embedding)
+                images[embedding_input.image_bytes] = embedding.image_embedding
+
+        return [
+            EmbeddingResponse(
+                text_embedding=(
+                    texts[embedding_input.text]
+                    if embedding_input.text
+                    else EMPTY_EMBEDDING
+                ),
+                image_embedding=(
+                    images[embedding_input.image_bytes]
+                    if embedding_input.image_bytes
+                    else EMPTY_EMBEDDING
+                ),
+            )
+            for embedding_input in batch
+        ]
+
+    def _predict_batches(
+        self, inputs: list[EmbeddingInput]
+    ) -> list[EmbeddingResponse]:
+        request_batches = [
+            inputs[i : i + EMBEDDING_MAX_INSTANCES_PER_REQUEST]
+            for i in range(0, len(inputs), EMBEDDING_MAX_INSTANCES_PER_REQUEST)
+        ]
+        if len(request_batches) <= 1:
+            responses = [self._predict(batch) for batch in request_batches]
+        else:
+            responses = list(
+                embeddings_executor.map(self._predict, request_batches)
+            )
+        return [embedding for response in responses for embedding in response]
+
+    def _predict(
+        self, inputs: list[EmbeddingInput]
+    ) -> list[EmbeddingResponse]:
+        instances = []
+        for embedding_input in inputs:
+            instance = struct_pb2.Value()
+            if embedding_input.text:
+                instance.struct_value.update({"text": embedding_input.text})
+            if embedding_input.image_bytes:
+                encoded_content = base64.b64encode(
+                    embedding_input.image_bytes
+                ).decode("utf-8")
+                instance.struct_value.update(
+                    {"image": {"bytesBase64Encoded": encoded_content}}
+                )
+            instances.append(instance)
+
+        try:
+            response = self.client.predict(
+                endpoint=self.endpoint, instances=instances
+            )
+        except InvalidArgument:
+            if len(inputs) == 1:
+                raise
+            # The model accepts fewer instances per request, split it
+            print(
+                f"Embedding request of {len(inputs)} instances rejected, "
+                "sending them one by one"
+            )
+            return [
+                embedding
+                for embedding_input in inputs
+                for embedding in self._predict([embedding_input])
+            ]
+
+        # pylint: disable-next=protected-access
+        predictions = response._pb.predictions
+        if len(predictions) != len(inputs):
+            raise ValueError(
+                f"Embedding request of {len(inputs)} instances returned "
+                f"{len(predictions)} predictions"
             )
 
-        instances = [instance]
-        endpoint = (
-            f"projects/{self.project}/locations/{self.location}"
-            "/publishers/google/models/multimodalembedding@001"
-        )
-        response = self.client.predict(endpoint=endpoint, instances=instances)
-        response_dict = MessageToDict(
-            response._pb  # pylint: disable=protected-access
-        )
-        text_embedding = []
-        if text:
-            text_emb_value = response_dict["predictions"][0]["textEmbedding"]
-            text_embedding = [float(v) for v in text_emb_value]
-
-        image_embedding = []
-        if image_bytes:
-            image_emb_value = response_dict["predictions"][0]["imageEmbedding"]
-            image_embedding = [float(v) for v in image_emb_value]
-
-        return EmbeddingResponse(
-            text_embedding=text_embedding, image_embedding=image_embedding
-        )
+        embeddings = []
+        for embedding_input, prediction in zip(inputs, predictions):
+            text_embedding = EMPTY_EMBEDDING
+            if embedding_input.text:
+                text_embedding = _decode_embedding(prediction, "textEmbedding")
+            image_embedding = EMPTY_EMBEDDING
+            if embedding_input.image_bytes:
+                image_embedding = _decode_embedding(
+                    prediction, "imageEmbedding"
+                )
+            embeddings.append(
+                EmbeddingResponse(
+                    text_embedding=text_embedding,
+                    image_embedding=image_embedding,
+                )
+            )
+        return embeddings
 
 
 def reduce_embedding_dimension(
-    vector_text: list[float] | None = None,
-    vector_image: list[float] | None = None,
-) -> list:
-    """
+    vector_text: np.ndarray | list[float] | None = None,
+    vector_image: np.ndarray | list[float] | None = None,
+) -> np.ndarray:
+    """Sum-pools a text and an image embedding
 
     Args:
-        vector_text:
-        vector_image:
+        vector_text: np.ndarray | list[float] | None
+            Text embedding, may be empty
+        vector_image: np.ndarray | list[float] | None
+            Image embedding, may be empty
 
     Returns:
-
+        np.ndarray
+            float32 vector. Convert it with tolist() only when sending it
+            to Vector Search.
     """
-    if vector_image and vector_text:
-        matrix = np.array([vector_text, vector_image])
-        max_pooled_rows = np.sum(matrix, axis=0)
-    else:
-        max_pooled_rows = np.array(vector_text or vector_image)
-
-    return list(max_pooled_rows)
+    vector_text = np.asarray(
+        vector_text if vector_text is not None else EMPTY_EMBEDDING,
+        dtype=np.float32,
+    )
+    vector_image = np.asarray(
+        vector_image if vector_image is not None else EMPTY_EMBEDDING,
+        dtype=np.float32,
+    )
+    if vector_text.size and vector_image.size:
+        return np.add(vector_text, vector_image)
+    return vector_text if vector_text.size else vector_image
 
 
 async def async_predict_text_llm(
@@ -181,6 +447,8 @@ async def async_predict_text_llm(
     temperature: float = 0.2,
     top_k: int = 40,
     top_p: float = 0.8,
+    use_cache: bool = False,
+    cache_ttl_seconds: float | None = None,
 ) -> str:
     """
 
@@ -191,34 +459,45 @@ async def async_predict_text_llm(
         temperature:
         top_k:
         top_p:
+        use_cache:
+            Serve identical requests from the LLM response cache. Only
+            for deterministic prompts.
+        cache_ttl_seconds:
+            TTL of the cached response. Defaults to the cache TTL.
 
     Returns:
 
     """
-    loop = asyncio.get_running_loop()
-    generated_response = None
-    try:
-        generated_response = await loop.run_in_executor(
-            None,
-            functools.partial(
-                model.predict,
-                prompt=prompt,
-                temperature=temperature,
-                max_output_tokens=max_output_tokens,
-                top_k=top_k,
-                top_p=top_p,
-            ),
+    key = _text_cache_key(prompt, max_output_tokens, temperature, top_k, top_p)
+    if use_cache:
+        cached_response = llm_response_cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    async def generate() -> str:
+        generated_response = await llm_executor.run(
+            TEXT_GENERATION_MODEL,
+            model.predict,
+            prompt=prompt,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            top_k=top_k,
+            top_p=top_p,
         )
-    except GoogleAPICallError as e:
-        print(e)
-        return ""
-
-    if generated_response and generated_response.text:
+        if not (generated_response and generated_response.text):
+            return ""
         generated_response = generated_response.text.replace("```json", "")
         generated_response = generated_response.replace("```JSON", "")
         generated_response = generated_response.replace("```", "")
+        if use_cache:
+            llm_response_cache.set(key, generated_response, cache_ttl_seconds)
         return generated_response
-    return ""
+
+    try:
+        return await llm_singleflight.do_async(key, generate)
+    except GoogleAPICallError as e:
+        print(e)
+        return ""
 
 
 async def run_predict_text_llm(
@@ -251,10 +530,19 @@ def get_text_embeddings(input_text: str) -> list:
     Returns:
 
     """
-    text_input = TextEmbeddingInput(text=input_text, task_type="CLUSTERING")
-
-    embeddings = text_embedding_model.get_embeddings(texts=[text_input])[
-        0
-    ].values
+    key = text_embedding_cache.key(text=input_text)
+    cached_embedding = text_embedding_cache.get(key)
+    if cached_embedding is not None:
+        return cached_embedding.tolist()
+
+    def get_embeddings() -> list:
+        text_input = TextEmbeddingInput(
+            text=input_text, task_type="CLUSTERING"
+        )
+        embeddings = text_embedding_model.get_embeddings(texts=[text_input])[
+            0
+        ].values
+        text_embedding_cache.set(key, embeddings)
+        return embeddings
 
-    return embeddings
+    return embeddings_singleflight.do(key, get_embeddings)
@@ -22,9 +22,11 @@ from typing import Literal
 from google.cloud import discoveryengine_v1alpha as discoveryengine
 from proto import Message
 
-recommender_client = discoveryengine.RecommendationServiceClient()
-document_client = discoveryengine.DocumentServiceClient()
-event_client = discoveryengine.UserEventServiceClient()
+from app.utils.utils_lazy import lazy
+
+recommender_client = lazy(discoveryengine.RecommendationServiceClient)
+document_client = lazy(discoveryengine.DocumentServiceClient)
+event_client = lazy(discoveryengine.UserEventServiceClient)
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
     rec_config = config["recommendations"]
@@ -0,0 +1,312 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Utils for product reviews and their precomputed summaries
+
+Summaries are stored in the product document of the reviews collection
+(website_reviews/{product_id}), next to the review set fingerprint they
+were generated from. The fingerprint is the number of reviews plus the
+time of the latest review, both stored on the product document by
+`add_review` and by deployment_scripts/firestore_upload_data.py, so it
+is read with the product document. Reviews must be written through one
+of them to invalidate the summary. A summary is only regenerated when
+the fingerprint changes.
+
+Review sets larger than the map-reduce token budget are summarized in
+chunks (see utils_summarize). Reviews are chunked in creation order, so a
+new review only invalidates the cached summary of the last chunk.
+
+Pre-warm the summaries of the whole catalog with:
+    python -m app.utils.utils_reviews --concurrency 8
+"""
+
+import argparse
+import asyncio
+import datetime
+import functools
+import json
+import tomllib
+
+from google.cloud import firestore
+
+from app.utils import utils_cloud_sql, utils_summarize
+from app.utils.utils_singleflight import get_group
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    summary_cfg = config["summary"]
+    llm_cache_ttl = config.get("llm_cache", {}).get("ttl_seconds", {})
+
+REVIEWS_COLLECTION = summary_cfg.get("reviews_collection", "website_reviews")
+PREWARM_CONCURRENCY = summary_cfg.get("prewarm_concurrency", 8)
+NO_REVIEWS_SUMMARY = "No reviews yet."
+
+# Concurrent requests for the same product share one summary refresh
+summary_singleflight = get_group("reviews_summary")
+
+
+def review_fingerprint(
+    review_count: int,
+    latest_review_at: datetime.datetime | None = None,
+) -> str:
+    """Builds the fingerprint of a review set
+
+    Args:
+        review_count: int
+            Number of reviews
+        latest_review_at: datetime.datetime | None
+            Time of the latest review, if known
+
+    Returns:
+        str
+            Fingerprint of the review set
+    """
+    latest = latest_review_at.isoformat() if latest_review_at else ""
+    return f"{review_count}:{latest}"
+
+
+def _product_reviews_ref(
+    db: firestore.Client, product_id: int | str
+) -> firestore.DocumentReference:
+    return db.collection(REVIEWS_COLLECTION).document(str(product_id))
+
+
+def add_review(db: firestore.Client, product_id: int | str, review: dict):
+    """Adds a review and updates the review set fingerprint
+
+    Args:
+        db: firestore.Client
+            Firestore client
+        product_id: int | str
+            Product id
+        review: dict
+            Review document (review, sentiment, stars)
+    """
+    product_ref = _product_reviews_ref(db, product_id)
+    review_count = (product_ref.get().to_dict() or {}).get("review_count")
+    batch = db.batch()
+    batch.set(
+        product_ref.collection("reviews").document(),
+        {**review, "timestamp": firestore.SERVER_TIMESTAMP},
+    )
+    batch.set(
+        product_ref,
+        {
+            # Reviews uploaded before the counter existed are counted once
+            "review_count": (
+                firestore.Increment(1)
+                if review_count is not None
+                else _count_reviews(product_ref) + 1
+            ),
+            "latest_review_at": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,
+    )
+    batch.commit()
+
+
+def _count_reviews(product_ref: firestore.DocumentReference) -> int:
+    result = product_ref.collection("reviews").count(alias="count").get()
+    return int(result[0][0].value)
+
+
+def summarize_reviews(product: dict, reviews: list[dict]) -> str:
+    """Generates the summary of a review set with Gemini
+
+    Review sets that do not fit the token budget are summarized with
+    map-reduce.
+
+    Args:
+        product: dict
+            Product dict
+        reviews: list[dict]
+            Review documents, oldest first
+
+    Returns:
+        str
+            Reviews summary
+    """
+    reviews_json = json.dumps({"product": product, "reviews": reviews})
+    if (
+        utils_summarize.estimate_tokens(reviews_json)
+        > utils_summarize.TOKEN_BUDGET
+    ):
+        return asyncio.run(
+            utils_summarize.map_reduce_summarize(
+                items=reviews,
+                map_prompt=summary_cfg["prompt_reviews_map"],
+                reduce_prompt=summary_cfg["prompt_reviews_reduce"],
+                product=json.dumps(product),
+            )
+        )
+
+    # Imported here so the fingerprint logic does not need Vertex AI
+    # pylint: disable-next=import-outside-toplevel
+    from app.utils import utils_gemini
+
+    return utils_gemini.generate_gemini_pro_text(
+        prompt=summary_cfg["prompt_reviews"].format(reviews=reviews_json),
+        max_output_tokens=1024,
+        temperature=0.2,
+        top_k=40,
+        top_p=0.8,
+        use_cache=True,
+        cache_ttl_seconds=llm_cache_ttl.get("reviews_summary"),
+    )
+
+
+def get_reviews_summary(
+    db: firestore.Client, product_id: int | str, product: dict
+) -> str:
+    """Gets the stored reviews summary, regenerating it if the review set
+    changed since it was generated
+
+    Args:
+        db: firestore.Client
+            Firestore client
+        product_id: int | str
+            Product id
+        product: dict
+            Product dict, used to generate the summary
+
+    Returns:
+        str
+            Reviews summary
+    """
+    return summary_singleflight.do(
+        str(product_id), _get_reviews_summary, db, product_id, product
+    )
+
+
+def _get_reviews_summary(
+    db: firestore.Client, product_id: int | str, product: dict
+) -> str:
+    product_ref = _product_reviews_ref(db, product_id)
+    product_doc = product_ref.get().to_dict() or {}
+
+    review_count = product_doc.get("review_count")
+    if review_count is None:
+        # Reviews uploaded without the counter, start tracking them
+        review_count = _count_reviews(product_ref)
+        product_ref.set({"review_count": review_count}, merge=True)
+    fingerprint = review_fingerprint(
+        review_count, product_doc.get("latest_review_at")
+    )
+
+    if (
+        "summary" in product_doc
+        and product_doc.get("summary_fingerprint") == fingerprint
+    ):
+        return product_doc["summary"]
+
+    summary = NO_REVIEWS_SUMMARY
+    if review_count:
+        reviews = []
+        review_snapshots = sorted(
+            product_ref.collection("reviews").get(),
+            key=lambda snapshot: snapshot.create_time,
+        )
+        for review_snapshot in review_snapshots:
+            review = review_snapshot.to_dict()
+            review.pop("timestamp", None)
+            reviews.append(review)
+        summary = summarize_reviews(product, reviews)
+
+    # The fingerprint read before the scan is stored, so a review added
+    # in the meantime triggers another regeneration
+    product_ref.set(
+        {
+            "summary": summary,
+            "summary_fingerprint": fingerprint,
+            "summary_updated_at": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,
+    )
+    return summary
+
+
+def _prewarm_product(db: firestore.Client, product_id: int) -> bool:
+    product = utils_cloud_sql.get_product(product_id)
+    if not product:
+        return False
+    get_reviews_summary(
+        db, product_id, utils_cloud_sql.convert_product_to_dict(product)
+    )
+    return True
+
+
+async def prewarm_reviews_summaries(
+    db: firestore.Client,
+    product_ids: list[int],
+    concurrency: int = PREWARM_CONCURRENCY,
+) -> dict:
+    """Generates the missing or stale reviews summaries of a list of
+    products, with at most `concurrency` products in flight
+
+    Args:
+        db: firestore.Client
+            Firestore client
+        product_ids: list[int]
+            Product ids
+        concurrency: int
+            Maximum number of concurrent products
+
+    Returns:
+        dict
+            Number of warmed, missing and failed products
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    counters = {"warmed": 0, "missing": 0, "failed": 0}
+
+    async def _prewarm(product_id: int):
+        async with semaphore:
+            try:
+                found = await loop.run_in_executor(
+                    None,
+                    functools.partial(_prewarm_product, db, product_id),
+                )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Error warming product {product_id}: {e}")
+                counters["failed"] += 1
+                return
+        counters["warmed" if found else "missing"] += 1
+
+    await asyncio.gather(*(_prewarm(product_id) for product_id in product_ids))
+    return counters
+
+
+def main():
+    """Pre-warms the reviews summaries of the whole catalog"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--concurrency", type=int, default=PREWARM_CONCURRENCY
+    )
+    args = parser.parse_args()
+
+    product_ids = [
+        row[0]
+        for row in utils_cloud_sql.get_repository().get_id_index_rows()
+    ]
+    print(f"Warming reviews summaries for {len(product_ids)} products")
+    counters = asyncio.run(
+        prewarm_reviews_summaries(
+            firestore.Client(), product_ids, args.concurrency
+        )
+    )
+    print(counters)
+
+
+if __name__ == "__main__":
+    main()
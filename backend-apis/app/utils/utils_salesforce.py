@@ -35,6 +35,7 @@ from app.utils import (
     utils_vertex_vector,
     utils_workspace,
 )
+from app.utils.utils_lazy import lazy
 
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
@@ -51,9 +52,11 @@ prompt_questions = config["salesforce"]["prompt_email_support"]
 datastore_location = config["global"]["datastore_location"]
 email_datastore_id = config["website_search"]["website_datastore_id"]
 
-translate_client = translate_v2.Client()
-embeddings_client = utils_palm.EmbeddingPredictionClient(project=project_id)
-db = firestore.Client()
+translate_client = lazy(translate_v2.Client)
+embeddings_client = lazy(
+    lambda: utils_palm.EmbeddingPredictionClient(project=project_id)
+)
+db = lazy(firestore.Client)
 
 
 def results_from_questions(questions: list, conversation_id: str) -> list:
@@ -263,7 +266,7 @@ def salesforce_multimodal(
 
     """
     # Extract embedding for each image
-    images_embeddings = []  # Embeddings of all images
+    images_bytes = []  # Bytes of all images
 
     for attachment in attachments:
         try:
@@ -284,13 +287,19 @@ def salesforce_multimodal(
             print(e)
             continue
         else:
-            images_embeddings.append(
-                embeddings_client.get_embedding(
-                    image_bytes=image_bytes
-                ).image_embedding
+            images_bytes.append(image_bytes)
+    if images_bytes:
+        # One batch for all the attachments
+        images_embeddings = [
+            embedding.image_embedding
+            for embedding in embeddings_client.get_embeddings(
+                [
+                    utils_palm.EmbeddingInput(image_bytes=image_bytes)
+                    for image_bytes in images_bytes
+                ]
             )
-    if images_embeddings:
-        image_embedding = list(np.sum(np.array(images_embeddings), axis=0))
+        ]
+        image_embedding = np.sum(images_embeddings, axis=0)
         return embeddings_search(
             image_embedding=image_embedding,
             conversation=conversation,
@@ -352,13 +361,13 @@ def is_human_needed(email_content: str) -> bool:
 
 
 def embeddings_search(
-    image_embedding: list[float], conversation: Conversation, questions: list
+    image_embedding: np.ndarray, conversation: Conversation, questions: list
 ) -> dict:
     """Search multimodal questions from email
 
     Args:
-        image_embedding: list[float]
-            Attached image embedding
+        image_embedding: np.ndarray
+            Attached image embedding, as a float32 vector
         email_content: str
             Email content
         conversation: Conversation
@@ -379,16 +388,20 @@ def embeddings_search(
             multimodal_questions.append(question)
 
     if multimodal_questions:
-        # Extract embedding for each text
-        text_embeddings = []
-        for question in multimodal_questions:
-            text_embeddings.append(
-                embeddings_client.get_embedding(text=question).text_embedding
+        # Extract embedding for each text, in one batch
+        text_embeddings = [
+            embedding.text_embedding
+            for embedding in embeddings_client.get_embeddings(
+                [
+                    utils_palm.EmbeddingInput(text=question)
+                    for question in multimodal_questions
+                ]
             )
+        ]
 
         # Combine embeddings: Texts + Images
         multimodal_embedding = utils_palm.reduce_embedding_dimension(
-            vector_text=list(np.sum(np.array(text_embeddings), axis=0)),
+            vector_text=np.sum(text_embeddings, axis=0),
             vector_image=image_embedding,
         )
     else:
@@ -414,14 +427,17 @@ def embeddings_search(
     neighbors_result["question"] = append_to_conversation["input"]
     neighbors_result["links"] = []
     neighbors_result["snapshots"] = []
-    for n in neighbors.nearest_neighbors[0].neighbors:
+    hydrated = utils_cloud_sql.hydrate_neighbors(
+        neighbors.nearest_neighbors[0].neighbors
+    )
+    if hydrated.missing_ids:
+        print(f"Products not found: {hydrated.missing_ids}")
+    for result in hydrated.results:
         neighbors_result["links"].append(
-            config["salesforce"]["website_uri"] + n.datapoint.datapoint_id
+            config["salesforce"]["website_uri"] + result["id"]
         )
-        product = utils_cloud_sql.get_product(int(n.datapoint.datapoint_id))
-        if product:
-            snapshot = utils_cloud_sql.convert_product_to_dict(product)
-            neighbors_result["snapshots"].append(snapshot)
+        if result["snapshot"]:
+            neighbors_result["snapshots"].append(result["snapshot"])
 
     references = json.dumps(
         {
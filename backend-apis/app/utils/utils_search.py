@@ -15,6 +15,7 @@
 """
 Utility module for Vertex AI Search API
 """
+import asyncio
 import json
 import tomllib
 from copy import deepcopy
@@ -32,6 +33,7 @@ from proto import Message
 from vertexai.preview.language_models import TextGenerationModel
 
 from app.utils import utils_cloud_sql, utils_palm, utils_vertex_vector
+from app.utils.utils_lazy import lazy
 
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
@@ -52,14 +54,18 @@ index_endpoint_id = config["multimodal"]["index_endpoint_id"]
 deployed_index_id = config["multimodal"]["deployed_index_id"]
 vector_api_endpoint = config["multimodal"]["vector_api_endpoint"]
 
-search_client = discoveryengine.SearchServiceClient()
-converse_client = discoveryengine.ConversationalSearchServiceClient()
-embeddings_client = utils_palm.EmbeddingPredictionClient(project=project_id)
-user_event_client = discoveryengine.UserEventServiceClient()
-storage_client = storage.Client()
+search_client = lazy(discoveryengine.SearchServiceClient)
+converse_client = lazy(discoveryengine.ConversationalSearchServiceClient)
+embeddings_client = lazy(
+    lambda: utils_palm.EmbeddingPredictionClient(project=project_id)
+)
+user_event_client = lazy(discoveryengine.UserEventServiceClient)
+storage_client = lazy(storage.Client)
 
-text_gen_client = TextGenerationModel.from_pretrained(model_name="text-bison")
-bucket = storage_client.bucket(images_bucket_name)
+text_gen_client = lazy(
+    lambda: TextGenerationModel.from_pretrained(model_name="text-bison")
+)
+bucket = lazy(lambda: storage_client.bucket(images_bucket_name))
 
 
 def get_search_conversation(conversation_resource: str) -> Conversation:
@@ -160,6 +166,32 @@ def update_search_conversation(
         raise HTTPException(status_code=400, detail=str(e)) from e
 
 
+async def _find_neighbors_and_get_conversation(
+    feature_vector, conversation_id: str
+) -> tuple:
+    """Runs the Vector Search query and reads the search conversation
+    concurrently
+
+    Args:
+        feature_vector:
+            Multimodal embedding of the query
+        conversation_id: str
+            Conversation resource name
+
+    Returns:
+        tuple
+            Vector Search response and conversation
+    """
+    return await asyncio.gather(
+        utils_vertex_vector.async_find_neighbors(
+            [utils_vertex_vector.NeighborQuery(feature_vector)]
+        ),
+        asyncio.to_thread(
+            converse_client.get_conversation, name=conversation_id
+        ),
+    )
+
+
 def generate_conversation_history(  # pylint: disable=too-many-statements, too-many-branches, too-many-locals
     message_dict: dict,
     search_doc_dict: dict,
@@ -251,26 +283,22 @@ def generate_conversation_history(  # pylint: disable=too-many-statements, too-m
                 vector_text=feature_vector.text_embedding,
             )
 
-            neighbors = utils_vertex_vector.find_neighbor(
-                feature_vector=reduced_vector,
+            # The conversation is read while Vector Search runs
+            neighbors, past_conversations = asyncio.run(
+                _find_neighbors_and_get_conversation(
+                    feature_vector=reduced_vector,
+                    conversation_id=search_doc_dict.get("conversation_id", ""),
+                )
             )
 
             results = []
             if neighbors.nearest_neighbors is not None and len(neighbors.nearest_neighbors) > 0:
-                num_responses = len(neighbors.nearest_neighbors[0].neighbors)
-                for i, n in enumerate(neighbors.nearest_neighbors[0].neighbors):
-                    product = utils_cloud_sql.get_product(
-                        int(n.datapoint.datapoint_id)
-                    )
-                    snapshot = {}
-
-                    if product:
-                        snapshot = utils_cloud_sql.convert_product_to_dict(product)
-                    result = {"id": n.datapoint.datapoint_id, "snapshot": snapshot}
-                    results.append(result)
-
-                    if i == 9 or (num_responses < 10 and i == num_responses - 1):
-                        break
+                hydrated = utils_cloud_sql.hydrate_neighbors(
+                    neighbors.nearest_neighbors[0].neighbors
+                )
+                if hydrated.missing_ids:
+                    print(f"Products not found: {hydrated.missing_ids}")
+                results = hydrated.results
 
             conversation_history = []
             if search_doc_dict:
@@ -316,9 +344,6 @@ def generate_conversation_history(  # pylint: disable=too-many-statements, too-m
                 }
             )
 
-            past_conversations = converse_client.get_conversation(
-                name=search_doc_dict.get("conversation_id", "")
-            )
             original_conversation = discoveryengine.Conversation()
             discoveryengine.Conversation.copy_from(
                 instance=original_conversation, other=past_conversations
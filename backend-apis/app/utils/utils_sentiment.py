@@ -0,0 +1,311 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Background sentiment scoring of chat messages
+
+Messages are written to Firestore first and queued here. A worker thread
+takes micro-batches from a bounded queue, scores them concurrently with
+the Natural Language API and patches sentiment_score and
+sentiment_magnitude back onto the documents with one batched write.
+
+When the queue is full, submit waits up to `submit_timeout_seconds` and
+then scores the message in the caller (backpressure), so no message is
+left without a sentiment. stop drains the queue before returning.
+"""
+
+import queue
+import threading
+import time
+import tomllib
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import firestore, language_v1
+
+from app.utils.utils_lazy import lazy
+from app.utils.utils_metrics import register_metrics
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    sentiment_cfg = config.get("sentiment_worker", {})
+
+# Queued when stopping, wakes up the worker
+_STOP = object()
+
+
+class SentimentTask(typing.NamedTuple):
+    """Message to score"""
+
+    document: firestore.DocumentReference
+    text: str
+
+
+def analyze_sentiment(
+    client: language_v1.LanguageServiceClient, text: str
+) -> dict:
+    """Scores the sentiment of a text
+
+    Args:
+        client: language_v1.LanguageServiceClient
+            Natural Language client
+        text: str
+            Text
+
+    Returns:
+        dict
+            sentiment_score and sentiment_magnitude, 0 if the call fails
+    """
+    try:
+        document = language_v1.types.Document(
+            content=text, type_=language_v1.types.Document.Type.PLAIN_TEXT
+        )
+        sentiment = client.analyze_sentiment(
+            request={"document": document}
+        ).document_sentiment
+        return {
+            "sentiment_score": sentiment.score,
+            "sentiment_magnitude": sentiment.magnitude,
+        }
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"[Error]analyze_sentiment:{e}")
+        return {"sentiment_score": 0, "sentiment_magnitude": 0}
+
+
+class SentimentWorker:
+    """Scores queued messages in micro-batches in a background thread"""
+
+    def __init__(
+        self,
+        analyze: typing.Callable[[str], dict],
+        db: firestore.Client,
+        max_queue_size: int = 1000,
+        batch_size: int = 16,
+        batch_wait_seconds: float = 0.05,
+        concurrency: int = 4,
+        submit_timeout_seconds: float = 0.1,
+    ):
+        """
+        Args:
+            analyze: typing.Callable[[str], dict]
+                Function returning the sentiment fields of a text
+            db: firestore.Client
+                Firestore client of the batched writes
+            max_queue_size: int
+                Maximum number of queued messages
+            batch_size: int
+                Maximum number of messages of a micro-batch
+            batch_wait_seconds: float
+                Seconds to wait for more messages after the first one of
+                a micro-batch
+            concurrency: int
+                Concurrent sentiment calls of a micro-batch
+            submit_timeout_seconds: float
+                Seconds submit waits for room in a full queue before
+                scoring the message in the caller
+        """
+        self.analyze = analyze
+        self.db = db
+        self.batch_size = batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.submit_timeout_seconds = submit_timeout_seconds
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="sentiment"
+        )
+        self._thread = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.scored = 0
+        self.scored_inline = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        """Starts the worker thread, if not running"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name="sentiment-worker", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, document: firestore.DocumentReference, text: str):
+        """Queues a message to score
+
+        Args:
+            document: firestore.DocumentReference
+                Message document to patch
+            text: str
+                Message text
+        """
+        with self._lock:
+            self.submitted += 1
+            running = (
+                self._thread is not None
+                and self._thread.is_alive()
+                and not self._stopping
+            )
+        if not running:
+            self._score_inline(SentimentTask(document, text))
+            return
+        try:
+            self._queue.put(
+                SentimentTask(document, text),
+                timeout=self.submit_timeout_seconds,
+            )
+        except queue.Full:
+            self._score_inline(SentimentTask(document, text))
+
+    def stop(self, timeout: float | None = None):
+        """Scores the queued messages and stops the worker thread
+
+        Args:
+            timeout: float | None
+                Seconds to wait for the queue to drain
+        """
+        with self._lock:
+            self._stopping = True
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                # Wakes up a worker waiting on an empty queue. A worker
+                # busy with a full queue sees the stopping flag instead.
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+            if thread.is_alive():
+                print(
+                    "[Error]sentiment_worker: "
+                    f"{self._queue.qsize()} messages not scored"
+                )
+
+    def _score_inline(self, task: SentimentTask):
+        with self._lock:
+            self.scored_inline += 1
+        self._write([task], [self.analyze(task.text)])
+
+    def _next_batch(self) -> tuple[list[SentimentTask], bool]:
+        """Waits for a message, then takes the next ones for up to
+        batch_wait_seconds
+
+        Returns:
+            tuple[list[SentimentTask], bool]
+                Messages of the batch, and True if the worker is stopping
+        """
+        task = self._queue.get()
+        if task is _STOP:
+            return [], True
+        tasks = [task]
+        deadline = time.monotonic() + self.batch_wait_seconds
+        while len(tasks) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                task = (
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if task is _STOP:
+                return tasks, True
+            tasks.append(task)
+        return tasks, False
+
+    def _run(self):
+        stopping = False
+        while True:
+            with self._lock:
+                stopping = stopping or self._stopping
+            if stopping:
+                # Drain without waiting for more messages
+                tasks = []
+                while len(tasks) < self.batch_size:
+                    try:
+                        task = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if task is not _STOP:
+                        tasks.append(task)
+                if not tasks:
+                    return
+            else:
+                tasks, stopping = self._next_batch()
+                if not tasks:
+                    continue
+            try:
+                sentiments = list(
+                    self._pool.map(self.analyze, [t.text for t in tasks])
+                )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # The worker must keep consuming the queue
+                print(f"[Error]sentiment_worker:{e}")
+                with self._lock:
+                    self.errors += 1
+                continue
+            self._write(tasks, sentiments)
+
+    def _write(self, tasks: list[SentimentTask], sentiments: list[dict]):
+        """Patches the sentiments onto the documents in one batched write"""
+        try:
+            batch = self.db.batch()
+            for task, sentiment in zip(tasks, sentiments):
+                batch.update(task.document, sentiment)
+            batch.commit()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"[Error]sentiment_write:{e}")
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            self.scored += len(tasks)
+            self.batches += 1
+
+    def stats(self) -> dict:
+        """Returns the worker counters
+
+        Returns:
+            dict
+                Submitted, scored and inline scored messages, batches,
+                write errors and queued messages
+        """
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "scored": self.scored,
+                "scored_inline": self.scored_inline,
+                "batches": self.batches,
+                "errors": self.errors,
+                "queued": self._queue.qsize(),
+            }
+
+
+lang_client = lazy(language_v1.LanguageServiceClient)
+db = lazy(firestore.Client)
+
+sentiment_worker = SentimentWorker(
+    # The lazy client is created inside analyze_sentiment's error handling
+    analyze=lambda text: analyze_sentiment(lang_client, text),
+    db=db,
+    max_queue_size=sentiment_cfg.get("max_queue_size", 1000),
+    batch_size=sentiment_cfg.get("batch_size", 16),
+    batch_wait_seconds=sentiment_cfg.get("batch_wait_seconds", 0.05),
+    concurrency=sentiment_cfg.get("concurrency", 4),
+    submit_timeout_seconds=sentiment_cfg.get("submit_timeout_seconds", 0.1),
+)
+
+register_metrics("sentiment_worker", sentiment_worker.stats)
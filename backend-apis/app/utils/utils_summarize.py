@@ -0,0 +1,200 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Utils for map-reduce summarization of large item lists (e.g. reviews)
+
+Items are partitioned, in order, into chunks that fit a token budget.
+Chunks are summarized concurrently (map) and the partial summaries are
+merged (reduce). Chunk summaries go through the LLM response cache, so
+appending an item only re-summarizes the last chunk.
+
+Growing lists (e.g. chat messages) can instead be folded into a rolling
+summary, sending only the items added since the last summary.
+"""
+
+import json
+import tomllib
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    summary_cfg = config["summary"]
+
+TOKEN_BUDGET = summary_cfg.get("map_reduce_token_budget", 8000)
+CHUNK_SUMMARY_TTL = summary_cfg.get("chunk_summary_ttl_seconds", 604800)
+MAX_REDUCE_ROUNDS = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens of a text (~4 characters per token)
+
+    Args:
+        text: str
+            Text
+
+    Returns:
+        int
+            Estimated number of tokens
+    """
+    return len(text) // 4 + 1
+
+
+def chunk_items(items: list, token_budget: int = TOKEN_BUDGET) -> list:
+    """Partitions items, in order, into chunks that fit a token budget.
+
+    An item larger than the budget gets a chunk of its own.
+
+    Args:
+        items: list
+            JSON serializable items
+        token_budget: int
+            Maximum estimated tokens of a chunk
+
+    Returns:
+        list
+            List of chunks (lists of items)
+    """
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for item in items:
+        item_tokens = estimate_tokens(json.dumps(item))
+        if chunk and chunk_tokens + item_tokens > token_budget:
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(item)
+        chunk_tokens += item_tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def summarize_chunks(
+    items: list,
+    map_prompt: str,
+    token_budget: int = TOKEN_BUDGET,
+    timeout: float | None = None,
+) -> list[str]:
+    """Summarizes the chunks of a list of items concurrently (map)
+
+    Args:
+        items: list
+            JSON serializable items
+        map_prompt: str
+            Prompt template with an {items} placeholder
+        token_budget: int
+            Maximum estimated tokens of a chunk
+        timeout: float | None
+            Seconds to wait for each chunk summary
+
+    Returns:
+        list[str]
+            Summary of each chunk. Failed chunks are left out.
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from app.utils import utils_gemini
+
+    summaries = await utils_gemini.run_predict_text_llm(
+        prompts=[
+            map_prompt.format(items=json.dumps(chunk))
+            for chunk in chunk_items(items, token_budget)
+        ],
+        use_cache=True,
+        cache_ttl_seconds=CHUNK_SUMMARY_TTL,
+        timeout=timeout,
+    )
+    return [summary for summary in summaries if summary]
+
+
+async def map_reduce_summarize(
+    items: list,
+    map_prompt: str,
+    reduce_prompt: str,
+    token_budget: int = TOKEN_BUDGET,
+    **reduce_args,
+) -> str:
+    """Summarizes a list of items that does not fit a single prompt
+
+    Args:
+        items: list
+            JSON serializable items
+        map_prompt: str
+            Prompt template with an {items} placeholder, used for the
+            chunks of items and of partial summaries
+        reduce_prompt: str
+            Prompt template with a {summaries} placeholder and the
+            placeholders of reduce_args, used to merge the summaries
+        token_budget: int
+            Maximum estimated tokens of a chunk
+        **reduce_args:
+            Other values of the reduce prompt (e.g. the product)
+
+    Returns:
+        str
+            Summary
+    """
+    summaries = await summarize_chunks(items, map_prompt, token_budget)
+    for _ in range(MAX_REDUCE_ROUNDS):
+        if estimate_tokens(json.dumps(summaries)) <= token_budget:
+            break
+        summaries = await summarize_chunks(
+            summaries, map_prompt, token_budget
+        )
+
+    # pylint: disable-next=import-outside-toplevel
+    from app.utils import utils_gemini
+
+    return await utils_gemini.async_predict_text_llm(
+        prompt=reduce_prompt.format(
+            summaries=json.dumps(summaries), **reduce_args
+        ),
+        max_output_tokens=1024,
+    )
+
+
+async def fold_summary(
+    summary: str,
+    items: list,
+    fold_prompt: str,
+    token_budget: int = TOKEN_BUDGET,
+) -> str:
+    """Folds new items into a rolling summary, one chunk at a time
+
+    Args:
+        summary: str
+            Current summary, empty for the first items
+        items: list
+            JSON serializable items added since the summary
+        fold_prompt: str
+            Prompt template with {summary} and {items} placeholders
+        token_budget: int
+            Maximum estimated tokens of a chunk
+
+    Returns:
+        str
+            Updated summary, empty if a call failed
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from app.utils import utils_gemini
+
+    for chunk in chunk_items(items, token_budget):
+        summary = await utils_gemini.async_predict_text_llm(
+            prompt=fold_prompt.format(
+                summary=summary, items=json.dumps(chunk)
+            ),
+            max_output_tokens=1024,
+        )
+        if not summary:
+            return ""
+    return summary
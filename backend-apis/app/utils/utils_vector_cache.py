@@ -0,0 +1,313 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Approximate cache of Vector Search results, keyed by query vector
+
+Query vectors are bucketed with sign-bit LSH (random hyperplanes), in
+several tables so near-identical queries share at least one bucket with
+a high probability. A cached result is reused when the cosine similarity
+of the queries reaches `similarity_threshold`. Scaling a query does not
+change its dot product ranking, so the cosine similarity is the right
+measure.
+
+A sample of the hits can be verified against Vector Search, to compare
+the hit rate with the overlap of the cached and the fresh neighbors. A
+verified hit replaces the cached result with the fresh one.
+
+The cache changes the search results, so it is disabled unless enabled
+in config.toml.
+"""
+
+import itertools
+import random
+import threading
+import tomllib
+
+import numpy as np
+
+from app.utils.utils_cache import TTLCache
+from app.utils.utils_metrics import register_metrics
+
+with open("app/config.toml", "rb") as f:
+    config = tomllib.load(f)
+    vector_search_cache_cfg = config.get("vector_search_cache", {})
+
+# Most recent entries kept per bucket
+MAX_BUCKET_ENTRIES = 8
+
+
+class QueryVectorCache:
+    """Results of Vector Search queries, reused for similar queries"""
+
+    def __init__(
+        self,
+        similarity_threshold: float = 0.99,
+        lsh_tables: int = 4,
+        lsh_bits: int = 12,
+        max_size: int = 2048,
+        ttl_seconds: float = 600,
+        verify_sample_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            similarity_threshold: float
+                Minimum cosine similarity of a query and a cached query
+            lsh_tables: int
+                Number of LSH tables. More tables find more similar
+                queries.
+            lsh_bits: int
+                Hyperplanes per table. More bits make smaller buckets.
+            max_size: int
+                Maximum number of cached results
+            ttl_seconds: float
+                TTL of the cached results
+            verify_sample_rate: float
+                Fraction of the hits also sent to Vector Search to measure
+                the overlap of the neighbors
+            seed: int
+                Seed of the hyperplanes
+        """
+        self.similarity_threshold = similarity_threshold
+        self.lsh_tables = lsh_tables
+        self.lsh_bits = lsh_bits
+        self.verify_sample_rate = verify_sample_rate
+        self.seed = seed
+        self.entries = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self._planes: dict[int, np.ndarray] = {}
+        self._buckets: dict[tuple, list[int]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.verified_hits = 0
+        self.overlap_sum = 0.0
+
+    def _signatures(self, vector: np.ndarray) -> list[bytes]:
+        """LSH signature of a normalized vector in each table"""
+        planes = self._planes.get(vector.size)
+        if planes is None:
+            planes = np.random.default_rng(self.seed).standard_normal(
+                (self.lsh_tables * self.lsh_bits, vector.size)
+            ).astype(np.float32)
+            self._planes[vector.size] = planes
+        bits = (planes @ vector >= 0).reshape(self.lsh_tables, self.lsh_bits)
+        return [np.packbits(row).tobytes() for row in bits]
+
+    def get(self, index_key: str, feature_vector, neighbor_count: int):
+        """Gets the cached result of a similar query
+
+        Args:
+            index_key: str
+                Index endpoint and deployed index of the query
+            feature_vector:
+                Query vector
+            neighbor_count: int
+                Number of neighbors of the query
+
+        Returns:
+            The cached result and the similarity of the queries, or
+            (None, 0.0) if there is no similar query
+        """
+        vector = _normalize(feature_vector)
+        best, best_similarity = None, 0.0
+        with self._lock:
+            for table, signature in enumerate(self._signatures(vector)):
+                bucket = self._buckets.get((index_key, table, signature), [])
+                for entry_id in list(bucket):
+                    entry = self.entries.get(entry_id)
+                    if entry is None:
+                        bucket.remove(entry_id)
+                        continue
+                    cached_vector, cached_count, result = entry
+                    if cached_count < neighbor_count:
+                        continue
+                    similarity = float(cached_vector @ vector)
+                    if similarity > best_similarity:
+                        best, best_similarity = result, similarity
+                if not bucket:
+                    self._buckets.pop((index_key, table, signature), None)
+
+            if best is not None and best_similarity >= (
+                self.similarity_threshold
+            ):
+                self.hits += 1
+                return best, best_similarity
+            self.misses += 1
+            return None, 0.0
+
+    def set(
+        self, index_key: str, feature_vector, neighbor_count: int, result
+    ):
+        """Stores the result of a query
+
+        Args:
+            index_key: str
+                Index endpoint and deployed index of the query
+            feature_vector:
+                Query vector
+            neighbor_count: int
+                Number of neighbors of the query
+            result:
+                Result of the query
+        """
+        vector = _normalize(feature_vector)
+        with self._lock:
+            entry_id = next(self._ids)
+            self.entries.set(entry_id, (vector, neighbor_count, result))
+            for table, signature in enumerate(self._signatures(vector)):
+                bucket = self._buckets.setdefault(
+                    (index_key, table, signature), []
+                )
+                bucket.append(entry_id)
+                del bucket[:-MAX_BUCKET_ENTRIES]
+            max_buckets = 2 * self.lsh_tables * self.entries.max_size
+            if len(self._buckets) > max_buckets:
+                self._prune_buckets()
+
+    def replace(
+        self,
+        index_key: str,
+        cached_result,
+        feature_vector,
+        neighbor_count: int,
+        result,
+    ):
+        """Replaces the cached result of a verified hit with the fresh one
+
+        Args:
+            index_key: str
+                Index endpoint and deployed index of the query
+            cached_result:
+                Result returned by get for the query
+            feature_vector:
+                Query vector
+            neighbor_count: int
+                Number of neighbors of the query
+            result:
+                Result returned by Vector Search
+        """
+        vector = _normalize(feature_vector)
+        with self._lock:
+            # The hit was found in one of the buckets of the query
+            for table, signature in enumerate(self._signatures(vector)):
+                bucket = self._buckets.get((index_key, table, signature), [])
+                for entry_id in bucket:
+                    entry = self.entries.get(entry_id)
+                    if entry is not None and entry[2] is cached_result:
+                        self.entries.invalidate(entry_id)
+        self.set(index_key, feature_vector, neighbor_count, result)
+
+    def _prune_buckets(self):
+        """Removes the buckets of evicted and expired entries"""
+        # pylint: disable-next=protected-access
+        live_ids = set(self.entries._entries)
+        for key in list(self._buckets):
+            self._buckets[key] = [
+                i for i in self._buckets[key] if i in live_ids
+            ]
+            if not self._buckets[key]:
+                del self._buckets[key]
+
+    def should_verify(self) -> bool:
+        """True if a hit should also be sent to Vector Search"""
+        return random.random() < self.verify_sample_rate
+
+    def record_overlap(self, cached_ids: list[str], fresh_ids: list[str]):
+        """Records the overlap of the cached and the fresh neighbors of a
+        verified hit
+
+        Args:
+            cached_ids: list[str]
+                Neighbor ids of the cached result
+            fresh_ids: list[str]
+                Neighbor ids returned by Vector Search
+        """
+        overlap = (
+            len(set(cached_ids) & set(fresh_ids)) / len(fresh_ids)
+            if fresh_ids
+            else 1.0
+        )
+        with self._lock:
+            self.verified_hits += 1
+            self.overlap_sum += overlap
+
+    def stats(self) -> dict:
+        """Returns the cache counters
+
+        Returns:
+            dict
+                Hits, misses, hit rate and mean neighbors overlap of the
+                verified hits
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "verified_hits": self.verified_hits,
+                "mean_overlap": (
+                    self.overlap_sum / self.verified_hits
+                    if self.verified_hits
+                    else None
+                ),
+                "size": self.entries.stats()["size"],
+            }
+
+
+def _normalize(feature_vector) -> np.ndarray:
+    vector = np.asarray(feature_vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def create_query_vector_cache(cfg: dict) -> QueryVectorCache | None:
+    """Creates the query vector cache from the [vector_search_cache]
+    section of config.toml
+
+    Args:
+        cfg: dict
+            [vector_search_cache] section
+
+    Returns:
+        QueryVectorCache | None
+            None if the cache is disabled
+    """
+    if not cfg.get("enabled", False):
+        return None
+    return QueryVectorCache(
+        similarity_threshold=cfg.get("similarity_threshold", 0.99),
+        lsh_tables=cfg.get("lsh_tables", 4),
+        lsh_bits=cfg.get("lsh_bits", 12),
+        max_size=cfg.get("max_size", 2048),
+        ttl_seconds=cfg.get("ttl_seconds", 600),
+        verify_sample_rate=cfg.get("verify_sample_rate", 0.0),
+    )
+
+
+query_vector_cache = create_query_vector_cache(vector_search_cache_cfg)
+
+
+def get_vector_search_cache_stats() -> dict:
+    """Gets the query vector cache counters
+
+    Returns:
+        dict
+            Counters of the cache, empty if it is disabled
+    """
+    return query_vector_cache.stats() if query_vector_cache else {}
+
+
+register_metrics("vector_search_cache", get_vector_search_cache_stats)
@@ -16,12 +16,26 @@
 Utility module for Vertex AI Vector Search
 """
 
+import asyncio
+import hashlib
+import threading
 import tomllib
+import typing
 
+import numpy as np
 from google.cloud import aiplatform_v1
 
+from app.utils.utils_lazy import lazy
+from app.utils.utils_local_vector import LocalVectorIndex, load_local_index
+from app.utils.utils_singleflight import get_group, make_key
+from app.utils.utils_vector_cache import query_vector_cache
+
 with open("app/config.toml", "rb") as f:
     config = tomllib.load(f)
+    local_vector_cfg = config.get("local_vector", {})
+
+# Identical concurrent queries share one Vector Search call
+search_singleflight = get_group("vector_search")
 
 project_id = config["global"]["project_id"]
 project_number = config["global"]["project_number"]
@@ -43,29 +57,330 @@ p5_reviews_deployed_index_id = config["search-persona5"][
     "reviews_deployed_index_id"
 ]
 
-p1_match_client = aiplatform_v1.MatchServiceClient(
-    client_options={
-        "api_endpoint": config["multimodal"]["vector_api_endpoint"]
-    }
+# One client, and so one channel, per Vector Search endpoint
+_match_clients: dict[str, aiplatform_v1.MatchServiceClient] = {}
+_match_clients_lock = threading.Lock()
+# Async clients are bound to the event loop they are created in. They
+# live in a dedicated event loop, shared by the app event loop and the
+# ones created with asyncio.run by sync routes.
+_async_match_clients: dict[str, aiplatform_v1.MatchServiceAsyncClient] = {}
+
+
+def _start_match_loop() -> asyncio.AbstractEventLoop:
+    """Starts the event loop of the async match clients in a thread"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(
+        target=loop.run_forever, name="vector-search-loop", daemon=True
+    ).start()
+    return loop
+
+
+_match_loop = lazy(_start_match_loop, name="vector_search_loop")
+
+
+def _local_index(path: str) -> LocalVectorIndex | None:
+    """Declares the local index of a file, loaded on first use"""
+    if not path:
+        return None
+    return lazy(
+        lambda: load_local_index(path, local_vector_cfg),
+        name=f"LocalVectorIndex({path})",
+    )
+
+
+class VectorIndex(typing.NamedTuple):
+    """Deployed index of a persona / user journey"""
+
+    index_endpoint_id: str
+    deployed_index_id: str
+    api_endpoint: str
+    # Index served in process instead of Vector Search, when configured
+    local_index: LocalVectorIndex | None = None
+
+
+p1_index = VectorIndex(
+    index_endpoint_id=p1_index_endpoint_id,
+    deployed_index_id=p1_deployed_index_id,
+    api_endpoint=config["multimodal"]["vector_api_endpoint"],
+    local_index=_local_index(config["multimodal"].get("local_index_path")),
 )
-p5_conversations_match_client = aiplatform_v1.MatchServiceClient(
-    client_options={
-        "api_endpoint": config["search-persona5"][
-            "conversations_vector_api_endpoint"
-        ]
-    }
+p5_conversations_index = VectorIndex(
+    index_endpoint_id=p5_conversations_index_endpoint_id,
+    deployed_index_id=p5_conversations_deployed_index_id,
+    api_endpoint=config["search-persona5"][
+        "conversations_vector_api_endpoint"
+    ],
+    local_index=_local_index(
+        config["search-persona5"].get("conversations_local_index_path")
+    ),
 )
-p5_reviews_match_client = aiplatform_v1.MatchServiceClient(
-    client_options={
-        "api_endpoint": config["search-persona5"][
-            "reviews_vector_api_endpoint"
-        ]
-    }
+p5_reviews_index = VectorIndex(
+    index_endpoint_id=p5_reviews_index_endpoint_id,
+    deployed_index_id=p5_reviews_deployed_index_id,
+    api_endpoint=config["search-persona5"]["reviews_vector_api_endpoint"],
+    local_index=_local_index(
+        config["search-persona5"].get("reviews_local_index_path")
+    ),
 )
 
 
+class NeighborQuery(typing.NamedTuple):
+    """Query of a find_neighbors request"""
+
+    feature_vector: np.ndarray | list
+    datapoint_id: str = "0"
+    neighbor_count: int = 10
+
+
+def get_index(
+    persona: int = 1, user_journey: str = "conversations"
+) -> VectorIndex:
+    """Gets the index of a persona and user journey
+
+    Args:
+        persona: int
+            1 (products) or 5
+        user_journey: str
+            conversations | reviews, for persona 5
+
+    Returns:
+        VectorIndex
+    """
+    if persona == 1:
+        return p1_index
+    if user_journey == "conversations":
+        return p5_conversations_index
+    return p5_reviews_index
+
+
+def get_match_client(api_endpoint: str) -> aiplatform_v1.MatchServiceClient:
+    """Gets the shared match client of an endpoint, created on first use
+
+    Args:
+        api_endpoint: str
+            Public endpoint domain of the index endpoint
+
+    Returns:
+        aiplatform_v1.MatchServiceClient
+    """
+    with _match_clients_lock:
+        if api_endpoint not in _match_clients:
+            _match_clients[api_endpoint] = aiplatform_v1.MatchServiceClient(
+                client_options={"api_endpoint": api_endpoint}
+            )
+        return _match_clients[api_endpoint]
+
+
+async def _async_find_neighbors_request(
+    api_endpoint: str, request: aiplatform_v1.FindNeighborsRequest
+) -> aiplatform_v1.FindNeighborsResponse:
+    """Sends a request with the shared async match client of an endpoint.
+    Runs in the match event loop, which creates the clients.
+    """
+    if api_endpoint not in _async_match_clients:
+        _async_match_clients[
+            api_endpoint
+        ] = aiplatform_v1.MatchServiceAsyncClient(
+            client_options={"api_endpoint": api_endpoint}
+        )
+    return await _async_match_clients[api_endpoint].find_neighbors(request)
+
+
+def _build_request(
+    index: VectorIndex, queries: list[NeighborQuery]
+) -> tuple[aiplatform_v1.FindNeighborsRequest, str]:
+    """Builds a request with one Query per query, and its singleflight key.
+    Vectors are converted to lists only here.
+    """
+    vectors = [
+        np.asarray(query.feature_vector, dtype=np.float32)
+        for query in queries
+    ]
+    request = aiplatform_v1.FindNeighborsRequest(
+        index_endpoint=f"projects/{project_number}/locations/us-central1/"
+        f"indexEndpoints/{index.index_endpoint_id}",
+        deployed_index_id=index.deployed_index_id,
+        return_full_datapoint=False,
+        queries=[
+            aiplatform_v1.FindNeighborsRequest.Query(
+                datapoint=aiplatform_v1.IndexDatapoint(
+                    datapoint_id=query.datapoint_id,
+                    feature_vector=vector.tolist(),
+                ),
+                neighbor_count=query.neighbor_count,
+            )
+            for query, vector in zip(queries, vectors)
+        ],
+    )
+    key = make_key(
+        index.index_endpoint_id,
+        index.deployed_index_id,
+        [
+            (
+                hashlib.sha256(vector.tobytes()).hexdigest(),
+                query.datapoint_id,
+                query.neighbor_count,
+            )
+            for query, vector in zip(queries, vectors)
+        ],
+    )
+    return request, key
+
+
+def _get_cached_neighbors(
+    index: VectorIndex, queries: list[NeighborQuery]
+) -> tuple[list, list[int]]:
+    """Looks up the queries in the query vector cache
+
+    Returns:
+        tuple[list, list[int]]
+            Cached nearest neighbors of each query (None if missing), and
+            positions of the queries to send to Vector Search: the misses
+            and the hits sampled for verification
+    """
+    if query_vector_cache is None:
+        return [None] * len(queries), list(range(len(queries)))
+
+    index_key = f"{index.index_endpoint_id}/{index.deployed_index_id}"
+    cached = []
+    positions = []
+    for position, query in enumerate(queries):
+        result, _ = query_vector_cache.get(
+            index_key, query.feature_vector, query.neighbor_count
+        )
+        cached.append(result)
+        if result is None or query_vector_cache.should_verify():
+            positions.append(position)
+    return cached, positions
+
+
+def _merge_neighbors(
+    index: VectorIndex,
+    queries: list[NeighborQuery],
+    cached: list,
+    positions: list[int],
+    response: aiplatform_v1.FindNeighborsResponse,
+) -> aiplatform_v1.FindNeighborsResponse:
+    """Caches the results of the sent queries and merges them with the
+    cached ones, in the order of the queries. The fresh result of a
+    verified hit replaces the cached one.
+    """
+    if query_vector_cache is None:
+        return response
+
+    index_key = f"{index.index_endpoint_id}/{index.deployed_index_id}"
+    results = list(cached)
+    for position, nearest in zip(positions, response.nearest_neighbors):
+        query = queries[position]
+        if cached[position] is None:
+            query_vector_cache.set(
+                index_key, query.feature_vector, query.neighbor_count, nearest
+            )
+        else:
+            query_vector_cache.record_overlap(
+                [
+                    n.datapoint.datapoint_id
+                    for n in cached[position].neighbors
+                ][: query.neighbor_count],
+                [n.datapoint.datapoint_id for n in nearest.neighbors],
+            )
+            query_vector_cache.replace(
+                index_key,
+                cached[position],
+                query.feature_vector,
+                query.neighbor_count,
+                nearest,
+            )
+        results[position] = nearest
+
+    return aiplatform_v1.FindNeighborsResponse(
+        nearest_neighbors=[
+            aiplatform_v1.FindNeighborsResponse.NearestNeighbors(
+                id=query.datapoint_id,
+                neighbors=list(nearest.neighbors)[: query.neighbor_count],
+            )
+            for query, nearest in zip(queries, results)
+        ]
+    )
+
+
+def find_neighbors(
+    queries: list[NeighborQuery],
+    persona: int = 1,
+    user_journey: str = "conversations",
+) -> aiplatform_v1.FindNeighborsResponse:
+    """Finds the neighbors of several vectors in a single request
+
+    Args:
+        queries: list[NeighborQuery]
+            Vector, datapoint id and neighbor count of each query
+        persona: int
+            1 (products) or 5
+        user_journey: str
+            conversations | reviews, for persona 5
+
+    Returns:
+        aiplatform_v1.FindNeighborsResponse
+            Nearest neighbors of each query, in order
+    """
+    index = get_index(persona, user_journey)
+    if index.local_index is not None:
+        return index.local_index.find_neighbors_batch(queries)
+
+    cached, positions = _get_cached_neighbors(index, queries)
+    response = aiplatform_v1.FindNeighborsResponse()
+    if positions:
+        request, key = _build_request(index, [queries[i] for i in positions])
+        response = search_singleflight.do(
+            key, get_match_client(index.api_endpoint).find_neighbors, request
+        )
+    return _merge_neighbors(index, queries, cached, positions, response)
+
+
+async def async_find_neighbors(
+    queries: list[NeighborQuery],
+    persona: int = 1,
+    user_journey: str = "conversations",
+) -> aiplatform_v1.FindNeighborsResponse:
+    """Finds the neighbors of several vectors in a single request, with
+    the async match client, so it can run alongside other reads
+
+    Args:
+        queries: list[NeighborQuery]
+            Vector, datapoint id and neighbor count of each query
+        persona: int
+            1 (products) or 5
+        user_journey: str
+            conversations | reviews, for persona 5
+
+    Returns:
+        aiplatform_v1.FindNeighborsResponse
+            Nearest neighbors of each query, in order
+    """
+    index = get_index(persona, user_journey)
+    if index.local_index is not None:
+        return index.local_index.find_neighbors_batch(queries)
+
+    cached, positions = _get_cached_neighbors(index, queries)
+    response = aiplatform_v1.FindNeighborsResponse()
+    if positions:
+        request, key = _build_request(index, [queries[i] for i in positions])
+        response = await search_singleflight.do_async(
+            key,
+            lambda: asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(
+                    _async_find_neighbors_request(
+                        index.api_endpoint, request
+                    ),
+                    _match_loop.get(),
+                )
+            ),
+        )
+    return _merge_neighbors(index, queries, cached, positions, response)
+
+
 def find_neighbor(
-    feature_vector: list,
+    feature_vector: np.ndarray | list,
     datapoint_id: str = "0",
     neighbor_count: int = 10,
     persona: int = 1,
@@ -75,42 +390,18 @@ def find_neighbor(
 
     Args:
         feature_vector:
+            Embedding, as a float32 vector or a list. It is converted to a
+            list only when building the request.
         datapoint_id:
         neighbor_count:
-        return_full_datapoint:
         persona:
         user_journey:
 
     Returns:
 
     """
-    if persona == 1:
-        index_endpoint_id = p1_index_endpoint_id
-        deployed_index_id = p1_deployed_index_id
-        match_client = p1_match_client
-    else:
-        if user_journey == "conversations":
-            index_endpoint_id = p5_conversations_index_endpoint_id
-            deployed_index_id = p5_conversations_deployed_index_id
-            match_client = p5_conversations_match_client
-        else:
-            index_endpoint_id = p5_reviews_index_endpoint_id
-            deployed_index_id = p5_reviews_deployed_index_id
-            match_client = p5_reviews_match_client
-
-    query = aiplatform_v1.FindNeighborsRequest.Query(
-        datapoint=aiplatform_v1.IndexDatapoint(
-            datapoint_id=datapoint_id, feature_vector=feature_vector
-        ),
-        neighbor_count=neighbor_count,
+    return find_neighbors(
+        [NeighborQuery(feature_vector, datapoint_id, neighbor_count)],
+        persona=persona,
+        user_journey=user_journey,
     )
-
-    request = aiplatform_v1.FindNeighborsRequest(
-        index_endpoint=f"projects/{project_number}/locations/us-central1/"
-        f"indexEndpoints/{index_endpoint_id}",
-        deployed_index_id=deployed_index_id,
-        return_full_datapoint=False,
-        queries=[query],
-    )
-
-    return match_client.find_neighbors(request)
@@ -28,6 +28,7 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
 from app.models.p1_model import SalesforceEmailSupportRequest
+from app.utils.utils_lazy import lazy
 from app.utils.utils_ws_protocols import (
     DocsProtocol,
     DocumentResource,
@@ -43,18 +44,25 @@ calendar_id = config["workspace"]["calendar_id"]
 project_id = config["global"]["project_id"]
 calendar_secret_id = config["workspace"]["calendar_secret_id"]
 
-secret_client = secretmanager.SecretManagerServiceClient()
-secret_user_info = secret_client.access_secret_version(
-    request={"name": calendar_secret_id}
-)
-workspace_user_info = json.loads(secret_user_info.payload.data.decode("UTF-8"))
-calendar_credentials = Credentials.from_authorized_user_info(
-    info=workspace_user_info, scopes=config["workspace"]["calendar_scopes"]
-)
 
-calendar_service = build(
-    serviceName="calendar", version="v3", credentials=calendar_credentials
-)
+def _build_calendar_service():
+    secret_client = secretmanager.SecretManagerServiceClient()
+    secret_user_info = secret_client.access_secret_version(
+        request={"name": calendar_secret_id}
+    )
+    workspace_user_info = json.loads(
+        secret_user_info.payload.data.decode("UTF-8")
+    )
+    calendar_credentials = Credentials.from_authorized_user_info(
+        info=workspace_user_info,
+        scopes=config["workspace"]["calendar_scopes"],
+    )
+    return build(
+        serviceName="calendar", version="v3", credentials=calendar_credentials
+    )
+
+
+calendar_service = lazy(_build_calendar_service)
 
 
 class WorkspaceServices:
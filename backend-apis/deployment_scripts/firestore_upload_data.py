@@ -51,7 +51,29 @@ async def review_upload(product_id: str, review: ReviewDoc):
     """
     await firestore_client.collection("website_reviews").document(
         product_id
-    ).collection("reviews").document().set(review)
+    ).collection("reviews").document().set(
+        {**review, "timestamp": firestore.SERVER_TIMESTAMP}
+    )
+
+
+async def review_count_upload(product_id: str, review_count: int):
+    """Updates the review set fingerprint used by the reviews summaries
+
+    Args:
+        product_id:
+            Product ID
+        review_count:
+            Number of reviews uploaded for the product
+    """
+    await firestore_client.collection("website_reviews").document(
+        product_id
+    ).set(
+        {
+            "review_count": firestore.Increment(review_count),
+            "latest_review_at": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,
+    )
 
 
 async def upload_reviews(review_docs: dict[str, list[ReviewDoc]]):
@@ -63,6 +85,12 @@ async def upload_reviews(review_docs: dict[str, list[ReviewDoc]]):
             for review in reviews
         )
     )
+    await asyncio.gather(
+        *(
+            review_count_upload(product_id, len(reviews))
+            for product_id, reviews in review_docs.items()
+        )
+    )
 
 
 async def p5_upload(collection_name, document_id: str, data: dict):
@@ -17,6 +17,7 @@ import base64
 import json
 import os
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import requests
@@ -29,6 +30,18 @@ class EmbeddingResponse(typing.NamedTuple):
     image_embedding: typing.Sequence[float]
 
 
+class EmbeddingInput(typing.NamedTuple):
+    text: str | None = None
+    image_bytes: bytes | None = None
+
+
+# multimodalembedding@001 accepts one instance per predict request
+MAX_INSTANCES_PER_REQUEST = 1
+MAX_CONCURRENT_REQUESTS = 8
+BATCH_SIZE = 32
+IMAGE_DOWNLOAD_TIMEOUT_SECONDS = 30
+
+
 class EmbeddingPredictionClient:
     """Wrapper around Prediction Service Client."""
 
@@ -54,38 +67,73 @@ class EmbeddingPredictionClient:
             raise ValueError(
                 "At least one of text or image_bytes must be specified."
             )
+        return self._predict([EmbeddingInput(text, image_bytes)])[0]
+
+    def get_embeddings(
+        self, batch: list[EmbeddingInput]
+    ) -> list[EmbeddingResponse]:
+        """Embeds a batch of inputs with predict requests of up to
+        MAX_INSTANCES_PER_REQUEST instances, sent concurrently."""
+        requests_instances = [
+            batch[i : i + MAX_INSTANCES_PER_REQUEST]
+            for i in range(0, len(batch), MAX_INSTANCES_PER_REQUEST)
+        ]
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+            responses = pool.map(self._predict, requests_instances)
+        return [embedding for response in responses for embedding in response]
+
+    def _predict(self, inputs: list[EmbeddingInput]):
+        instances = []
+        for embedding_input in inputs:
+            if not embedding_input.text and not embedding_input.image_bytes:
+                raise ValueError(
+                    "At least one of text or image_bytes must be specified."
+                )
+
+            instance = struct_pb2.Struct()
+            if embedding_input.text:
+                instance.fields["text"].string_value = embedding_input.text
+
+            if embedding_input.image_bytes:
+                encoded_content = base64.b64encode(
+                    embedding_input.image_bytes
+                ).decode("utf-8")
+                image_struct = instance.fields["image"].struct_value
+                image_struct.fields[
+                    "bytesBase64Encoded"
+                ].string_value = encoded_content
+            instances.append(instance)
 
-        instance = struct_pb2.Struct()
-        if text:
-            instance.fields["text"].string_value = text
-
-        if image_bytes:
-            encoded_content = base64.b64encode(image_bytes).decode("utf-8")
-            image_struct = instance.fields["image"].struct_value
-            image_struct.fields[
-                "bytesBase64Encoded"
-            ].string_value = encoded_content
-
-        instances = [instance]
         endpoint = (
             f"projects/{self.project}/locations/{self.location}"
             "/publishers/google/models/multimodalembedding@001"
         )
         response = self.client.predict(endpoint=endpoint, instances=instances)
+        if len(response.predictions) != len(inputs):
+            raise ValueError(
+                f"Embedding request of {len(inputs)} instances returned "
+                f"{len(response.predictions)} predictions"
+            )
 
-        text_embedding = None
-        if text:
-            text_emb_value = response.predictions[0]["textEmbedding"]
-            text_embedding = [v for v in text_emb_value]
-
-        image_embedding = None
-        if image_bytes:
-            image_emb_value = response.predictions[0]["imageEmbedding"]
-            image_embedding = [v for v in image_emb_value]
-
-        return EmbeddingResponse(
-            text_embedding=text_embedding, image_embedding=image_embedding
-        )
+        embeddings = []
+        for embedding_input, prediction in zip(inputs, response.predictions):
+            text_embedding = None
+            if embedding_input.text:
+                text_emb_value = prediction["textEmbedding"]
+                text_embedding = [v for v in text_emb_value]
+
+            image_embedding = None
+            if embedding_input.image_bytes:
+                image_emb_value = prediction["imageEmbedding"]
+                image_embedding = [v for v in image_emb_value]
+
+            embeddings.append(
+                EmbeddingResponse(
+                    text_embedding=text_embedding,
+                    image_embedding=image_embedding,
+                )
+            )
+        return embeddings
 
 
 def reduce_embedding_dimension(
@@ -101,18 +149,35 @@ def reduce_embedding_dimension(
     return list(max_pooled_rows)
 
 
-def image_text_to_embedding(text: str, image_uri: str) -> list:
-    image_contents = requests.get(image_uri).content
-    response = embeddings_client.get_embedding(
-        text=text[:1020], image_bytes=image_contents
-    )
+def download_image(uri: str) -> bytes:
+    response = requests.get(uri, timeout=IMAGE_DOWNLOAD_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.content
 
-    reduced_vector = reduce_embedding_dimension(
-        vector_image=response.image_embedding,
-        vector_text=response.text_embedding,
-    )
 
-    return reduced_vector
+def products_to_embeddings(products: list) -> list:
+    """Embeds the title, description and image of a batch of products"""
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+        images_contents = list(
+            pool.map(lambda p: download_image(p["uri"]), products)
+        )
+
+    responses = embeddings_client.get_embeddings(
+        [
+            EmbeddingInput(
+                text=(product["title"] + " " + product["description"])[:1020],
+                image_bytes=image_contents,
+            )
+            for product, image_contents in zip(products, images_contents)
+        ]
+    )
+    return [
+        reduce_embedding_dimension(
+            vector_image=response.image_embedding,
+            vector_text=response.text_embedding,
+        )
+        for response in responses
+    ]
 
 
 def generate_metadata_upsert(input_dir: str, output_dir: str):
@@ -122,18 +187,17 @@ def generate_metadata_upsert(input_dir: str, output_dir: str):
         products = [json.loads(p) for p in f.readlines()]
 
     metadata = {"datapoints": []}
-    for product in products:
-        id = product["id"] if product["id"] != "0" else "1000"
-        print(id)
-
-        feature_vector = image_text_to_embedding(
-            text=product["title"] + " " + product["description"],
-            image_uri=product["uri"],
-        )
-
-        metadata["datapoints"].append(
-            {"datapoint_id": id, "feature_vector": feature_vector}
-        )
+    for i in range(0, len(products), BATCH_SIZE):
+        batch = products[i : i + BATCH_SIZE]
+        print(f"Embedding products {i} to {i + len(batch)}")
+
+        for product, feature_vector in zip(
+            batch, products_to_embeddings(batch)
+        ):
+            id = product["id"] if product["id"] != "0" else "1000"
+            metadata["datapoints"].append(
+                {"datapoint_id": id, "feature_vector": feature_vector}
+            )
 
     with open(os.path.join(output_dir, "vector_metadata.json"), "a") as f:
         f.write(json.dumps(metadata))
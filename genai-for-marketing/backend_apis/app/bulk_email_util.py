@@ -20,7 +20,6 @@ Email Generation:
 """
 
 import asyncio
-import functools
 import numpy as np
 import pandas as pd
 import vertexai
@@ -30,8 +29,10 @@ import base64
 from PIL import Image
 
 from google.cloud import translate_v2 as translate
-from vertexai.preview.language_models import TextGenerationModel
-from vertexai.preview.vision_models import ImageGenerationModel
+
+from .utils_llm_executor import llm_executor
+from .utils_models import model_registry
+from .utils_lazy import lazy
 
 
 # Load configuration file
@@ -43,10 +44,7 @@ location = config["global"]["location"]
 vertexai.init(
     project=project_id,
     location=location)
-llm = TextGenerationModel.from_pretrained(
-    config["models"]["text_model_name"])
-imagen = ImageGenerationModel.from_pretrained(config["models"]["image_model_name"])
-translate_client = translate.Client()
+translate_client = lazy(translate.Client)
 
 # Default values
 EMAIL_TEXT_PROMPT = config["prompts"]["prompt_email_text"]
@@ -79,23 +77,22 @@ async def email_generate(row: pd.Series, theme: str, image_context: str) -> pd.S
     
     email_prompt = EMAIL_TEXT_PROMPT.format(prompt_row,
                                             theme)
-    loop = asyncio.get_running_loop()
     progress_text = f"Generating email text for {prompt_row}"
     print(progress_text)
     generated_text = ""
     generated_images = []
 
     try:
-        generated_response = await loop.run_in_executor(
-            None, 
-            functools.partial(
-                llm.predict,
-                prompt=email_prompt,
-                temperature=0.2,
-                max_output_tokens=1024,
-                top_k = 40,
-                top_p = 0.8
-                ))
+        generated_response = await llm_executor.run(
+            config["models"]["text_model_name"],
+            model_registry.get_text_model(
+                config["models"]["text_model_name"]).predict,
+            prompt=email_prompt,
+            temperature=0.2,
+            max_output_tokens=1024,
+            top_k = 40,
+            top_p = 0.8
+            )
     except Exception as e:
         generated_response = None
         print("Error")
@@ -119,14 +116,14 @@ async def email_generate(row: pd.Series, theme: str, image_context: str) -> pd.S
         try:
             prompt_image = IMAGE_PROMPT
             
-            imagen_responses = await loop.run_in_executor(
-                None,
-                functools.partial(
-                    imagen.generate_images,
-                        prompt=prompt_image.format(
-                            image_context
-                            ), 
-                        number_of_images=1))
+            imagen_responses = await llm_executor.run(
+                config["models"]["image_model_name"],
+                model_registry.get_image_model(
+                    config["models"]["image_model_name"]).generate_images,
+                prompt=prompt_image.format(
+                    image_context
+                    ), 
+                number_of_images=1)
         except Exception as e:
             print(prompt_image.format(
                             image_context
@@ -23,10 +23,15 @@ from . import utils_firebase
 from . import utils_trendspotting as trendspotting
 from . import utils_prompt
 from . import bulk_email_util
+from . import utils_models
+from .utils_models import model_registry
+from .utils_lazy import lazy
+from .utils_singleflight import get_group, make_key
 from datetime import datetime, timedelta
 from fastapi import FastAPI, HTTPException, UploadFile, Request, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from googleapiclient.discovery import build
 from google.cloud import bigquery
@@ -36,9 +41,6 @@ from google.cloud import translate_v2 as translate
 from google.oauth2 import service_account
 from proto import Message
 import vertexai
-from vertexai.preview.language_models import TextGenerationModel as bison_latest
-from vertexai.language_models import TextGenerationModel as bison_ga
-from vertexai.preview.vision_models import ImageGenerationModel
 from vertexai.vision_models import Image
 from google.cloud import secretmanager
 import json
@@ -86,7 +88,7 @@ bucket_name = config["global"]["asset_bkt"]
 
 vertexai.init(project=project_id, location=location)
 # Vertex AI Search Client
-search_client = discoveryengine.SearchServiceClient()
+search_client = lazy(discoveryengine.SearchServiceClient)
 vertexai_search_datastore = config["global"]["vertexai_search_datastore"]
 
 # Audiences
@@ -95,30 +97,46 @@ prompt_nl_sql = config["global"]["prompt_nl_sql"]
 tag_name = config["global"]["tag_name"]
 
 # Trendspotting
-bq_client = bigquery.Client(project=project_id)
-datacatalog_client = datacatalog_v1.DataCatalogClient()
+bq_client = lazy(lambda: bigquery.Client(project=project_id))
+datacatalog_client = lazy(datacatalog_v1.DataCatalogClient)
 
-# Text models
-llm_latest = bison_latest.from_pretrained(model_name="text-bison")
-llm_ga = bison_ga.from_pretrained(model_name="text-bison@002")
+# Text models, resolved once by the model registry
+TEXT_MODEL_LATEST = "text-bison"
+TEXT_MODEL_GA = "text-bison@002"
 TEXT_MODEL_NAME = config["models"]["text_model_name"]
 
+# Identical concurrent trend lookups share one upstream call
+trends_singleflight = get_group("trends")
+
 #translation
-translate_client = translate.Client()
+translate_client = lazy(translate.Client)
 
 # Image models
-imagen = ImageGenerationModel.from_pretrained("imagegeneration@002")
+IMAGE_MODEL_NAME = "imagegeneration@002"
+
+# Models resolved at startup, before the API reports ready
+WARM_UP_MODELS = [
+    (utils_models.TEXT, TEXT_MODEL_LATEST),
+    (utils_models.TEXT_GA, TEXT_MODEL_GA),
+    (utils_models.TEXT, TEXT_MODEL_NAME),
+    (utils_models.IMAGE, IMAGE_MODEL_NAME),
+    (utils_models.IMAGE, config["models"]["image_model_name"]),
+]
 
 # Workspace integration
 # Fetch Secret Configuration
-secret_client = secretmanager.SecretManagerServiceClient()
 secret_name = config['global']['secret_name_workspace']
-secret_response = secret_client.access_secret_version(name=secret_name)
-workspace_cred = secret_response.payload.data.decode("UTF-8")
-workspace_cred = json.loads(workspace_cred)
-CREDENTIALS = service_account.Credentials.from_service_account_info(
-    info=workspace_cred, 
-    scopes=config["global"]["workspace_scopes"])
+def load_workspace_credentials() -> service_account.Credentials:
+    secret_client = secretmanager.SecretManagerServiceClient()
+    secret_response = secret_client.access_secret_version(name=secret_name)
+    workspace_cred = secret_response.payload.data.decode("UTF-8")
+    workspace_cred = json.loads(workspace_cred)
+    return service_account.Credentials.from_service_account_info(
+        info=workspace_cred, 
+        scopes=config["global"]["workspace_scopes"])
+# Fetched on first use. Use CREDENTIALS.get(): the Google API client
+# checks the credentials type, so the proxy can not be passed as is.
+CREDENTIALS = lazy(load_workspace_credentials)
 # drive_service = build('drive', 'v3', credentials=CREDENTIALS)
 # docs_service = build('docs', 'v1', credentials=CREDENTIALS)
 # sheets_service = build('sheets', 'v4', credentials=CREDENTIALS)
@@ -179,6 +197,25 @@ async def angular() -> FileResponse:
     return FileResponse("/static/index.html")
 
 
+@app.on_event("startup")
+def warm_up_models():
+    """Resolves the models in the background while the server starts"""
+    model_registry.warm_up_in_background(WARM_UP_MODELS)
+
+
+@app.get(path="/marketing-api/ready")
+def get_readiness() -> JSONResponse:
+    """Readiness of the API
+    Returns:
+        200 once every model is resolved, 503 before, with the status
+        and load time of each model
+    """
+    readiness = model_registry.readiness()
+    return JSONResponse(
+        content=readiness,
+        status_code=200 if readiness["ready"] else 503)
+
+
 app.mount(
     path="/marketing", app=StaticFiles(directory="/static", html=True), name="static"
 )
@@ -368,9 +405,9 @@ def post_text_bison_generate(data: TextGenerateRequest,
     """
    
     if data.model == "latest":
-        llm = llm_latest
+        llm = model_registry.get_text_model(TEXT_MODEL_LATEST)
     elif data.model == "ga":
-        llm = llm_ga
+        llm = model_registry.get_text_model_ga(TEXT_MODEL_GA)
     else:
         raise HTTPException(
             status_code=400, 
@@ -393,6 +430,48 @@ def post_text_bison_generate(data: TextGenerateRequest,
         )
 
 
+@router.post(path="/generate-text-stream")
+def post_text_bison_generate_stream(data: TextGenerateRequest,
+                                    ) -> StreamingResponse:
+    """Text generation with PaLM API, streamed as server-sent events
+    Parameters:
+        model: str = "latest"
+            [Options] "latest" | "ga"
+        prompt: str
+        temperature: float = 0.2
+        top_k: int = 40
+        top_p: float = 0.8
+        max_output_tokens: int = 1024
+    Returns:
+        text/event-stream: data: {"text": "..."} events with the
+        response chunks, then a "done" or "error" event
+    """
+   
+    if data.model == "latest":
+        model_name = TEXT_MODEL_LATEST
+        llm = model_registry.get_text_model(model_name)
+    elif data.model == "ga":
+        model_name = TEXT_MODEL_GA
+        llm = model_registry.get_text_model_ga(model_name)
+    else:
+        raise HTTPException(
+            status_code=400, 
+            detail="Invalid model name. Options: ga | latest."
+            )
+
+    chunks = utils_prompt.stream_predict_text_llm(
+        llm=llm,
+        model_name=model_name,
+        prompt=data.prompt,
+        max_output_tokens=data.max_output_tokens,
+        temperature=data.temperature,
+        top_k=data.top_k,
+        top_p=data.top_p)
+    return StreamingResponse(
+        utils_prompt.to_sse_events(chunks),
+        media_type="text/event-stream")
+
+
 @router.post(path="/generate-image")
 def post_image_generate(data: ImageGenerateRequest,
                         ) -> ImageGenerateResponse:
@@ -408,6 +487,7 @@ def post_image_generate(data: ImageGenerateRequest,
             images_parameters (dict): Parameters used with the model
     """
     try:
+        imagen = model_registry.get_image_model(IMAGE_MODEL_NAME)
         imagen_responses = imagen.generate_images(
             prompt=data.prompt,
             number_of_images=data.number_of_images,
@@ -455,6 +535,7 @@ def post_image_edit(data: ImageEditRequest
         mask = Image(image_bytes=base64.b64decode(data.mask_base64))
 
     try:
+        imagen = model_registry.get_image_model(IMAGE_MODEL_NAME)
         imagen_responses = imagen.edit_image(
             prompt=data.prompt,
             base_image=Image(image_bytes=base64.b64decode(data.base_image_base64)),
@@ -492,7 +573,7 @@ def get_top_search_term(trends_date: str
     Returns:
         top_search_terms: list[dict[int, str]]
     """
-    try:
+    def query_top_terms() -> list:
         query = (
             "SELECT term, rank "
             "FROM `bigquery-public-data.google_trends.top_terms` "
@@ -501,10 +582,14 @@ def get_top_search_term(trends_date: str
             "ORDER by rank ASC"
         )
         query_job = bq_client.query(query, location="US")
-        trends = [
+        return [
             {"rank": i[1], "term":i[0]}
                 for i in query_job.result()
         ]
+
+    try:
+        trends = trends_singleflight.do(
+            make_key("top_terms", trends_date), query_top_terms)
     except Exception as e:
         message = "Date must use the format YYY-MM-DD. " + str(e)
         raise HTTPException(status_code=400, detail=message)
@@ -532,7 +617,13 @@ def post_summarize_news(data: NewsSummaryRequest,request: Request
     start_date = end_date - timedelta(data.max_days)
 
     try:
-        documents = trendspotting.get_relevant_documents(
+        documents = trends_singleflight.do(
+            make_key(
+                "news",
+                sorted(data.keywords),
+                data.max_days,
+                data.max_records),
+            trendspotting.get_relevant_documents,
             data.keywords,
             start_date.strftime('%Y%m%d%H%M%S'),
             end_date.strftime('%Y%m%d%H%M%S'),
@@ -545,7 +636,9 @@ def post_summarize_news(data: NewsSummaryRequest,request: Request
     try:
         summaries = []
         for doc in documents:
-            summary = trendspotting.summarize_news_article(doc["page_content"], llm_ga)
+            summary = trendspotting.summarize_news_article(
+                doc["page_content"],
+                model_registry.get_text_model_ga(TEXT_MODEL_GA))
             summaries.append({
                 "original_headline": doc["title"],
                 "summary":summary,
@@ -580,7 +673,7 @@ def post_audiences(data: AudiencesRequest) -> AudiencesResponse:
 
     try:
         audiences, gen_code, prompt = utils_codey.generate_sql_and_query(
-            llm=llm_ga,
+            llm=model_registry.get_text_model_ga(TEXT_MODEL_GA),
             datacatalog_client=datacatalog_client,
             prompt_template=prompt_nl_sql,
             query_metadata=query_metadata,
@@ -688,7 +781,7 @@ def post_upload_file_drive(folder_id: str,file: UploadFile):
     
     try:
         file_id = utils_workspace.upload_to_folder(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             f=file.file,
             folder_id=folder_id,
             upload_name=file.filename,
@@ -743,22 +836,22 @@ def post_brief_create_upload(data: BriefCreateRequest) -> BriefCreateResponse:
     try:
         print("Creating document Assets..")
         new_folder_id = utils_workspace.create_folder_in_folder(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             folder_name=f"Marketing_Assets_{int(time.time())}",
             parent_folder_id=drive_folder_id)
         
         utils_workspace.set_permission(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             file_id=new_folder_id)
 
         doc_id = utils_workspace.copy_drive_file(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             drive_file_id=doc_template_id,
             parentFolderId=new_folder_id,
             copy_title=f"GenAI Marketing Brief")
 
         utils_workspace.update_doc(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             document_id=doc_id,
             campaign_name=data.campaign_name,
             business_name=data.business_name,
@@ -791,20 +884,20 @@ def post_create_slides_upload(data: SlidesCreateRequest
 
     try:
         slide_id = utils_workspace.copy_drive_file(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             drive_file_id=slides_template_id,
             parentFolderId=data.folder_id,
             copy_title="Marketing Assets")
         
         sheet_id = utils_workspace.copy_drive_file(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             drive_file_id=sheet_template_id,
             parentFolderId=data.folder_id,
             copy_title="GenAI Marketing Data Source")
         print(sheet_id)     
 
         utils_workspace.merge_slides(
-            credentials = CREDENTIALS,
+            credentials = CREDENTIALS.get(),
             presentation_id=slide_id,
             spreadsheet_id=sheet_id,
             spreadsheet_template_id=sheet_template_id,
@@ -960,6 +1053,77 @@ def generate_content(data: ContentCreationRequest
     )
 
 
+@router.post(path="/generate-content-stream")
+def generate_content_stream(data: ContentCreationRequest
+                            ) -> StreamingResponse:
+    """Generate Content like Media , Ad or Emails, streamed as
+    server-sent events
+    Body:
+        type: str | Email/Webpost/SocialMedia/AssetGroup
+        theme: str
+        context: str | None = None
+        no_of_char: int = 500
+        audience_age_range: str = '20-30'
+        audience_gender:str = 'All'
+        image_generate: bool = True
+    Returns:
+        text/event-stream:
+            data: {"text": "..."} events with the text content chunks,
+            an "images" event with the generated images,
+            then a "done" or "error" event.
+            AssetGroup is not streamed, its content is sent in a single
+            "content" event.
+    """
+    text_prompts = {
+        'Email': lambda: EMAIL_TEXT_PROMPT.format(
+            data.context,
+            data.theme),
+        'Webpost': lambda: WEBSITE_PROMPT_TEMPLATE.format(
+            data.theme,
+            data.context),
+        'SocialMedia': lambda: AD_PROMPT_TEMPLATE.format(
+            BUSINESS_NAME,
+            data.no_of_char,
+            data.audience_age_range,
+            data.audience_gender,
+            data.theme,
+            data.context),
+    }
+
+    if data.type not in text_prompts:
+        # Several texts are generated, use the non streaming endpoint
+        content = generate_content(data)
+        def content_event():
+            content_json = json.dumps(jsonable_encoder(content))
+            yield f"event: content\ndata: {content_json}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        return StreamingResponse(
+            content_event(),
+            media_type="text/event-stream")
+
+    def content_events():
+        chunks = utils_prompt.stream_predict_text_llm(
+            llm=model_registry.get_text_model(TEXT_MODEL_NAME),
+            model_name=TEXT_MODEL_NAME,
+            prompt=text_prompts[data.type]())
+        for event in utils_prompt.to_sse_events(chunks, done_event=False):
+            yield event
+            if event.startswith("event: error"):
+                return
+        if data.image_generate == True:
+            images = asyncio.run(utils_prompt.async_generate_image(
+                    prompt=IMAGE_PROMPT_TAMPLATE.format(
+                            data.theme,)
+            ))
+            images_json = json.dumps(jsonable_encoder(images or []))
+            yield f"event: images\ndata: {images_json}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(
+        content_events(),
+        media_type="text/event-stream")
+
+
 @router.post(path="/bulk-email-generate")
 def post_bulk_email_generate(data: BulkEmailGenRequest) -> BulkEmailGenResponse:
     """
@@ -999,7 +1163,7 @@ def post_export_google_doc(data:ExportGoogleDocRequest) -> ExportGoogleDocRespon
     """
     
     try:
-        file_id = utils_workspace.create_doc(credentials = CREDENTIALS,
+        file_id = utils_workspace.create_doc(credentials = CREDENTIALS.get(),
                                              folder_id=data.folder_id,
                                              doc_name=data.doc_name,
                                              text=data.text)
@@ -1008,7 +1172,7 @@ def post_export_google_doc(data:ExportGoogleDocRequest) -> ExportGoogleDocRespon
             file = utils_gcs.download_from_gcs(project_id=project_id,
                                                bucket_name=bucket_name,
                                                source_blob_name='/'.join(img.split('/')[1:]))
-            utils_workspace.upload_to_folder(credentials= CREDENTIALS,
+            utils_workspace.upload_to_folder(credentials= CREDENTIALS.get(),
                                              f=file,
                                              folder_id=data.folder_id,
                                              upload_name=str(data.image_prefix)+"_"+str(i),
@@ -21,6 +21,7 @@ import firebase_admin
 from firebase_admin import firestore,credentials, auth
 import os
 from .body_schema import Campaign, CampaignList
+from .utils_lazy import lazy
 import json
 import tomllib
 import google.oauth2.id_token
@@ -35,7 +36,7 @@ with open("/code/app/config.toml", "rb") as f:
 
 # Application Default credentials are automatically created.
 app = firebase_admin.initialize_app()
-db = firestore.client()
+db = lazy(firestore.client)
 
 def to_serializable(val):
     if hasattr(val, '__dict__'):
@@ -0,0 +1,178 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Process-wide registry of Vertex AI model handles
+
+Each model is resolved with from_pretrained once and reused by every
+request. The models used by the API are resolved in the background at
+startup and the registry reports when they are ready.
+"""
+
+import threading
+import time
+
+from vertexai.language_models import TextGenerationModel as TextModelGA
+from vertexai.preview.language_models import TextGenerationModel
+from vertexai.preview.vision_models import ImageGenerationModel
+
+# Model kinds and the class used to resolve them
+TEXT = "text"
+TEXT_GA = "text_ga"
+IMAGE = "image"
+MODEL_CLASSES = {
+    TEXT: TextGenerationModel,
+    TEXT_GA: TextModelGA,
+    IMAGE: ImageGenerationModel,
+}
+
+
+class ModelRegistry:
+    """Resolves each model once and keeps the handle for the process"""
+
+    def __init__(self, model_classes: dict | None = None):
+        """
+        Args:
+            model_classes: dict | None
+                Class with a from_pretrained method for each model kind
+        """
+        self.model_classes = model_classes or MODEL_CLASSES
+        self._models = {}
+        self._status = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._warm_up_done = False
+
+    def _model_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, kind: str, model_name: str):
+        """Gets the handle of a model, resolving it on first use
+
+        Args:
+            kind: str
+                Model kind: text | text_ga | image
+            model_name: str
+                Model name, e.g. text-bison@002
+
+        Returns:
+            The model handle
+        """
+        key = (kind, model_name)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        # One lock per model, so a slow model does not block the others
+        with self._model_lock(key):
+            model = self._models.get(key)
+            if model is not None:
+                return model
+            status_key = f"{kind}:{model_name}"
+            self._status[status_key] = {"status": "loading"}
+            started_at = time.monotonic()
+            try:
+                model = self.model_classes[kind].from_pretrained(model_name)
+            except Exception as e:
+                self._status[status_key] = {
+                    "status": "error",
+                    "error": str(e),
+                }
+                raise
+            self._models[key] = model
+            self._status[status_key] = {
+                "status": "ready",
+                "load_ms": (time.monotonic() - started_at) * 1000,
+            }
+            return model
+
+    def get_text_model(self, model_name: str) -> TextGenerationModel:
+        """Gets a text model (preview SDK)"""
+        return self.get(TEXT, model_name)
+
+    def get_text_model_ga(self, model_name: str) -> TextModelGA:
+        """Gets a text model (GA SDK)"""
+        return self.get(TEXT_GA, model_name)
+
+    def get_image_model(self, model_name: str) -> ImageGenerationModel:
+        """Gets an image generation model"""
+        return self.get(IMAGE, model_name)
+
+    def warm_up(
+            self,
+            models: list[tuple[str, str]],
+            retry_delay_seconds: float = 1.0,
+            max_retry_delay_seconds: float = 60.0):
+        """Resolves a list of models. The models that fail are retried
+        with exponential backoff until all of them are resolved. Errors
+        are recorded in the status.
+
+        Args:
+            models: list[tuple[str, str]]
+                (kind, model_name) of each model
+            retry_delay_seconds: float
+                Delay before the first retry
+            max_retry_delay_seconds: float
+                Maximum delay between two retries
+        """
+        pending = list(dict.fromkeys(models))
+        delay = retry_delay_seconds
+        while True:
+            failed = []
+            for kind, model_name in pending:
+                try:
+                    self.get(kind, model_name)
+                except Exception as e:
+                    print(f"Error warming up {kind}:{model_name}. {e}")
+                    failed.append((kind, model_name))
+            if not failed:
+                break
+            print(f"Retrying the warm-up of {len(failed)} models "
+                  f"in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, max_retry_delay_seconds)
+            pending = failed
+        self._warm_up_done = True
+
+    def warm_up_in_background(
+            self,
+            models: list[tuple[str, str]]
+        ) -> threading.Thread:
+        """Runs warm_up in a daemon thread, so the server can start
+        serving while the models are resolved and retried.
+        """
+        thread = threading.Thread(
+            target=self.warm_up,
+            args=(models,),
+            name="model-warm-up",
+            daemon=True)
+        thread.start()
+        return thread
+
+    def readiness(self) -> dict:
+        """Returns the readiness of the warm-up models
+
+        Returns:
+            dict
+                ready: True when the warm-up resolved every warm-up
+                model. Failed models are retried by the warm-up thread.
+                models: status of each model
+        """
+        return {
+            "ready": self._warm_up_done,
+            "models": dict(self._status),
+        }
+
+
+model_registry = ModelRegistry()
@@ -18,10 +18,14 @@ A utility module for performing prompt engineering with the Vertex PaLM API.
 """
 
 
-import asyncio
-import functools
+import json
 import vertexai
 import tomllib
+from typing import Iterable, Iterator
+
+from .utils_llm_executor import llm_executor
+from .utils_models import model_registry
+from .utils_singleflight import get_group, make_key
 
 # Load configuration file
 with open("/code/app/config.toml", "rb") as f:
@@ -32,7 +36,9 @@ location = config["global"]["location"]
 vertexai.init(project=project_id, location=location)
 
 from vertexai.preview.language_models import TextGenerationModel
-from vertexai.preview.vision_models import ImageGenerationModel
+
+# Identical concurrent prompts share one model call
+llm_singleflight = get_group("llm")
 
 async def async_predict_text_llm(
         prompt: str,
@@ -42,19 +48,21 @@ async def async_predict_text_llm(
         top_k: int=40,
         top_p: float=0.8
     )-> str:
-    loop = asyncio.get_running_loop()
-    llm = TextGenerationModel.from_pretrained(pretrained_model)
+    llm = model_registry.get_text_model(pretrained_model)
     generated_response = None
    
     try:
-        generated_response = await loop.run_in_executor(
-            None,
-            functools.partial(
+        generated_response = await llm_singleflight.do_async(
+            make_key(
+                pretrained_model, prompt, temperature,
+                max_output_tokens, top_k, top_p),
+            lambda: llm_executor.run(
+                pretrained_model,
                 llm.predict,
-                    prompt=prompt, 
-                    temperature=temperature, 
-                    max_output_tokens=max_output_tokens, 
-                    top_k=top_k, top_p=top_p))
+                prompt=prompt, 
+                temperature=temperature, 
+                max_output_tokens=max_output_tokens, 
+                top_k=top_k, top_p=top_p))
     except Exception as e:
         print(e)
 
@@ -62,17 +70,70 @@ async def async_predict_text_llm(
         return generated_response.text
     return ""
 
+def stream_predict_text_llm(
+        llm: TextGenerationModel,
+        model_name: str,
+        prompt: str,
+        max_output_tokens: int=1024,
+        temperature: float=0.4,
+        top_k: int=40,
+        top_p: float=0.8
+    )-> Iterator[str]:
+    """Streams the response of a text model as it is generated.
+    If the stream fails before the first chunk, the response is
+    generated without streaming. A slot of the model_name limiter
+    (see utils_llm_executor) is held while the response is streamed.
+    """
+    started = False
+    with llm_executor.hold(model_name):
+        try:
+            for response in llm.predict_streaming(
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_output_tokens=max_output_tokens,
+                    top_k=top_k, top_p=top_p):
+                if response.text:
+                    started = True
+                    yield response.text
+        except Exception as e:
+            if started:
+                raise
+            print(f"Streaming failed, generating without streaming. {e}")
+            yield llm.predict(
+                prompt=prompt,
+                temperature=temperature,
+                max_output_tokens=max_output_tokens,
+                top_k=top_k, top_p=top_p).text
+
+
+def to_sse_events(
+        chunks: Iterable[str],
+        done_event: bool=True
+    ) -> Iterator[str]:
+    """Formats text chunks as server-sent events.
+    Each chunk is sent as a JSON {"text": ...} data event. The stream ends
+    with a "done" event (unless done_event is False), or an "error" event
+    if generation failed.
+    """
+    try:
+        for chunk in chunks:
+            yield f"data: {json.dumps({'text': chunk})}\n\n"
+    except Exception as e:
+        print(e)
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+        return
+    if done_event:
+        yield "event: done\ndata: {}\n\n"
+
 async def async_generate_image(prompt,number_of_images=4):
-    loop = asyncio.get_running_loop()
     # Image models
-    imagen = ImageGenerationModel.from_pretrained(config["models"]["image_model_name"])
+    imagen = model_registry.get_image_model(config["models"]["image_model_name"])
     try:
-        imagen_responses = await loop.run_in_executor(
-            None,
-            functools.partial(
-                imagen.generate_images,
-                    prompt=prompt, 
-                    number_of_images=number_of_images))
+        imagen_responses = await llm_executor.run(
+            config["models"]["image_model_name"],
+            imagen.generate_images,
+            prompt=prompt, 
+            number_of_images=number_of_images)
     except Exception as e:
         print(str(e))
     else:
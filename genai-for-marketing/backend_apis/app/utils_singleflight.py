@@ -0,0 +1,214 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Coalescing of identical in-flight calls (singleflight)
+
+The first call for a key runs the upstream call. Identical calls made
+while it is in flight wait for it and share its result, or its exception.
+Sync callers (threads) and async callers (any event loop, including the
+ones created with asyncio.run by sync routes) share the same in-flight
+calls.
+
+Copy of backend-apis/app/utils/utils_singleflight.py, the canonical version.
+Change that module first and port the change here.
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import typing
+from concurrent.futures import Future
+
+_groups: dict[str, "SingleFlight"] = {}
+_groups_lock = threading.Lock()
+
+
+def make_key(*args, **kwargs) -> str:
+    """Builds a key from normalized call arguments
+
+    Args:
+        *args:
+            JSON serializable positional arguments
+        **kwargs:
+            JSON serializable keyword arguments, in any order
+
+    Returns:
+        str
+            SHA-256 of the arguments
+    """
+    payload = json.dumps(
+        {"args": args, "kwargs": kwargs}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """Group of calls coalesced by key, with its metrics"""
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name: str
+                Name of the group, used in the metrics
+        """
+        self.name = name
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            self.executions += 1
+            return future, True
+
+    def _finish(self, key: str, future: Future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def do(self, key: str, func: typing.Callable, *args, **kwargs):
+        """Runs a blocking call, or waits for the identical call in flight
+
+        Args:
+            key: str
+                Key of the call
+            func: typing.Callable
+                Blocking function
+            *args:
+                Positional arguments of func
+            **kwargs:
+                Keyword arguments of func
+
+        Returns:
+            The result of func
+        """
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    return future.result()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    if future.cancelled():
+                        # The leader was cancelled, run the call again
+                        continue
+                    raise
+
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self.errors += 1
+                self._finish(key, future)
+                future.set_exception(e)
+                raise
+            self._finish(key, future)
+            future.set_result(result)
+            return result
+
+    async def do_async(
+        self, key: str, coro_func: typing.Callable[[], typing.Awaitable]
+    ):
+        """Awaits a call, or waits for the identical call in flight
+
+        Args:
+            key: str
+                Key of the call
+            coro_func: typing.Callable[[], typing.Awaitable]
+                Function without arguments returning the awaitable
+
+        Returns:
+            The result of the awaitable
+        """
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                wrapped = asyncio.wrap_future(future)
+                # Waits without propagating the cancellation of the
+                # leader, which could be in another event loop
+                await asyncio.wait({wrapped})
+                if future.cancelled():
+                    continue
+                return wrapped.result()
+
+            try:
+                result = await coro_func()
+            except asyncio.CancelledError:
+                self._finish(key, future)
+                future.cancel()
+                raise
+            except BaseException as e:
+                with self._lock:
+                    self.errors += 1
+                self._finish(key, future)
+                future.set_exception(e)
+                raise
+            self._finish(key, future)
+            future.set_result(result)
+            return result
+
+    def stats(self) -> dict:
+        """Returns the group counters
+
+        Returns:
+            dict
+                Calls, upstream executions, coalesced calls, errors and
+                keys in flight
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "in_flight": len(self._in_flight),
+            }
+
+
+def get_group(name: str) -> SingleFlight:
+    """Gets the process-wide group of a name, creating it on first use
+
+    Args:
+        name: str
+            Group name, e.g. "llm" or "embeddings"
+
+    Returns:
+        SingleFlight
+    """
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+
+def get_singleflight_stats() -> dict:
+    """Gets the counters of every group
+
+    Returns:
+        dict
+            Counters of each group, by name
+    """
+    with _groups_lock:
+        groups = dict(_groups)
+    return {name: group.stats() for name, group in groups.items()}